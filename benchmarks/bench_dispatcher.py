@@ -0,0 +1,114 @@
+# pylint: disable=redefined-outer-name
+"""
+    benchmarks of the dispatcher hot paths
+
+    runs with pytest-benchmark against the fixtures in conftest.py.  save
+    a run under the current commit and compare later runs against it:
+        pipenv run python -m pytest benchmarks/bench_dispatcher.py --benchmark-autosave
+        pipenv run python -m pytest benchmarks/bench_dispatcher.py --benchmark-compare
+
+    set BENCH_DATABASE_URL to run against postgres, STUB_LATENCY to slow
+    down the stub external system and CSV_ROWS to change the export size
+"""
+import os
+import json
+import itertools
+import pytest
+from falcon import testing
+from forms import generate_form, generate_forms, MAX_ADUS
+import tasks
+import service.microservice
+from service.resources.jobs import schedule
+from service.resources.external_systems import MAP, template_columns
+from service.resources.registry import get_registry
+from service.resources.submission_model import Submission, create_submission
+
+CSV_ROWS = int(os.environ.get('CSV_ROWS', 500))
+ACCESS_KEY = 'benchmark'
+
+@pytest.fixture
+def client(database, monkeypatch):
+    # pylint: disable=unused-argument
+    """client for the service with rate limiting off"""
+    monkeypatch.setenv('ACCESS_KEY', ACCESS_KEY)
+    monkeypatch.setenv('RATE_LIMIT_PER_SECOND', '0')
+    # the queue depth is still probed, just never over the limit
+    monkeypatch.setenv('SHED_QUEUE_DEPTH', str(10**9))
+    return testing.TestClient(app=service.microservice.start_service(),\
+            headers={'ACCESS_KEY': ACCESS_KEY})
+
+@pytest.fixture
+def csv_backlog(db_session, tmp_path, monkeypatch):
+    """returns a setup adding CSV_ROWS unprocessed submissions, exports go to tmp_path"""
+    monkeypatch.setattr(tasks, 'CSV_DIR', str(tmp_path))
+    monkeypatch.delenv('DBI_FTP_SERVER', raising=False)
+
+    def setup(num_adus=None):
+        db_session.query(Submission).filter(Submission.csv_date_processed.is_(None))\
+                .update({Submission.csv_date_processed: tasks.datetime.utcnow()},\
+                synchronize_session=False)
+        db_session.add_all([Submission(data=json.dumps(form))\
+                for form in generate_forms(CSV_ROWS, num_adus=num_adus)])
+        db_session.commit()
+    return setup
+
+def test_forms_match_template():
+    """every column of the dbi template is filled when all units are"""
+    form = generate_form(num_adus=MAX_ADUS)
+    assert MAX_ADUS == 15
+    assert {form_id for _, form_id in template_columns(MAP["dbi"]["template"])} <= set(form)
+
+def test_validate(measure):
+    """compiled validation of one form"""
+    forms = itertools.cycle(generate_forms(500, seed=2))
+
+    def setup():
+        return (next(forms),), {}
+    measure(get_registry().validator, setup=setup, rounds=5000)
+
+def test_on_post(measure, client):
+    """submission POST: validation, insert and scheduling"""
+    forms = itertools.cycle(generate_forms(500, seed=1))
+
+    def setup():
+        return (), {'json': next(forms)}
+    response = measure(lambda json: client.simulate_post('/submissions', json=json),\
+            setup=setup, rounds=200)
+    assert response.status_code == 200
+
+def test_schedule(measure, db_session, stub_systems):
+    """ledger writes and job publish for a new submission"""
+    def setup():
+        return (create_submission(db_session, generate_form()),), {'registry': stub_systems}
+    jobs = measure(schedule, setup=setup, rounds=200)
+    assert len(jobs) == 1
+
+def test_dispatch(measure, db_session, stub_systems):
+    """claim, post to the stub external system and record its id"""
+    def setup():
+        submission = create_submission(db_session, generate_form())
+        # workers get a detached copy, as unpickled from the job
+        db_session.refresh(submission)
+        db_session.expunge(submission)
+        return ('stub', stub_systems.version, submission), {}
+    result = measure(lambda *args: tasks.dispatch.apply(args=args), setup=setup, rounds=200)
+    assert result.successful()
+
+@pytest.mark.parametrize('num_adus', [1, MAX_ADUS])
+def test_create_csv(measure, db_session, csv_backlog, num_adus):
+    """checkpointed csv export of CSV_ROWS submissions"""
+    def setup():
+        csv_backlog(num_adus)
+        return (db_session, 'dbi', get_registry().systems['dbi']), {}
+    file_path = measure(tasks.create_csv, setup=setup, rounds=10, items=CSV_ROWS)
+    with open(file_path) as csv_file:
+        assert sum(1 for _ in csv_file) == CSV_ROWS + 1
+
+def test_outbound_csv(measure, csv_backlog):
+    """the beat scheduled export task for every csv system"""
+    def setup():
+        csv_backlog()
+        return (), {}
+    result = measure(tasks.outbound_csv.apply, setup=setup, rounds=10,\
+            items=CSV_ROWS)
+    assert result.successful()
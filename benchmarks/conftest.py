@@ -0,0 +1,145 @@
+# pylint: disable=redefined-outer-name
+"""
+    fixtures for the benchmark suite
+
+    jobs go to an in-memory broker unless REDIS_URL is set, submissions to
+    a throwaway sqlite database unless BENCH_DATABASE_URL points at postgres
+"""
+import os
+import json
+import time
+import itertools
+import tracemalloc
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+os.environ.setdefault('REDIS_URL', 'memory://')
+
+STUB_URL_VAR = 'STUB_SYSTEM_URL'
+# stand in for an api system, answering in STUB_LATENCY seconds
+STUB_SYSTEMS = {
+    "stub": {
+        "type": "api",
+        "env_var": STUB_URL_VAR,
+        "template": {
+            "block": "",
+            "lot": ""
+        }
+    }
+}
+
+class StubHandler(BaseHTTPRequestHandler):
+    """answers every post with a jsend success carrying a new id"""
+    ids = itertools.count(1)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """read the payload and hand out the next id"""
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.seconds:
+            time.sleep(self.server.seconds)
+        body = json.dumps({"status": "success", "data": {"id": next(self.ids)}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """keep the benchmark output quiet"""
+
+@pytest.fixture(scope='session')
+def database(tmp_path_factory):
+    """point the service at the benchmark database, with its tables created"""
+    # pylint: disable=import-outside-toplevel
+    from service.resources.db_session import get_engine, dispose_engine
+    from service.resources.submission_model import BASE
+    dispose_engine()
+    os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL') or\
+            'sqlite:///' + str(tmp_path_factory.mktemp('db') / 'bench.db')
+    engine = get_engine()
+    # the service logs every statement, which would drown the timings
+    engine.echo = False
+    BASE.metadata.create_all(engine)
+    yield engine
+    dispose_engine()
+
+@pytest.fixture
+def db_session(database):
+    # pylint: disable=unused-argument
+    """session on the benchmark database"""
+    # pylint: disable=import-outside-toplevel
+    from service.resources.db_session import create_session
+    session = create_session()()
+    yield session
+    session.close()
+
+@pytest.fixture(scope='session')
+def stub_server():
+    """local http server standing in for the external systems"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.seconds = float(os.environ.get('STUB_LATENCY', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    os.environ[STUB_URL_VAR] = 'http://{0}:{1}/'.format(*server.server_address)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def stub_systems(stub_server, monkeypatch):
+    # pylint: disable=unused-argument
+    """registry with a single api system answered by the stub server"""
+    # pylint: disable=import-outside-toplevel
+    from service.resources.registry import Registry
+    registry = Registry(STUB_SYSTEMS, version=1)
+    monkeypatch.setattr('service.resources.registry.REGISTRY', registry)
+    yield registry
+    purge_queue('dispatch.stub')
+
+def purge_queue(name):
+    """drop the jobs benchmarks left on a queue"""
+    # pylint: disable=import-outside-toplevel
+    from service.resources.jobs import get_celery
+    with get_celery().connection_for_write() as conn:
+        conn.default_channel.queue_purge(name)
+
+def percentile(ordered, fraction):
+    """nearest rank percentile of sorted values"""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+@pytest.fixture
+def measure(benchmark):
+    """
+        benchmark func and add what pytest-benchmark leaves out to the
+        stored results: latency percentiles, throughput in items (rows,
+        submissions) per second and peak python memory of one more run
+    """
+    def run(func, setup=None, rounds=50, items=1):
+        def args():
+            return setup() if setup else ((), {})
+        result = benchmark.pedantic(func, setup=args, rounds=rounds, warmup_rounds=1)
+        if benchmark.stats is None:
+            # --benchmark-disable runs func once as a smoke test, nothing is timed
+            return result
+
+        call_args, call_kwargs = args()
+        tracemalloc.start()
+        try:
+            func(*call_args, **call_kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        stats = benchmark.stats.stats
+        ordered = stats.sorted_data
+        benchmark.extra_info.update({
+            'p50_ms': percentile(ordered, 0.50) * 1000,
+            'p95_ms': percentile(ordered, 0.95) * 1000,
+            'p99_ms': percentile(ordered, 0.99) * 1000,
+            'items_per_second': items / stats.mean,
+            'peak_memory_kb': peak / 1024
+        })
+        return result
+    return run
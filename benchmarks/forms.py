@@ -0,0 +1,77 @@
+"""
+    synthetic adu form submissions shaped like the dbi csv template
+
+    every field id of MAP["dbi"]["template"] gets a plausible value, the
+    15 unit grouping is filled for current_num_adu units and left out for
+    the rest, like the real form does
+"""
+import random
+import string
+from service.resources.external_systems import MAP, GROUP_COUNTER_REPLACEMENT_STRING
+
+MAX_ADUS = next(item["count"] for item in MAP["dbi"]["template"]\
+        if item.get("type") == "grouping")
+UNIT_TYPES = ["detached", "attached", "garage conversion", "basement conversion"]
+ORDINANCES = ["state", "local"]
+YES_NO = ["yes", "no"]
+
+def words(rng, count):
+    """count random lowercase words"""
+    return " ".join("".join(rng.choice(string.ascii_lowercase)\
+            for _ in range(rng.randint(3, 10))) for _ in range(count))
+
+def field_value(rng, field_id):
+    # pylint: disable=too-many-return-statements
+    """plausible value for a form field, guessed from its id"""
+    if field_id in ("block", "lot"):
+        return str(rng.randint(1, 9999)).zfill(4)
+    if "email" in field_id:
+        return words(rng, 1) + "@example.com"
+    if "phone" in field_id:
+        return "415-" + str(rng.randint(200, 999)) + "-" + str(rng.randint(1000, 9999))
+    if field_id.endswith("zip"):
+        return str(rng.randint(94102, 94188))
+    if field_id.endswith("state"):
+        return "CA"
+    if field_id.endswith("_yn") or field_id.startswith(("change_after_adu", "add_", "comp_",\
+            "attestation", "identity_checkboxes", "do_you", "i_am")):
+        return rng.choice(YES_NO)
+    if field_id.startswith(("est_cost", "excavation", "new_", "proposed_residential")):
+        return rng.randint(0, 250000)
+    if "number" in field_id or field_id.endswith(("_units", "_stories", "_cellars")):
+        return rng.randint(0, 12)
+    if field_id.endswith("date"):
+        return "2021-" + str(rng.randint(1, 12)).zfill(2) + "-" + str(rng.randint(1, 28)).zfill(2)
+    if "text" in field_id or "not_listed" in field_id:
+        return words(rng, rng.randint(5, 40))
+    return words(rng, rng.randint(1, 4))
+
+def unit_value(rng, field_id):
+    """value for a field of the per unit grouping"""
+    if field_id.startswith("current_unit_type_adu"):
+        return rng.choice(UNIT_TYPES)
+    if field_id.startswith("current_sq_ft_adu"):
+        return rng.randint(150, 1200)
+    return rng.choice(ORDINANCES)
+
+def generate_form(rng=None, num_adus=None):
+    """one submission's form json, with num_adus units (random when None)"""
+    rng = rng or random.Random()
+    num_adus = rng.randint(1, MAX_ADUS) if num_adus is None else num_adus
+    form = {}
+    for item in MAP["dbi"]["template"]:
+        if item.get("type") == "grouping":
+            for i in range(num_adus):
+                for nested_item in item["template"]:
+                    field_id = nested_item["id"].replace(GROUP_COUNTER_REPLACEMENT_STRING,\
+                            str(i+1))
+                    form[field_id] = unit_value(rng, field_id)
+        else:
+            form[item["id"]] = field_value(rng, item["id"])
+    form["current_num_adu"] = num_adus
+    return form
+
+def generate_forms(count, seed=0, num_adus=None):
+    """count forms from a seeded generator, the same for every run"""
+    rng = random.Random(seed)
+    return [generate_form(rng, num_adus) for _ in range(count)]
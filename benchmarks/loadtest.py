@@ -0,0 +1,107 @@
+"""
+    load test the web process under each gunicorn profile
+
+    starts gunicorn with gunicorn.conf.py for every profile, drives it
+    with keep-alive http clients for a fixed duration and reports
+    successful requests/sec and requests/sec per core
+
+    usage:
+        ACCESS_KEY=123456 pipenv run python benchmarks/loadtest.py \
+            --profiles sync gthread --path /welcome --duration 10
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = 'service.microservice:start_service()'
+SUBMISSION = {"first_name": "bob", "last_name": "smith", "block": 1, "lot": 2}
+
+def wait_for_port(port, timeout=30):
+    """block until the server accepts connections"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn did not start on port " + str(port))
+
+def client_loop(port, path, method, deadline, results):
+    """issue requests over one keep-alive connection until the deadline"""
+    headers = {"ACCESS_KEY": os.environ.get('ACCESS_KEY', ''),\
+            "Content-Type": "application/json"}
+    body = json.dumps(SUBMISSION) if method == 'POST' else None
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    done = errors = 0
+    while time.time() < deadline:
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            # only successful requests count towards the rate
+            if 200 <= response.status < 300:
+                done += 1
+            else:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.close()
+    results.append((done, errors))
+
+def run_profile(profile, args):
+    """start gunicorn with a profile, load it and return the measurements"""
+    env = dict(os.environ, GUNICORN_PROFILE=profile, PORT=str(args.port),\
+            WEB_CONCURRENCY=str(args.workers), RATE_LIMIT_PER_SECOND='0')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn',\
+            '--config', os.path.join(ROOT, 'gunicorn.conf.py'), APP],\
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.port)
+        results = []
+        deadline = time.time() + args.duration
+        clients = [threading.Thread(target=client_loop,\
+                args=(args.port, args.path, args.method, deadline, results))\
+                for _ in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        server.terminate()
+        server.wait()
+    done = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return done / float(args.duration), errors
+
+def main():
+    """parse arguments and print a row per profile"""
+    parser = argparse.ArgumentParser(description=__doc__,\
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', nargs='+', default=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--path', default='/welcome')
+    parser.add_argument('--method', default='GET', choices=['GET', 'POST'])
+    parser.add_argument('--duration', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    cores = multiprocessing.cpu_count()
+    print("{0:<10}{1:>12}{2:>16}{3:>10}".format('profile', 'req/sec', 'req/sec/core', 'errors'))
+    for profile in args.profiles:
+        rate, errors = run_profile(profile, args)
+        print("{0:<10}{1:>12.1f}{2:>16.1f}{3:>10}".format(profile, rate, rate / cores, errors))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+    shows a slow external system no longer delays dispatches to fast ones
+
+    runs in-process celery workers against an in-memory broker standing in
+    for redis.  a backlog of slow dispatches is queued ahead of fast ones,
+    first with every dispatch on one shared queue, then routed with
+    celeryconfig.route_task to a queue per external system using the same
+    total number of worker threads.  reports fast dispatch latency
+
+    usage:
+        pipenv run python benchmarks/queue_isolation.py --slow-jobs 20 --slow-seconds 0.5
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+from contextlib import ExitStack
+import celery
+from celery.contrib.testing.worker import start_worker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import celeryconfig # pylint: disable=wrong-import-position
+
+FINISHED = {}
+LOCK = threading.Lock()
+
+def make_app(routed):
+    """celery app on an in-memory broker, optionally using the per system routes"""
+    app = celery.Celery('queue-isolation', broker='memory://')
+    app.conf.update(
+        task_acks_late=celeryconfig.task_acks_late,
+        # the in-memory transport only tops up prefetched jobs every couple of
+        # seconds (redis does it on every ack), so prefetch everything up front
+        worker_prefetch_multiplier=100,
+        task_ignore_result=True,
+        broker_transport_options={'polling_interval': 0.005},
+        task_routes=celeryconfig.task_routes if routed else None
+    )
+
+    @app.task(name='tasks.dispatch')
+    def dispatch(external_code, seconds, job_id):
+        # pylint: disable=unused-argument
+        """stand in for an external system taking seconds to answer"""
+        time.sleep(seconds)
+        with LOCK:
+            FINISHED[job_id] = time.monotonic()
+    return app
+
+def percentile(values, fraction):
+    """nearest rank percentile, nan when no job finished"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run(routed, args):
+    """queue slow then fast dispatches and return fast dispatch latencies"""
+    FINISHED.clear()
+    app = make_app(routed)
+    if routed:
+        # the stand in systems are not in the registry, give them their queues
+        celeryconfig.DISPATCH_CODES = ('slow', 'fast')
+        workers = [(celeryconfig.dispatch_queue('slow'), args.threads // 2),\
+                (celeryconfig.dispatch_queue('fast'), args.threads - args.threads // 2)]
+    else:
+        workers = [(celeryconfig.DEFAULT_QUEUE, args.threads)]
+
+    with ExitStack() as stack:
+        for queue, threads in workers:
+            stack.enter_context(start_worker(app, pool='threads', concurrency=threads,\
+                    queues=[queue], hostname=queue + '@bench', perform_ping_check=False))
+        queued = {}
+        for i in range(args.slow_jobs):
+            app.send_task('tasks.dispatch', args=('slow', args.slow_seconds, 'slow' + str(i)))
+        for i in range(args.fast_jobs):
+            queued['fast' + str(i)] = time.monotonic()
+            app.send_task('tasks.dispatch', args=('fast', args.fast_seconds, 'fast' + str(i)))
+        deadline = time.monotonic() + args.slow_jobs * args.slow_seconds + 30
+        while len(FINISHED) < args.slow_jobs + args.fast_jobs and time.monotonic() < deadline:
+            time.sleep(0.01)
+    return [FINISHED[job_id] - started for job_id, started in queued.items()\
+            if job_id in FINISHED]
+
+def main():
+    """print fast dispatch latency for the shared and routed setups"""
+    parser = argparse.ArgumentParser(description=__doc__,\
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slow-jobs', type=int, default=20)
+    parser.add_argument('--slow-seconds', type=float, default=0.5)
+    parser.add_argument('--fast-jobs', type=int, default=20)
+    parser.add_argument('--fast-seconds', type=float, default=0.01)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    print("{0:<8}{1:>14}{2:>14}{3:>10}".format('queues', 'fast p50 (s)', 'fast p95 (s)', 'done'))
+    for routed in (False, True):
+        latencies = run(routed, args)
+        print("{0:<8}{1:>14.3f}{2:>14.3f}{3:>10}".format('routed' if routed else 'shared',\
+                percentile(latencies, 0.5), percentile(latencies, 0.95), len(latencies)))
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,50 @@
 
 import os
 from celery.schedules import crontab
+from kombu import Queue
+from service.resources.registry import get_registry
+
+DEFAULT_QUEUE = 'celery'
+BATCH_QUEUE = 'batch'
+BATCH_TASKS = ('tasks.outbound-csv', 'tasks.inbound-csv', 'tasks.replay-dead-letters',\
+        'tasks.archive-submissions', 'tasks.reconcile-csv', 'tasks.export-parquet',\
+        'tasks.expire-callbacks')
+
+def dispatch_queue(external_code):
+    """name of the queue dispatches to an external system go through"""
+    return 'dispatch.' + external_code
+
+# api systems with a queue of their own, those in the registry when the process
+# started.  workers only consume the queues they started with
+DISPATCH_CODES = tuple(get_registry().of_type('api'))
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    # pylint: disable=unused-argument, too-many-arguments
+    """
+        send every external system its own queue so a slow system
+        only backs up its own dispatches, and keep csv batches apart.
+        systems added by a registry reload share the default queue
+        until the workers restart
+    """
+    if name == 'tasks.dispatch':
+        external_code = args[0] if args else kwargs['external_code']
+        if external_code in DISPATCH_CODES:
+            return {'queue': dispatch_queue(external_code)}
+        return {'queue': DEFAULT_QUEUE}
+    if name in BATCH_TASKS:
+        return {'queue': BATCH_QUEUE}
+    return None
 
 # use local time
 enable_utc = False
 
 ## Broker settings.
-broker_url = os.environ['REDIS_URL']
+broker_url = os.environ.get('REDIS_URL')
+# unacknowledged jobs are redelivered after this many seconds, it must
+# be longer than the slowest dispatch or export
+broker_transport_options = {
+    'visibility_timeout': int(os.environ.get('CELERY_VISIBILITY_TIMEOUT', 3600))
+}
 
 # List of modules to import when the Celery worker starts.
 imports = ('tasks',)
@@ -16,6 +54,21 @@ imports = ('tasks',)
 task_serializer = 'pickle'
 accept_content = ['pickle', 'application/x-python-serialize', 'json', 'application/json']
 
+## Routing
+task_queues = [Queue(DEFAULT_QUEUE), Queue(BATCH_QUEUE)] +\
+        [Queue(dispatch_queue(code)) for code in DISPATCH_CODES]
+task_routes = (route_task,)
+
+## Worker settings
+# ack once the job finished so jobs of a worker that dies are redelivered,
+# the dispatch ledger drops any that already reached the external system
+task_acks_late = True
+task_reject_on_worker_lost = True
+# long running jobs should not hold back prefetched short ones
+worker_prefetch_multiplier = int(os.environ.get('CELERY_PREFETCH_MULTIPLIER', 1))
+# job ids are only returned for tracing, nothing reads the results
+task_ignore_result = True
+
 beat_schedule = {
     "csv-export": {
         "task": "tasks.outbound-csv",
@@ -24,5 +77,21 @@ beat_schedule = {
     "csv-import": {
         "task": "tasks.inbound-csv",
         "schedule": crontab(hour=6, minute=0) # run every day at 6am
+    },
+    "csv-reconcile": {
+        "task": "tasks.reconcile-csv",
+        "schedule": crontab(hour=6, minute=30) # run every day at 6:30am
+    },
+    "parquet-export": {
+        "task": "tasks.export-parquet",
+        "schedule": crontab(hour=4, minute=0) # run every day at 4am
+    },
+    "callback-deadline": {
+        "task": "tasks.expire-callbacks",
+        "schedule": crontab(minute=15) # run every hour at quarter past
+    },
+    "archive": {
+        "task": "tasks.archive-submissions",
+        "schedule": crontab(hour=3, minute=0) # run every day at 3am
     }
 }
@@ -0,0 +1,44 @@
+"""gunicorn configuration
+
+    GUNICORN_PROFILE selects the worker model
+        sync    - one request at a time per worker process
+        gthread - GUNICORN_THREADS requests at a time per worker process (default)
+        gevent  - GUNICORN_CONNECTIONS greenlets per worker process,
+                  with psycopg2 patched by psycogreen
+"""
+# pylint: disable=invalid-name
+import os
+import multiprocessing
+
+PROFILE = os.environ.get('GUNICORN_PROFILE', 'gthread')
+
+if PROFILE == 'gevent':
+    # patch before the app and its db driver are imported by preload
+    from gevent import monkey # pylint: disable=import-error
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg # pylint: disable=import-error
+    patch_psycopg()
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = PROFILE
+# gunicorn silently turns sync workers into gthread workers when threads > 1
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if PROFILE == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+
+# import the app and the external systems MAP once in the master so
+# workers share those pages instead of each importing them.  celery,
+# celeryconfig and tasks are not among them, the web process only loads
+# celery on its first enqueue, after the fork
+preload_app = True
+
+def post_fork(server, worker):
+    # pylint: disable=unused-argument
+    """
+        connections must not be shared across processes,
+        give each worker a fresh db pool
+    """
+    from service.resources.db_session import dispose_engine # pylint: disable=import-outside-toplevel
+    dispose_engine()
@@ -0,0 +1,37 @@
+# pylint: skip-file
+"""dispatch ledger
+
+    one row per submission and external system tracking
+    queued, in-flight, done and failed dispatches
+
+Revision ID: 3b8f2d6c1a4e
+Revises: 886f03e523c6
+Create Date: 2026-10-19 09:12:31.228416
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8f2d6c1a4e'
+down_revision = '886f03e523c6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'dispatch',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('submission_id', sa.Integer, sa.ForeignKey('submission.id'), nullable=False),
+        sa.Column('external_system', sa.String(255), nullable=False),
+        sa.Column('state', sa.String(20), nullable=False),
+        sa.Column('attempts', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('date_updated', sa.DateTime(timezone=True), nullable=False),
+        sa.UniqueConstraint('submission_id', 'external_system')
+    )
+
+
+def downgrade():
+    op.drop_table('dispatch')
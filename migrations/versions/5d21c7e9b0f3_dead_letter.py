@@ -0,0 +1,42 @@
+# pylint: skip-file
+"""dead letter store for dispatches which ran out of retries
+
+Revision ID: 5d21c7e9b0f3
+Revises: 3b8f2d6c1a4e
+Create Date: 2026-10-19 10:03:54.781290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import func
+
+
+# revision identifiers, used by Alembic.
+revision = '5d21c7e9b0f3'
+down_revision = '3b8f2d6c1a4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'dead_letter',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('submission_id', sa.Integer, sa.ForeignKey('submission.id'), nullable=False),
+        sa.Column('external_system', sa.String(255), nullable=False),
+        sa.Column('error_class', sa.String(255), nullable=False),
+        sa.Column('error', sa.Text),
+        sa.Column('last_status', sa.Integer),
+        sa.Column('last_response', sa.Text),
+        sa.Column('attempts', sa.Integer, nullable=False),
+        sa.Column('date_created', sa.DateTime(timezone=True), server_default=func.now()),
+        sa.Column('date_replayed', sa.DateTime(timezone=True))
+    )
+    # replays scan for rows not yet replayed
+    op.create_index('ix_dead_letter_unreplayed', 'dead_letter', ['id'],
+        postgresql_where=sa.text('date_replayed IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_dead_letter_unreplayed', 'dead_letter')
+    op.drop_table('dead_letter')
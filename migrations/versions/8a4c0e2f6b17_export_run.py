@@ -0,0 +1,42 @@
+# pylint: skip-file
+"""export runs with high water marks and checkpoints for resumable csv exports
+
+Revision ID: 8a4c0e2f6b17
+Revises: 5d21c7e9b0f3
+Create Date: 2026-10-19 11:20:07.115932
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import func
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4c0e2f6b17'
+down_revision = '5d21c7e9b0f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'export_run',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('external_system', sa.String(255), nullable=False),
+        sa.Column('status', sa.String(20), nullable=False),
+        sa.Column('file_path', sa.Text, nullable=False),
+        sa.Column('high_water_mark', sa.Integer, nullable=False),
+        sa.Column('checkpoint_id', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('checkpoint_offset', sa.BigInteger, nullable=False, server_default='0'),
+        sa.Column('rows_written', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('date_started', sa.DateTime(timezone=True), server_default=func.now()),
+        sa.Column('date_finished', sa.DateTime(timezone=True))
+    )
+    # exports walk unprocessed submissions in id order
+    op.create_index('ix_submission_csv_unprocessed', 'submission', ['id'],
+        postgresql_where=sa.text('csv_date_processed IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_submission_csv_unprocessed', 'submission')
+    op.drop_table('export_run')
@@ -0,0 +1,26 @@
+# pylint: skip-file
+"""amendments of archived submissions
+
+Revision ID: a9d5e2c7f4b1
+Revises: f3a6c8e1b9d4
+Create Date: 2026-10-19 15:41:08.512730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d5e2c7f4b1'
+down_revision = 'f3a6c8e1b9d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('submission_archive', sa.Column('amendments', sa.Text, nullable=False,
+        server_default='[]'))
+
+
+def downgrade():
+    op.drop_column('submission_archive', 'amendments')
@@ -0,0 +1,55 @@
+# pylint: skip-file
+"""archive table for finished submissions, range partitioned by year on postgres
+
+submission itself stays unpartitioned: postgres 11 does not allow foreign
+keys referencing a partitioned table, and external_id, dispatch and
+dead_letter all reference submission.  old rows move to the archive instead
+
+Revision ID: c7e1f4a9d2b5
+Revises: 8a4c0e2f6b17
+Create Date: 2026-10-19 15:42:31.608214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import func
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e1f4a9d2b5'
+down_revision = '8a4c0e2f6b17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # partitions are created per year by tasks.archive-submissions
+        op.execute("""
+            CREATE TABLE submission_archive (
+                id integer NOT NULL,
+                date_created timestamp with time zone NOT NULL,
+                data text NOT NULL,
+                csv_date_processed timestamp with time zone,
+                external_ids text NOT NULL,
+                date_archived timestamp with time zone DEFAULT now(),
+                PRIMARY KEY (id, date_created)
+            ) PARTITION BY RANGE (date_created)
+        """)
+    else:
+        op.create_table(
+            'submission_archive',
+            sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+            sa.Column('date_created', sa.DateTime(timezone=True), primary_key=True),
+            sa.Column('data', sa.Text, nullable=False),
+            sa.Column('csv_date_processed', sa.DateTime(timezone=True)),
+            sa.Column('external_ids', sa.Text, nullable=False),
+            sa.Column('date_archived', sa.DateTime(timezone=True), server_default=func.now())
+        )
+    # archival looks for old submissions
+    op.create_index('ix_submission_date_created', 'submission', ['date_created'])
+
+
+def downgrade():
+    op.drop_index('ix_submission_date_created', 'submission')
+    op.drop_table('submission_archive')
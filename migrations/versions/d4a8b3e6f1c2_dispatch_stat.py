@@ -0,0 +1,108 @@
+# pylint: skip-file
+"""dispatch counts per external system and state, kept up to date by triggers
+
+Revision ID: d4a8b3e6f1c2
+Revises: c7e1f4a9d2b5
+Create Date: 2026-10-19 17:08:45.219604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8b3e6f1c2'
+down_revision = 'c7e1f4a9d2b5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect not in ('postgresql', 'sqlite'):
+        # without the triggers the counts would never change
+        raise NotImplementedError("dispatch_stat triggers exist for postgresql and sqlite, not " +
+            dialect)
+    op.create_table(
+        'dispatch_stat',
+        sa.Column('external_system', sa.String(255), primary_key=True),
+        sa.Column('state', sa.String(20), primary_key=True),
+        sa.Column('count', sa.Integer, nullable=False, server_default='0')
+    )
+    op.execute("""
+        INSERT INTO dispatch_stat (external_system, state, count)
+            SELECT external_system, state, COUNT(*) FROM dispatch
+            GROUP BY external_system, state
+    """)
+    if dialect == 'sqlite':
+        sqlite_triggers()
+        return
+    op.execute("""
+        CREATE FUNCTION dispatch_stat_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE dispatch_stat SET count = count - 1
+                    WHERE external_system = OLD.external_system AND state = OLD.state;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO dispatch_stat (external_system, state, count)
+                    VALUES (NEW.external_system, NEW.state, 1)
+                    ON CONFLICT (external_system, state)
+                    DO UPDATE SET count = dispatch_stat.count + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER dispatch_stat_insert_delete AFTER INSERT OR DELETE ON dispatch
+            FOR EACH ROW EXECUTE PROCEDURE dispatch_stat_count()
+    """)
+    op.execute("""
+        CREATE TRIGGER dispatch_stat_update AFTER UPDATE OF state ON dispatch
+            FOR EACH ROW WHEN (OLD.state IS DISTINCT FROM NEW.state)
+            EXECUTE PROCEDURE dispatch_stat_count()
+    """)
+
+
+def sqlite_triggers():
+    op.execute("""
+        CREATE TRIGGER dispatch_stat_insert AFTER INSERT ON dispatch
+        BEGIN
+            INSERT OR IGNORE INTO dispatch_stat (external_system, state, count)
+                VALUES (NEW.external_system, NEW.state, 0);
+            UPDATE dispatch_stat SET count = count + 1
+                WHERE external_system = NEW.external_system AND state = NEW.state;
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dispatch_stat_update AFTER UPDATE OF state ON dispatch
+            WHEN OLD.state != NEW.state
+        BEGIN
+            UPDATE dispatch_stat SET count = count - 1
+                WHERE external_system = OLD.external_system AND state = OLD.state;
+            INSERT OR IGNORE INTO dispatch_stat (external_system, state, count)
+                VALUES (NEW.external_system, NEW.state, 0);
+            UPDATE dispatch_stat SET count = count + 1
+                WHERE external_system = NEW.external_system AND state = NEW.state;
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dispatch_stat_delete AFTER DELETE ON dispatch
+        BEGIN
+            UPDATE dispatch_stat SET count = count - 1
+                WHERE external_system = OLD.external_system AND state = OLD.state;
+        END
+    """)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP TRIGGER dispatch_stat_update ON dispatch")
+        op.execute("DROP TRIGGER dispatch_stat_insert_delete ON dispatch")
+        op.execute("DROP FUNCTION dispatch_stat_count()")
+    else:
+        op.execute("DROP TRIGGER dispatch_stat_delete")
+        op.execute("DROP TRIGGER dispatch_stat_update")
+        op.execute("DROP TRIGGER dispatch_stat_insert")
+    op.drop_table('dispatch_stat')
@@ -0,0 +1,25 @@
+# pylint: skip-file
+"""fencing token of the batch lease which last wrote an export run
+
+Revision ID: e2b9c4d7a1f8
+Revises: d4a8b3e6f1c2
+Create Date: 2026-10-19 19:42:13.508127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b9c4d7a1f8'
+down_revision = 'd4a8b3e6f1c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('export_run', sa.Column('fencing_token', sa.BigInteger))
+
+
+def downgrade():
+    op.drop_column('export_run', 'fencing_token')
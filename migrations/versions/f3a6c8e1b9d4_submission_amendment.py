@@ -0,0 +1,38 @@
+# pylint: skip-file
+"""submission versions and the amendments which made them
+
+Revision ID: f3a6c8e1b9d4
+Revises: e2b9c4d7a1f8
+Create Date: 2026-10-19 20:51:37.264019
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import func
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a6c8e1b9d4'
+down_revision = 'e2b9c4d7a1f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('submission', sa.Column('version', sa.Integer, nullable=False,
+        server_default='0'))
+    op.create_table(
+        'submission_amendment',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('submission_id', sa.Integer, sa.ForeignKey('submission.id'), nullable=False),
+        sa.Column('version', sa.Integer, nullable=False),
+        sa.Column('diff', sa.Text, nullable=False),
+        sa.Column('external_systems', sa.Text, nullable=False),
+        sa.Column('date_created', sa.DateTime(timezone=True), server_default=func.now()),
+        sa.UniqueConstraint('submission_id', 'version')
+    )
+
+
+def downgrade():
+    op.drop_table('submission_amendment')
+    op.drop_column('submission', 'version')
@@ -2,52 +2,100 @@
 import os
 import json
 import jsend
-import sentry_sdk
 import falcon
 from .resources.welcome import Welcome
 from .resources.submission import SubmissionResource
+from .resources.stats import StatsResource
+from .resources.callback import CallbackResource
 from .resources.db_session import create_session
+from .resources.throttle import ThrottleMiddleware, RateLimiter, LoadShedder,\
+        DEFAULT_KEY_RATE, DEFAULT_KEY_BURST
+from .resources.error_reporting import get_reporter
 
 def start_service():
     """Start this service
     set SENTRY_DSN environmental variable to enable logging with Sentry
     """
     # Initialize Sentry
-    sentry_sdk.init(os.environ.get('SENTRY_DSN'))
+    if os.environ.get('SENTRY_DSN'):
+        import sentry_sdk # pylint: disable=import-outside-toplevel
+        sentry_sdk.init(os.environ.get('SENTRY_DSN'))
 
     # Initialize Falcon
-    api = falcon.API(middleware=[SQLAlchemySessionManager(create_session())])
+    api = falcon.API(request_type=SessionRequest, middleware=[
+        ThrottleMiddleware(RateLimiter.from_env(), LoadShedder.from_env(),\
+                RateLimiter.from_env('RATE_LIMIT_KEY', DEFAULT_KEY_RATE, DEFAULT_KEY_BURST),\
+                int(os.environ.get('RATE_LIMIT_PROXIES', 0))),
+        SQLAlchemySessionManager(create_session())
+    ])
     api.req_options.auto_parse_form_urlencoded = True
     api.req_options.strip_url_path_trailing_slash = True
 
     api.add_route('/welcome', Welcome())
-    api.add_route('/submissions', SubmissionResource())
+    submissions = SubmissionResource()
+    api.add_route('/submissions', submissions)
+    api.add_route('/submissions/stats', StatsResource())
+    api.add_route('/submissions/{submission_id:int}', submissions, suffix='item')
+    api.add_route('/callbacks/{external_code}/{submission_id:int}', CallbackResource())
     api.add_sink(default_error, '')
     return api
 
-def default_error(_req, resp):
+def default_error(req, resp):
     """Handle default error"""
     resp.status = falcon.HTTP_404
     msg_error = jsend.error('404 - Not Found')
 
-    sentry_sdk.capture_message(msg_error)
+    reporter = get_reporter()
+    if reporter is not None:
+        # scans of many paths are one event per dedup window, sent in the background
+        reporter.report('404 - Not Found: ' + req.method + ' ' + req.path,\
+                fingerprint='404', level='info')
     resp.body = json.dumps(msg_error)
 
+class SessionContext(falcon.Context):
+    """
+    Request context which opens a db session the first time
+    session is accessed
+    """
+    session_factory = None
+    db_session = None
+
+    @property
+    def session(self):
+        """request scoped db session, created on first access"""
+        if self.db_session is None:
+            self.db_session = self.session_factory() # pylint: disable=not-callable
+        return self.db_session
+
+class SessionRequest(falcon.Request):
+    # pylint: disable=too-few-public-methods
+    """Request carrying a SessionContext"""
+    context_type = SessionContext
+
 class SQLAlchemySessionManager:
     """
-    Create a session for every request and close it when the request ends.
+    Lazily create a session for requests which use the db,
+    then commit or roll it back and close it when the request ends.
     """
 
     def __init__(self, Session):
         self.Session = Session # pylint: disable=invalid-name
 
-    def process_resource(self, req, resp, resource, params):
+    def process_request(self, req, resp):
         # pylint: disable=unused-argument
-        """attach a db session for every resource"""
-        resource.session = self.Session()
+        """let the request context open a session on demand"""
+        req.context.session_factory = self.Session
 
     def process_response(self, req, resp, resource, req_succeeded):
         # pylint: disable=no-self-use, unused-argument
-        """close db session for every resource"""
-        if hasattr(resource, 'session'):
-            resource.session.close()
+        """commit or roll back and close the session, if one was opened"""
+        session = req.context.db_session
+        if session is None:
+            return
+        try:
+            if req_succeeded:
+                session.commit()
+            else:
+                session.rollback()
+        finally:
+            session.close()
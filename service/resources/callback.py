@@ -0,0 +1,105 @@
+"""Callback Endpoint for external systems which acknowledge dispatches later"""
+import json
+import hmac
+import hashlib
+import jsend
+import falcon
+from service.resources.jobs import schedule
+from service.resources.registry import get_registry
+from service.resources.submission_model import Submission, ExternalId, Dispatch, DeadLetter,\
+        set_dispatch_state, record_external_id, DISPATCH_PENDING, DISPATCH_IN_FLIGHT,\
+        DISPATCH_DONE, DISPATCH_FAILED
+from .submission import read_body
+from .validation import max_body_bytes
+
+SIGNATURE_HEADER = 'X-Signature'
+# the callback may beat the worker marking the dispatch pending
+WAITING_STATES = [DISPATCH_PENDING, DISPATCH_IN_FLIGHT]
+
+def sign(secret, body):
+    """signature of a callback body, the hex hmac-sha256 under the system's secret"""
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+class CallbackResource:
+    # pylint: disable=too-few-public-methods
+    """
+        Callbacks from external systems with the result of a dispatch,
+        signed with the secret named by the system's callback_secret_var
+    """
+    uses_db = True
+
+    def on_post(self, req, resp, external_code, submission_id):
+        # pylint: disable=no-self-use, too-many-locals
+        """
+            Handle callback POST requests, a jsend body like the one
+            external systems answer dispatches with.  success records the
+            external id and schedules the dependants, anything else fails
+            the dispatch with a dead letter to replay
+        """
+        registry = get_registry()
+        system = registry.systems.get(external_code)
+        body = read_body(req, max_body_bytes())
+        if system is None or not system.callback_secret or not hmac.compare_digest(\
+                sign(system.callback_secret, body), req.get_header(SIGNATURE_HEADER) or ''):
+            raise falcon.HTTPForbidden(description='Access Denied')
+
+        try:
+            result = json.loads(body.decode('utf-8'))
+            succeeded = result['status'] == 'success'
+            external_id = str(result['data']['id']) if succeeded else None
+        except (ValueError, KeyError, TypeError) as err:
+            resp.body = json.dumps(jsend.error("Invalid callback: {0}".format(err)))
+            resp.status = falcon.HTTP_400
+            return
+
+        db_session = req.context.session
+        submission = db_session.query(Submission).get(submission_id)
+        if submission is None:
+            resp.body = json.dumps(jsend.error('404 - Not Found'))
+            resp.status = falcon.HTTP_404
+            return
+
+        if not succeeded:
+            attempts = db_session.query(Dispatch.attempts)\
+                    .filter(Dispatch.submission_id == submission_id)\
+                    .filter(Dispatch.external_system == external_code).scalar()
+            if set_dispatch_state(db_session, submission_id, external_code, DISPATCH_FAILED,\
+                    from_states=WAITING_STATES):
+                db_session.add(DeadLetter(submission_id=submission_id,\
+                        external_system=external_code,\
+                        error_class='CallbackError',\
+                        error=json.dumps(result.get('message', result.get('data'))),\
+                        last_response=body.decode('utf-8'),\
+                        attempts=attempts))
+                db_session.commit()
+            resp.body = json.dumps(jsend.success({'submission_id': submission_id}))
+            resp.status = falcon.HTTP_200
+            return
+
+        if not set_dispatch_state(db_session, submission_id, external_code, DISPATCH_DONE,\
+                from_states=WAITING_STATES):
+            recorded = db_session.query(ExternalId.external_id)\
+                    .filter(ExternalId.submission_id == submission_id)\
+                    .filter(ExternalId.external_system == external_code)\
+                    .order_by(ExternalId.id.desc()).limit(1).scalar()
+            if recorded is None:
+                resp.body = json.dumps(jsend.error('No dispatch waiting for a callback'))
+                resp.status = falcon.HTTP_409
+                return
+            # a repeated callback
+            external_id, jobs = recorded, None
+        else:
+            record_external_id(db_session, submission_id, external_code, external_id)
+            db_session.commit()
+            print("callback:submission_id - " + str(submission_id) + ":system - " +\
+                    external_code + " external_id saved successfully")
+            jobs = schedule(submission, system.dependants, registry=registry)\
+                    if system.dependants else None
+
+        resp.body = json.dumps(jsend.success({
+            'submission_id': submission_id,
+            'external_id': external_id,
+            'group_id': jobs.id if jobs else None,
+            'job_ids': [job.id for job in jobs] if jobs else []
+        }))
+        resp.status = falcon.HTTP_200
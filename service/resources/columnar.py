@@ -0,0 +1,157 @@
+"""
+    Columnar export of submissions for reporting
+
+    the form data of a batch of submissions is decoded once and turned
+    into typed arrow columns laid out like a csv system's template, then
+    appended to parquet files partitioned by the day submissions were
+    created.  code fields and fields answered from a short list of
+    choices are dictionary encoded.  needs pyarrow, which only the
+    workers running the export import
+"""
+import os
+import json
+import itertools
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from .validation import FIELD_RULES, INTEGER_PATTERN, NUMBER_PATTERN, expand_rules
+
+PARTITION_KEY = 'date'
+# hidden while written, dataset readers skip files starting with a dot
+PARTIAL_PREFIX = '.'
+# text fields answered from a short list of choices
+CATEGORY_FIELDS = ("do_you_own_the_property", "relationship_to_owner", "who_owns_property",\
+        "type_of_construction", "current_unit_type_adu_%#%")
+ARROW_TYPES = {
+    'code': pa.dictionary(pa.int32(), pa.string()),
+    'integer': pa.int64(),
+    'number': pa.float64(),
+    'text': pa.string()
+}
+INT64_RANGE = (-2 ** 63, 2 ** 63 - 1)
+ROW_COLUMNS = [
+    pa.field('adu_id', pa.int64(), nullable=False),
+    pa.field('date_created', pa.timestamp('us', tz='UTC')),
+    pa.field('version', pa.int64())
+]
+
+def export_schema(columns, counts):
+    """
+        arrow schema of an export, the submission's id, creation time and
+        version followed by a field per template column, typed by its rule
+        in FIELD_RULES.  counts are the grouping counts of the mapping
+    """
+    rules = expand_rules(FIELD_RULES, counts)
+    rules.update(expand_rules(dict.fromkeys(CATEGORY_FIELDS, {"type": "code"}), counts))
+    return pa.schema(ROW_COLUMNS + [pa.field(field_id,\
+            ARROW_TYPES[rules.get(field_id, {}).get("type", "text")])\
+            for _, field_id in columns])
+
+def to_array(values, arrow_type):
+    """
+        arrow array of one field's decoded values.  numbers are parsed by
+        arrow from their text in one pass, values which are not numbers
+        become nulls, as do integers out of int64's range.  text keeps
+        strings, other single values are written as json and lists and
+        objects become nulls
+    """
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type):
+        pattern = INTEGER_PATTERN if pa.types.is_integer(arrow_type) else NUMBER_PATTERN
+        text = [str(value) if isinstance(value, (str, int, float)) and\
+                not isinstance(value, bool) and pattern.match(str(value)) else None\
+                for value in values]
+        if pa.types.is_integer(arrow_type):
+            # one value too big for the column would fail the whole cast
+            text = [value if value is None or INT64_RANGE[0] <= int(value) <= INT64_RANGE[1]\
+                    else None for value in text]
+        return pc.cast(pa.array(text, pa.string()), arrow_type)
+    text = pa.array([value if isinstance(value, str) or value is None else\
+            None if isinstance(value, (list, dict)) else json.dumps(value)\
+            for value in values], pa.string())
+    if pa.types.is_dictionary(arrow_type):
+        return text.dictionary_encode()
+    return text
+
+def record_batch(rows, schema):
+    """record batch of (id, date_created, version, data) rows, each row's data decoded once"""
+    decoded = [json.loads(row[3]) for row in rows]
+    arrays = [pa.array([row[index] for row in rows], field.type)\
+            for index, field in enumerate(ROW_COLUMNS)]
+    arrays.extend(to_array([data.get(field.name) for data in decoded], field.type)\
+            for field in list(schema)[len(ROW_COLUMNS):])
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+class PartitionWriter:
+    """
+        appends record batches to parquet files named prefix-<n>.parquet,
+        in a directory per utc day of date_created named date=YYYY-MM-DD.
+        submissions come in id order, which is creation order, so one
+        file is open at a time and a day seen again gets another file.
+        files are written hidden and shown once closed
+    """
+
+    def __init__(self, directory, prefix, schema):
+        self.directory = directory
+        self.prefix = prefix
+        self.schema = schema
+        self.dictionary_columns = [field.name for field in schema\
+                if pa.types.is_dictionary(field.type)]
+        self.writer = None
+        self.day = None
+        self.paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            # an unfinished file stays hidden
+            self.writer.close()
+
+    def write(self, batch):
+        """append a batch, split into runs of rows created on the same day"""
+        days = pc.cast(batch.column('date_created'), pa.date32()).to_pylist()
+        start = 0
+        for day, run in itertools.groupby(days):
+            length = sum(1 for _ in run)
+            self.open(day).write_batch(batch.slice(start, length))
+            start += length
+
+    def open(self, day):
+        """the writer of the file for a day, closing the last day's file"""
+        if day != self.day:
+            self.close()
+            directory = os.path.join(self.directory, PARTITION_KEY + '=' + day.isoformat())
+            os.makedirs(directory, exist_ok=True)
+            self.paths.append(os.path.join(directory,\
+                    self.prefix + '-' + str(len(self.paths)) + '.parquet'))
+            self.writer = pq.ParquetWriter(partial_path(self.paths[-1]), self.schema,\
+                    use_dictionary=self.dictionary_columns)
+            self.day = day
+        return self.writer
+
+    def close(self):
+        """finish the open file and show it"""
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(partial_path(self.paths[-1]), self.paths[-1])
+            self.writer = None
+            self.day = None
+
+def partial_path(path):
+    """path a file is written to before it is complete"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, PARTIAL_PREFIX + name)
+
+def remove_files(directory, prefix):
+    """remove the files of every partition named after prefix, complete or not"""
+    removed = []
+    for partition in os.listdir(directory) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, partition)
+        for name in os.listdir(path) if os.path.isdir(path) else []:
+            if name.startswith((prefix + '-', PARTIAL_PREFIX + prefix + '-')):
+                os.remove(os.path.join(path, name))
+                removed.append(name)
+    return removed
@@ -0,0 +1,218 @@
+"""Streaming delivery of csv exports to ftp servers"""
+import os
+import io
+import zlib
+import ftplib
+import hashlib
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+BLOCK_SIZE = 64 * 1024
+MAX_RECONNECTS = 3
+REMOTE_PARTIAL_SUFFIX = ".partial"
+CHECKSUM_SUFFIX = ".sha256"
+DEFAULT_FTP_PORT = 21
+
+class ExportStream:
+    """
+        writes an export to a local file and, if given, an upload in the
+        same pass, gzip compressing on the fly and computing a sha256
+        checksum of the bytes written.  when compressing every checkpoint
+        closes a gzip member, so the file can be cut back to any checkpoint
+        and continued with new members
+    """
+
+    def __init__(self, local_file, compress=False, upload=None):
+        self.local_file = local_file
+        self.compress = compress
+        self.upload = upload
+        self.checksum = hashlib.sha256()
+        self.compressor = None
+
+    def resume(self, offset):
+        """keep the first offset bytes of the local file and continue after them"""
+        self.local_file.truncate(offset)
+        self.local_file.seek(0)
+        # only an interrupted export reads back what it already wrote
+        remaining = offset
+        while remaining:
+            block = self.local_file.read(min(BLOCK_SIZE, remaining))
+            self.checksum.update(block)
+            remaining -= len(block)
+        self.local_file.seek(offset)
+        if self.upload is not None:
+            self.upload.resume(offset)
+
+    def write(self, data):
+        """add bytes to the export"""
+        if self.compress:
+            if self.compressor is None:
+                self.compressor = zlib.compressobj(wbits=GZIP_WBITS)
+            data = self.compressor.compress(data)
+        self.emit(data)
+
+    def emit(self, data):
+        """pass on bytes as they will appear in the file"""
+        if data:
+            self.local_file.write(data)
+            self.checksum.update(data)
+            if self.upload is not None:
+                self.upload.write(data)
+
+    def checkpoint(self):
+        """make everything written so far durable, returns the local file offset"""
+        if self.compressor is not None:
+            self.emit(self.compressor.flush())
+            self.compressor = None
+        self.local_file.flush()
+        os.fsync(self.local_file.fileno())
+        return self.local_file.tell()
+
+    def close(self):
+        """finish the export and its upload, returns the hex checksum"""
+        self.checkpoint()
+        if self.upload is not None:
+            self.upload.close()
+        return self.checksum.hexdigest()
+
+class FtpUpload:
+    """
+        upload mirroring a local file to a remote file.  data goes to a
+        .partial remote file which is renamed once complete.  after a
+        dropped connection the upload reconnects and sends the missing
+        bytes from the local file
+    """
+
+    def __init__(self, delivery, remote_name, local_file):
+        self.delivery = delivery
+        self.remote_name = remote_name
+        self.partial_name = remote_name + REMOTE_PARTIAL_SUFFIX
+        self.local_file = local_file
+        self.conn = None
+        self.buffer = bytearray()
+        self.position = 0
+
+    def resume(self, offset):
+        """start uploading, the first offset bytes of the local file are final"""
+        self.position = offset
+        self.restart(self.delivery.size(self.partial_name) or 0, offset)
+
+    def restart(self, remote_size, end):
+        """
+            open a data connection continuing the remote file from
+            remote_size and send it the local bytes up to end
+        """
+        if remote_size > end:
+            # remote has bytes the local file dropped, start over
+            remote_size = 0
+        self.conn = self.delivery.connection().transfercmd('STOR ' + self.partial_name,\
+                remote_size or None)
+        self.local_file.flush()
+        while remote_size < end:
+            block = os.pread(self.local_file.fileno(), min(BLOCK_SIZE, end - remote_size),\
+                    remote_size)
+            self.conn.sendall(block)
+            remote_size += len(block)
+
+    def write(self, data):
+        """queue bytes for the remote file"""
+        self.buffer.extend(data)
+        if len(self.buffer) >= BLOCK_SIZE:
+            self.send()
+
+    def send(self):
+        """send buffered bytes, reconnecting if the connection dropped"""
+        end = self.position + len(self.buffer)
+        try:
+            self.conn.sendall(self.buffer)
+        except ftplib.all_errors as err:
+            print("ftp upload of " + self.remote_name + " interrupted:")
+            print("{0}".format(err))
+            self.catch_up(end)
+        self.position = end
+        self.buffer = bytearray()
+
+    def catch_up(self, end):
+        """reconnect and send whatever the remote file is missing up to end"""
+        for attempt in range(MAX_RECONNECTS):
+            try:
+                self.delivery.reconnect()
+                self.restart(self.delivery.size(self.partial_name) or 0, end)
+                return
+            except ftplib.all_errors:
+                if attempt == MAX_RECONNECTS - 1:
+                    raise
+
+    def close(self):
+        """finish the transfer and move the file into place"""
+        self.send()
+        self.conn.close()
+        self.conn = None
+        ftp = self.delivery.connection()
+        ftp.voidresp()
+        ftp.rename(self.partial_name, self.remote_name)
+
+class FtpDelivery:
+    """
+        ftp connection reused for every file delivered to one server
+    """
+
+    def __init__(self, server, username, password, timeout=60):
+        host, _, port = server.partition(':')
+        self.host = host
+        self.port = int(port or DEFAULT_FTP_PORT)
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.ftp = None
+
+    @classmethod
+    def from_system(cls, external_system):
+        """
+            build from the env vars named by an external system's mapping
+            returns None when its ftp server is not set
+        """
+        server = os.environ.get(external_system.get("ftp_server_var", ""))
+        if not server:
+            return None
+        return cls(server,\
+                os.environ.get(external_system.get("ftp_username_var", "")),\
+                os.environ.get(external_system.get("ftp_password_var", "")))
+
+    def connection(self):
+        """logged in ftp connection, opened on first use"""
+        if self.ftp is None:
+            ftp = ftplib.FTP()
+            ftp.connect(self.host, self.port, timeout=self.timeout)
+            ftp.login(self.username or '', self.password or '')
+            ftp.voidcmd('TYPE I')
+            self.ftp = ftp
+        return self.ftp
+
+    def reconnect(self):
+        """drop the connection, the next use opens a new one"""
+        self.close()
+        return self.connection()
+
+    def size(self, remote_name):
+        """size of a remote file, None if it does not exist"""
+        try:
+            return self.connection().size(remote_name)
+        except ftplib.error_perm:
+            return None
+
+    def upload(self, remote_name, local_file):
+        """upload mirroring local_file, see FtpUpload"""
+        return FtpUpload(self, remote_name, local_file)
+
+    def put(self, remote_name, data):
+        """store a small file"""
+        self.connection().storbinary('STOR ' + remote_name, io.BytesIO(data))
+
+    def close(self):
+        """log out, ignoring a connection which is already gone"""
+        if self.ftp is not None:
+            try:
+                self.ftp.quit()
+            except ftplib.all_errors:
+                self.ftp.close()
+            self.ftp = None
@@ -2,8 +2,33 @@
 import os
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+ENGINE = None
+
+def get_engine():
+    """returns the process wide engine, creating it on first use"""
+    global ENGINE # pylint: disable=global-statement
+    if ENGINE is None:
+        ENGINE = sa.create_engine(os.environ.get('DATABASE_URL'), echo=True)
+    return ENGINE
 
 def create_session():
     """creates database session"""
-    db_engine = sa.create_engine(os.environ.get('DATABASE_URL'), echo=True)
-    return sessionmaker(bind=db_engine)
+    return sessionmaker(bind=get_engine())
+
+def pool_usage():
+    """fraction of the connection pool which is checked out"""
+    pool = get_engine().pool
+    if not isinstance(pool, QueuePool):
+        return 0.0
+    # pylint: disable=protected-access
+    return pool.checkedout() / float(pool.size() + max(pool._max_overflow, 0))
+
+def dispose_engine():
+    """
+        drop pooled connections, used after forking so processes
+        never share a connection
+    """
+    if ENGINE is not None:
+        ENGINE.dispose()
@@ -0,0 +1,164 @@
+"""
+    Error reporting off the request thread
+
+    events are sampled and deduplicated by fingerprint when reported,
+    which costs a counter increment under a lock.  the events kept are
+    queued for a background thread which hands them to the transport in
+    batches, a repeated event carries how often it was suppressed
+"""
+import os
+import time
+import queue
+import random
+import atexit
+import threading
+
+DEFAULT_SAMPLE_RATE = 1.0
+DEFAULT_DEDUP_SECONDS = 60.0
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_FLUSH_SECONDS = 2.0
+MAX_QUEUED = 1000
+MAX_FINGERPRINTS = 1000
+COUNTERS = ('reported', 'sampled_out', 'deduplicated', 'dropped', 'sent', 'failed')
+
+REPORTER = None
+
+class ErrorReporter:
+    # pylint: disable=too-many-instance-attributes
+    """
+        reports events to transport, a function taking a list of events,
+        from a background thread.  of the events with the same fingerprint
+        only the first in every dedup_seconds is sent, and only
+        sample_rate of those
+    """
+
+    def __init__(self, transport, sample_rate=DEFAULT_SAMPLE_RATE,\
+            dedup_seconds=DEFAULT_DEDUP_SECONDS, batch_size=DEFAULT_BATCH_SIZE,\
+            flush_seconds=DEFAULT_FLUSH_SECONDS, clock=time.monotonic, rng=random.random):
+        # pylint: disable=too-many-arguments
+        self.transport = transport
+        self.sample_rate = sample_rate
+        self.dedup_seconds = dedup_seconds
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self.rng = rng
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # fingerprint to [end of its dedup window, events suppressed in it], oldest first
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+
+    def report(self, message, fingerprint=None, level='error'):
+        """
+            queue an event unless it is a repeat within its fingerprint's
+            window or sampled out, returns whether it was queued
+        """
+        fingerprint = fingerprint or message
+        now = self.clock()
+        with self.lock:
+            self.counters['reported'] += 1
+            window = self.windows.get(fingerprint)
+            if window is not None and now < window[0]:
+                window[1] += 1
+                self.counters['deduplicated'] += 1
+                return False
+            if self.rng() >= self.sample_rate:
+                self.counters['sampled_out'] += 1
+                return False
+            repeats = self.windows.pop(fingerprint, [0, 0])[1]
+            if len(self.windows) >= MAX_FINGERPRINTS:
+                del self.windows[next(iter(self.windows))]
+            self.windows[fingerprint] = [now + self.dedup_seconds, 0]
+            try:
+                self.start().put_nowait({'message': message, 'fingerprint': fingerprint,\
+                        'level': level, 'repeats': repeats})
+            except queue.Full:
+                self.counters['dropped'] += 1
+                return False
+        return True
+
+    def start(self):
+        """queue of the background thread, started on first use in each process"""
+        if self.pid != os.getpid():
+            # forked workers do not inherit the thread
+            self.pid = os.getpid()
+            self.queue = queue.Queue(MAX_QUEUED)
+            self.thread = threading.Thread(target=self.run, args=(self.queue,),\
+                    name='error-reporter', daemon=True)
+            self.thread.start()
+        return self.queue
+
+    def run(self, events):
+        """hand queued events to the transport, up to batch_size at a time"""
+        while True:
+            batch = [events.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(events.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            self.send([event for event in batch if event is not None])
+            for _ in batch:
+                events.task_done()
+            if stopping:
+                return
+
+    def send(self, batch):
+        """pass a batch to the transport, counting what went out"""
+        if not batch:
+            return
+        try:
+            self.transport(batch)
+            counter = 'sent'
+        except Exception as err: # pylint: disable=broad-except
+            print("error reporting failed:")
+            print("{0}".format(err))
+            counter = 'failed'
+        with self.lock:
+            self.counters[counter] += len(batch)
+
+    def flush(self):
+        """wait until every event queued in this process went to the transport"""
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def close(self, timeout=DEFAULT_FLUSH_SECONDS):
+        """send what is queued and stop the background thread"""
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+def sentry_transport(batch):
+    """capture a batch of events with sentry, which sends them from its own worker"""
+    import sentry_sdk # pylint: disable=import-outside-toplevel
+    for event in batch:
+        with sentry_sdk.push_scope() as scope:
+            scope.fingerprint = [event['fingerprint']]
+            scope.set_extra('repeats', event['repeats'])
+            sentry_sdk.capture_message(event['message'], level=event['level'])
+
+def get_reporter():
+    """the reporter of this process, sending to sentry, None without SENTRY_DSN"""
+    global REPORTER # pylint: disable=global-statement
+    if REPORTER is None and os.environ.get('SENTRY_DSN'):
+        REPORTER = ErrorReporter(sentry_transport,\
+                sample_rate=float(os.environ.get('ERROR_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)),\
+                dedup_seconds=float(os.environ.get('ERROR_DEDUP_SECONDS',\
+                DEFAULT_DEDUP_SECONDS)),\
+                flush_seconds=float(os.environ.get('ERROR_FLUSH_SECONDS',\
+                DEFAULT_FLUSH_SECONDS)))
+        atexit.register(REPORTER.close)
+    return REPORTER
+
+def error_counts():
+    """counters of the events this process reported, empty without a reporter"""
+    reporter = REPORTER
+    if reporter is None:
+        return {}
+    with reporter.lock:
+        return dict(reporter.counters)
@@ -1,5 +1,7 @@
 """Mapping and configuration for external systems"""
 
+GROUP_COUNTER_REPLACEMENT_STRING = "%#%"
+
 MAP = {
     "dbi":{
         "type": "csv",
@@ -135,3 +137,23 @@ MAP = {
     #     }
     # }
 }
+
+def template_columns(template):
+    """
+        (name, id) of every column of a csv template
+        groupings are expanded into count numbered copies of their template
+    """
+    columns = []
+    for item in template:
+        # loop through a group object
+        if "type" in item and item["type"] == "grouping":
+            for i in range(item["count"]): # zero-based
+                for nested_item in item["template"]:
+                    columns.append((\
+                            nested_item["name"].replace(GROUP_COUNTER_REPLACEMENT_STRING,\
+                            str(i+1)),\
+                            nested_item["id"].replace(GROUP_COUNTER_REPLACEMENT_STRING,\
+                            str(i+1))))
+        else:
+            columns.append((item["name"], item["id"]))
+    return columns
@@ -0,0 +1,103 @@
+"""
+    Thin client for queueing background jobs
+
+    jobs are sent to the workers by task name so the web process never
+    imports tasks.py, and celery itself is only imported on first use
+"""
+from .db_session import create_session
+from .submission_model import queue_dispatch, DISPATCH_FAILED, set_dispatch_state
+from .registry import get_registry
+
+CELERY_APP = None
+
+def get_celery():
+    """returns the celery app, importing and configuring it on first use"""
+    global CELERY_APP # pylint: disable=global-statement
+    if CELERY_APP is None:
+        # pylint: disable=import-outside-toplevel
+        import celery
+        from kombu import serialization
+        import celeryconfig
+
+        serialization.register_pickle()
+        serialization.enable_insecure_serializers()
+
+        CELERY_APP = celery.Celery('adu-dispatcher')
+        CELERY_APP.config_from_object(celeryconfig)
+    return CELERY_APP
+
+def schedule(submission_obj, codes=None, db_session=None, countdown=None, registry=None,\
+        amended=()):
+    # pylint: disable=too-many-arguments
+    """
+        queues jobs to send data to external systems, by default the top
+        level systems of the registry, else the systems named in codes
+        systems already queued, in flight or done according to the
+        dispatch ledger are skipped, done ones too unless they are in
+        amended, which are sent the amended data again.  ledger writes are committed on
+        db_session, which must not be the session submission_obj belongs to
+        countdown delays the jobs by that many seconds
+        jobs carry the system code and registry version, not the mapping
+        returns the group of jobs which were scheduled, published
+        together over one broker connection, with no id when empty
+    """
+    # pylint: disable=import-outside-toplevel
+    from celery import group
+    if registry is None:
+        registry = get_registry()
+    if db_session is None:
+        db_session = create_session()()
+        try:
+            return schedule(submission_obj, codes, db_session, countdown, registry, amended)
+        finally:
+            db_session.close()
+
+    jobs = dispatch_jobs(submission_obj, codes, db_session, countdown, registry, amended)
+    if not jobs:
+        # nothing to publish, an empty group without an id
+        return get_celery().GroupResult(None, [])
+    try:
+        return group(jobs, app=get_celery()).apply_async()
+    except Exception:
+        # let a later schedule pick them up again
+        for job in jobs:
+            set_dispatch_state(db_session, submission_obj.id, job.args[0], DISPATCH_FAILED)
+        db_session.commit()
+        raise
+
+def dispatch_jobs(submission_obj, codes, db_session, countdown, registry, amended=()):
+    # pylint: disable=too-many-arguments
+    """
+        dispatch jobs to publish for the systems in codes, or the
+        dependants of those already done, marked queued in the ledger
+    """
+    systems_todo = registry.roots if codes is None else codes
+    systems_done = [external_id.external_system for external_id in submission_obj.external_ids]
+    jobs = []
+
+    for todo in systems_todo:
+        system = registry.systems[todo]
+        if (todo not in systems_done or todo in amended) and system.type == 'api':
+            if not queue_dispatch(db_session, submission_obj.id, todo):
+                print("schedule:submission_id - " + str(submission_obj.id) +\
+                        ":system - " + todo + " already dispatched, skipping")
+                continue
+            print("schedule:submission_id - " + str(submission_obj.id) + ":system - " + todo)
+
+            # determine if send csv or making api call
+            print("scheduling external api call")
+            # data needs to be sent to external system api
+            jobs.append(get_celery().signature('tasks.dispatch',\
+                    args=(todo, registry.version, submission_obj),\
+                    serializer='pickle',\
+                    countdown=countdown,\
+                    retry=True,\
+                    retry_policy={
+                        'max_retries': system.max_retries,
+                        'interval_start': system.retry_interval
+                    }))
+        elif system.dependants:
+            # external system already done, check dependants
+            jobs = jobs + dispatch_jobs(submission_obj, system.dependants, db_session,\
+                    countdown, registry)
+    return jobs
@@ -0,0 +1,130 @@
+"""
+    Leases keeping a batch task to one worker at a time
+
+    a lease is a redis key naming its owner which expires unless renewed,
+    taken, renewed and released in WATCH/MULTI transactions.  taking a
+    lease also hands out the next fencing token for its name, so writes
+    stamped with a token can be refused once a later holder has written
+"""
+import os
+import time
+import uuid
+import functools
+
+DEFAULT_LEASE_SECONDS = 300
+LEASE_PREFIX = 'lease:'
+FENCE_PREFIX = 'fence:'
+
+CLIENT = None
+
+class LeaseLost(Exception):
+    """the lease expired or was taken over by another worker"""
+
+def lease_seconds():
+    """seconds a lease lasts without renewal, from BATCH_LEASE_SECONDS"""
+    return float(os.environ.get('BATCH_LEASE_SECONDS', DEFAULT_LEASE_SECONDS))
+
+def get_client():
+    """redis client for REDIS_URL, None when the broker is not redis"""
+    global CLIENT # pylint: disable=global-statement
+    url = os.environ.get('REDIS_URL', '')
+    if CLIENT is None and url.startswith(('redis://', 'rediss://')):
+        # pylint: disable=import-outside-toplevel
+        import redis
+        CLIENT = redis.Redis.from_url(url)
+    return CLIENT
+
+class Lease:
+    """
+        lease on a name held by this process.  without a redis broker
+        there is only one worker, and the lease is always granted
+    """
+
+    def __init__(self, name, client=None, seconds=None):
+        self.name = name
+        self.key = LEASE_PREFIX + name
+        self.client = client if client is not None else get_client()
+        self.seconds = seconds or lease_seconds()
+        self.owner = uuid.uuid4().hex.encode('ascii')
+        self.token = None
+        self.renewed = None
+
+    def acquire(self):
+        """take the lease unless another worker holds it, returns whether it was taken"""
+        if self.client is None:
+            return True
+        # pylint: disable=import-outside-toplevel
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.exists(self.key):
+                    return False
+                pipe.multi()
+                pipe.incr(FENCE_PREFIX + self.name)
+                pipe.set(self.key, self.owner, px=int(self.seconds * 1000))
+                self.token = pipe.execute()[0]
+            except WatchError:
+                # taken while this worker looked
+                return False
+        self.renewed = time.monotonic()
+        return True
+
+    def renew(self):
+        """extend the lease, raises LeaseLost when it is no longer held"""
+        if self.client is None:
+            return
+        # pylint: disable=import-outside-toplevel
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) != self.owner:
+                    raise LeaseLost(self.name + " lease with token " + str(self.token) + " lost")
+                pipe.multi()
+                pipe.pexpire(self.key, int(self.seconds * 1000))
+                pipe.execute()
+            except WatchError as exc:
+                raise LeaseLost(self.name + " lease with token " + str(self.token) +\
+                        " taken over") from exc
+        self.renewed = time.monotonic()
+
+    def heartbeat(self):
+        """renew once a third of the lease has gone by, cheap enough to call per row"""
+        if self.renewed is not None and time.monotonic() - self.renewed >= self.seconds / 3:
+            self.renew()
+
+    def release(self):
+        """give the lease up if it is still held"""
+        if self.client is None:
+            return
+        # pylint: disable=import-outside-toplevel
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) == self.owner:
+                    pipe.multi()
+                    pipe.delete(self.key)
+                    pipe.execute()
+            except WatchError:
+                # expired and taken over, nothing left to give up
+                pass
+
+def singleton(task):
+    """
+        runs a bound task only while holding a lease on its name, a run
+        started while another worker holds it is skipped.  the task gets
+        the lease as its lease argument, to renew during long runs
+    """
+    @functools.wraps(task)
+    def run(self, *args, **kwargs):
+        lease = Lease(self.name)
+        if not lease.acquire():
+            print(self.name + " skipped, another worker holds its lease")
+            return None
+        try:
+            return task(self, *args, lease=lease, **kwargs)
+        finally:
+            lease.release()
+    return run
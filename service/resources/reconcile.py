@@ -0,0 +1,179 @@
+"""
+    Reconciliation of an inbound csv against the submissions exported
+
+    both sides are walked once in id order.  exported ids come from the
+    database in chunks, inbound ids go through an external sort which
+    holds at most a buffer of ids in memory and spills sorted runs to
+    temporary files, so memory stays flat however long the file is
+"""
+import os
+import csv
+import gzip
+import heapq
+import itertools
+import tempfile
+
+DEFAULT_SORT_BUFFER = 200000 # inbound ids held in memory while sorting
+MAX_MERGE_FANIN = 64 # sorted runs read at once
+ID_COLUMN = 'adu_id'
+REPORTS = ('missing', 'duplicate', 'mismatched', 'reexport')
+
+def sort_buffer():
+    """inbound ids sorted in memory before spilling, from RECONCILE_SORT_BUFFER"""
+    return int(os.environ.get('RECONCILE_SORT_BUFFER', DEFAULT_SORT_BUFFER))
+
+def open_inbound(path):
+    """text stream of an inbound file, gunzipped when it ends in .gz"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='', encoding='utf-8')
+    return open(path, newline='', encoding='utf-8')
+
+def inbound_ids(rows, invalid):
+    """
+        adu ids of the rows of a pipe delimited file with a header,
+        values which are not ids are passed to invalid
+    """
+    header = next(rows, None)
+    if header is None:
+        return
+    if ID_COLUMN not in header:
+        raise ValueError("inbound file has no " + ID_COLUMN + " column")
+    index = header.index(ID_COLUMN)
+    for row in rows:
+        if not row:
+            continue
+        value = row[index].strip() if len(row) > index else ''
+        try:
+            yield int(value)
+        except ValueError:
+            invalid(value)
+
+def read_run(path):
+    """ids of a sorted run file"""
+    with open(path) as run_file:
+        for line in run_file:
+            yield int(line)
+
+class ExternalSort:
+    """
+        sorts ids holding at most buffer_size of them in memory, the rest
+        is spilled to sorted runs in a temporary directory and merged
+        back, no more than fanin runs at a time
+    """
+
+    def __init__(self, buffer_size=None, fanin=MAX_MERGE_FANIN):
+        self.buffer_size = buffer_size or sort_buffer()
+        self.fanin = fanin
+        self.buffer = []
+        self.runs = []
+        self.directory = None
+        self.names = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, values):
+        """add ids to be sorted"""
+        for value in values:
+            self.buffer.append(value)
+            if len(self.buffer) >= self.buffer_size:
+                self.spill()
+
+    def spill(self):
+        """write the buffer out as a sorted run"""
+        self.buffer.sort()
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer = []
+
+    def write_run(self, values):
+        """write sorted ids to a new run file and return its path"""
+        if self.directory is None:
+            self.directory = tempfile.TemporaryDirectory(prefix='reconcile-')
+        path = os.path.join(self.directory.name, str(next(self.names)))
+        with open(path, 'w') as run_file:
+            run_file.writelines(str(value) + '\n' for value in values)
+        return path
+
+    def sorted(self):
+        """every id added, in order"""
+        if not self.runs:
+            # everything fit in the buffer
+            self.buffer.sort()
+            return iter(self.buffer)
+        if self.buffer:
+            self.spill()
+        while len(self.runs) > self.fanin:
+            runs, self.runs = self.runs[:self.fanin], self.runs[self.fanin:]
+            self.runs.append(self.write_run(heapq.merge(*[read_run(run) for run in runs])))
+            for run in runs:
+                os.remove(run)
+        return heapq.merge(*[read_run(run) for run in self.runs])
+
+    def close(self):
+        """remove the run files"""
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+
+def merge(inbound, exported):
+    """
+        sort-merge join of inbound ids, in order, with (id, date exported)
+        of the exported submissions, in id order.  yields (report, id,
+        detail) for exported ids missing from inbound with their export
+        date, inbound ids which were never exported and inbound ids found
+        more than once with their count
+    """
+    exported = iter(exported)
+    current = next(exported, None)
+    for adu_id, group in itertools.groupby(inbound):
+        while current is not None and current[0] < adu_id:
+            yield 'missing', current[0], current[1]
+            current = next(exported, None)
+        if current is not None and current[0] == adu_id:
+            current = next(exported, None)
+        else:
+            yield 'mismatched', adu_id, None
+        count = sum(1 for _ in group)
+        if count > 1:
+            yield 'duplicate', adu_id, count
+    while current is not None:
+        yield 'missing', current[0], current[1]
+        current = next(exported, None)
+
+def reconcile(inbound_path, exported, report_paths, exported_before, reexport_before,\
+        buffer_size=None):
+    # pylint: disable=too-many-arguments, too-many-locals
+    """
+        writes a pipe delimited report per kind in REPORTS to report_paths
+        and returns the number of ids in each.  exported ids are only
+        missing if they were exported before exported_before, and are
+        re-export candidates if that was before reexport_before
+    """
+    counts = dict.fromkeys(REPORTS, 0)
+    reports = {}
+    try:
+        for report, header in zip(REPORTS, ('|exported', '|count', '', '|exported')):
+            reports[report] = open(report_paths[report], 'w')
+            reports[report].write(ID_COLUMN + header + '\n')
+
+        def write(report, *values):
+            counts[report] += 1
+            reports[report].write('|'.join(str(value) for value in values) + '\n')
+
+        with ExternalSort(buffer_size) as inbound, open_inbound(inbound_path) as inbound_file:
+            inbound.add(inbound_ids(csv.reader(inbound_file, delimiter='|'),\
+                    lambda value: write('mismatched', value)))
+            for report, adu_id, detail in merge(inbound.sorted(), exported):
+                if report != 'missing':
+                    write(report, *([adu_id] if detail is None else [adu_id, detail]))
+                elif detail < exported_before:
+                    write(report, adu_id, detail.isoformat())
+                    if detail < reexport_before:
+                        write('reexport', adu_id, detail.isoformat())
+    finally:
+        for report_file in reports.values():
+            report_file.close()
+    return counts
@@ -0,0 +1,169 @@
+"""
+    Registry of the external systems submissions are sent to
+
+    the mapping is read from the versioned json file named by
+    EXTERNAL_SYSTEMS_CONFIG, falling back to MAP when it is not set, then
+    validated and compiled once.  every process polls the file's mtime
+    and swaps in the new registry when it changes
+"""
+import os
+import json
+import time
+import threading
+from .external_systems import MAP, template_columns
+from .validation import Validator
+
+CONFIG_ENV = 'EXTERNAL_SYSTEMS_CONFIG'
+DEFAULT_RELOAD_SECONDS = 5.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_INTERVAL = 0
+SYSTEM_TYPES = ('api', 'csv')
+
+REGISTRY = None
+LOCK = threading.Lock()
+
+class RegistryError(ValueError):
+    """the external systems mapping is invalid"""
+
+class ExternalSystem:
+    # pylint: disable=too-many-instance-attributes, too-few-public-methods
+    """one external system of a registry, compiled from its mapping"""
+
+    def __init__(self, code, config, parent=None):
+        if not isinstance(config, dict) or config.get('type') not in SYSTEM_TYPES:
+            raise RegistryError(code + ": type must be one of " + ", ".join(SYSTEM_TYPES))
+        self.code = code
+        self.config = config
+        self.type = config['type']
+        self.parent = parent
+        self.dependants = list(config.get('dependants', {}))
+        self.template = config.get('template')
+        self.max_retries = config.get('max_retries', DEFAULT_MAX_RETRIES)
+        self.retry_interval = config.get('timeout', DEFAULT_RETRY_INTERVAL)
+        self.url = None
+        # systems with a callback secret acknowledge dispatches through the callback route
+        self.callback_secret = None
+        self.columns = None
+        # ids of the form fields the template reads, groupings expanded
+        self.fields = set()
+        self.compress = bool(config.get('compress', False))
+        if self.type == 'api':
+            if 'env_var' not in config:
+                raise RegistryError(code + ": env_var required in mapping for external api calls")
+            if not isinstance(self.template, dict):
+                raise RegistryError(code + ": api template must be an object")
+            # payload templates map payload keys to form field ids
+            self.fields = {value for value in self.template.values() if value}
+            # env vars do not change while the process runs
+            self.url = os.environ.get(config['env_var'])
+            if 'callback_secret_var' in config:
+                self.callback_secret = os.environ.get(config['callback_secret_var'])
+        else:
+            if 'callback_secret_var' in config:
+                raise RegistryError(code + ": only api systems can call back")
+            if not isinstance(self.template, list):
+                raise RegistryError(code + ": csv template must be a list")
+            self.columns = template_columns(self.template)
+            self.fields = {field_id for _, field_id in self.columns}
+
+class Registry:
+    # pylint: disable=too-many-instance-attributes
+    """
+        external systems compiled from a mapping shaped like MAP.  systems
+        are kept in dependency order, every system after the one it
+        depends on, and are looked up by code
+    """
+
+    def __init__(self, mapping, version=0, source=None, mtime=None):
+        # pylint: disable=too-many-arguments
+        self.mapping = mapping
+        self.version = version
+        self.source = source
+        self.mtime = mtime
+        self.checked = time.monotonic()
+        self.roots = list(mapping)
+        self.systems = {}
+        level = [(code, config, None) for code, config in mapping.items()]
+        while level:
+            next_level = []
+            for code, config, parent in level:
+                if code in self.systems:
+                    raise RegistryError(code + ": external system codes must be unique")
+                self.systems[code] = ExternalSystem(code, config, parent)
+                next_level.extend((dependant, dependant_config, code) for dependant,\
+                        dependant_config in config.get('dependants', {}).items())
+            level = next_level
+        # form field id to the codes of the systems reading it, for amendments
+        self.field_systems = {}
+        for code, system in self.systems.items():
+            for field_id in system.fields:
+                self.field_systems.setdefault(field_id, []).append(code)
+        self.validator = Validator(mapping)
+
+    @classmethod
+    def load(cls, path):
+        """compile the registry in a json config file of version and systems"""
+        mtime = os.stat(path).st_mtime
+        with open(path) as config_file:
+            config = json.load(config_file)
+        if not isinstance(config.get('version'), int) or\
+                not isinstance(config.get('systems'), dict):
+            raise RegistryError(path + ": version (an integer) and systems are required")
+        return cls(config['systems'], config['version'], path, mtime)
+
+    def reading(self, field_ids):
+        """codes of the systems reading any of the form fields, in dependency order"""
+        codes = set()
+        for field_id in field_ids:
+            codes.update(self.field_systems.get(field_id, ()))
+        return [code for code in self.systems if code in codes]
+
+    def of_type(self, system_type):
+        """systems of a type keyed by code, in dependency order"""
+        return {code: system for code, system in self.systems.items()\
+                if system.type == system_type}
+
+def reload_seconds():
+    """seconds between checks of the config file, from REGISTRY_RELOAD_SECONDS"""
+    return float(os.environ.get('REGISTRY_RELOAD_SECONDS', DEFAULT_RELOAD_SECONDS))
+
+def get_registry(refresh=False):
+    """
+        the current registry, compiled on first use and recompiled when
+        the config file changed.  the file is checked at most every
+        REGISTRY_RELOAD_SECONDS unless refresh is set
+    """
+    registry = REGISTRY
+    if registry is not None and not refresh and\
+            time.monotonic() - registry.checked < reload_seconds():
+        return registry
+    with LOCK:
+        return swap(refresh)
+
+def swap(refresh):
+    """replace the registry if its source changed, callers hold LOCK"""
+    global REGISTRY # pylint: disable=global-statement
+    current = REGISTRY
+    if current is not None and not refresh and\
+            time.monotonic() - current.checked < reload_seconds():
+        # another thread reloaded it while this one waited
+        return current
+    path = os.environ.get(CONFIG_ENV)
+    try:
+        if not path:
+            if current is None or current.source is not None:
+                current = Registry(MAP)
+        elif current is None or current.source != path or\
+                current.mtime != os.stat(path).st_mtime:
+            current = Registry.load(path)
+            print("external systems registry version " + str(current.version) +\
+                    " loaded from " + path)
+    except (OSError, ValueError) as err:
+        # keep what works, or fall back to MAP, rather than failing every job
+        print("external systems registry not loaded from " + str(path) + ":")
+        print("{0}".format(err))
+        if current is None:
+            current = Registry(MAP)
+    current.checked = time.monotonic()
+    REGISTRY = current
+    return current
@@ -0,0 +1,49 @@
+"""Dispatch statistics endpoint"""
+import os
+import json
+import time
+import threading
+import jsend
+import falcon
+from service.resources.submission_model import DispatchStat
+from .error_reporting import error_counts
+from .hooks import validate_access
+
+DEFAULT_CACHE_SECONDS = 5.0
+
+@falcon.before(validate_access)
+class StatsResource:
+    # pylint: disable=too-few-public-methods
+    """
+        Number of dispatches per external system and state.  counts come
+        from dispatch_stat, which triggers keep current, and are cached for
+        STATS_CACHE_SECONDS so dashboards polling at any rate cost at most
+        one small query per process per interval
+    """
+
+    def __init__(self, cache_seconds=None, clock=time.monotonic):
+        self.cache_seconds = float(os.environ.get('STATS_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))\
+                if cache_seconds is None else cache_seconds
+        self.clock = clock
+        self.cached = None
+        self.fetched = None
+        self.lock = threading.Lock()
+
+    def on_get(self, req, resp):
+        """Handle stats GET requests"""
+        with self.lock:
+            now = self.clock()
+            if self.fetched is None or now - self.fetched >= self.cache_seconds:
+                self.cached = dispatch_counts(req.context.session)
+                self.fetched = now
+            counts = self.cached
+        # error reports are counted per process and never cached
+        resp.body = json.dumps(jsend.success({'dispatches': counts, 'errors': error_counts()}))
+        resp.status = falcon.HTTP_200
+
+def dispatch_counts(db_session):
+    """{external_system: {state: count}} of dispatches"""
+    counts = {}
+    for stat in db_session.query(DispatchStat).filter(DispatchStat.count > 0):
+        counts.setdefault(stat.external_system, {})[stat.state] = stat.count
+    return counts
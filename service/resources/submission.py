@@ -2,45 +2,141 @@
 
 # import sys, traceback
 import json
+from datetime import datetime
 import jsend
 import falcon
-import tasks
-from service.resources.external_systems import MAP
-from service.resources.submission_model import create_submission
+from service.resources.jobs import schedule
+from service.resources.registry import get_registry
+from service.resources.submission_model import Submission, SubmissionArchive, ExternalId,\
+        Dispatch, create_submission, amend_submission, unsettled_dispatches
 from .hooks import validate_access
+from .validation import max_body_bytes, ValidationError
 
 # from pprint import pprint
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 @falcon.before(validate_access)
 class SubmissionResource:
-    # pylint: disable=too-few-public-methods
     """Integrate Submission Data Object to Falcon Framework """
+    uses_db = True
+
+    def on_get(self, req, resp):
+        # pylint: disable=no-self-use
+        """
+            Handle Submission list GET requests
+            pages through submissions created at or after since, in id
+            order, starting after the id given as after
+        """
+        try:
+            since = req.get_param('since')
+            since = datetime.fromisoformat(since) if since else None
+            after = req.get_param_as_int('after', min_value=0) or 0
+            limit = req.get_param_as_int('limit', min_value=1, max_value=MAX_PAGE_SIZE)\
+                    or DEFAULT_PAGE_SIZE
+        except (ValueError, falcon.HTTPBadRequest) as err:
+            resp.body = json.dumps(jsend.error("Invalid paging parameters: {0}".format(\
+                    getattr(err, 'description', err))))
+            resp.status = falcon.HTTP_400
+            return
+
+        db_session = req.context.session
+        # only the columns listed, the form data stays in the table
+        query = db_session.query(Submission.id, Submission.date_created,\
+                Submission.csv_date_processed).filter(Submission.id > after)
+        if since is not None:
+            query = query.filter(Submission.date_created >= since)
+        page = query.order_by(Submission.id).limit(limit).all()
+        external_ids = submission_external_ids(db_session, [row.id for row in page])
+
+        resp.body = json.dumps(jsend.success({
+            'submissions': [{
+                'submission_id': row.id,
+                'date_created': isoformat(row.date_created),
+                'csv_date_processed': isoformat(row.csv_date_processed),
+                'external_ids': external_ids.get(row.id, {})
+            } for row in page],
+            'next_after': page[-1].id if len(page) == limit else None
+        }))
+        resp.status = falcon.HTTP_200
+
+    def on_get_item(self, req, resp, submission_id):
+        # pylint: disable=no-self-use
+        """Handle Submission GET requests, with the systems still to be reached"""
+        db_session = req.context.session
+        submission = db_session.query(Submission).get(submission_id)
+        if submission is not None:
+            external_ids = submission_external_ids(db_session, [submission_id])\
+                    .get(submission_id, {})
+            dispatches = dict(db_session.query(Dispatch.external_system, Dispatch.state)\
+                    .filter(Dispatch.submission_id == submission_id))
+            registry = get_registry()
+            pending = [code for code in registry.of_type('api') if code not in external_ids]
+            if submission.csv_date_processed is None:
+                pending.extend(registry.of_type('csv'))
+            archived = False
+        else:
+            submission = db_session.query(SubmissionArchive)\
+                    .filter(SubmissionArchive.id == submission_id).first()
+            if submission is None:
+                resp.body = json.dumps(jsend.error('404 - Not Found'))
+                resp.status = falcon.HTTP_404
+                return
+            # only finished submissions are archived
+            external_ids = json.loads(submission.external_ids)
+            dispatches = {}
+            pending = []
+            archived = True
+
+        resp.body = json.dumps(jsend.success({
+            'submission_id': submission.id,
+            'date_created': isoformat(submission.date_created),
+            'csv_date_processed': isoformat(submission.csv_date_processed),
+            'external_ids': external_ids,
+            'dispatches': dispatches,
+            'pending_systems': sorted(pending),
+            'archived': archived,
+            'data': json.loads(submission.data)
+        }))
+        resp.status = falcon.HTTP_200
 
     def on_post(self, req, resp):
         """Handle Submission POST requests"""
+        body = read_body(req, max_body_bytes())
+        try:
+            json_params = json.loads(body.decode('utf-8'))
+        except ValueError as err:
+            resp.body = json.dumps(jsend.error("Invalid submission: {0}".format(err)))
+            resp.status = falcon.HTTP_400
+            return
         submission = None
         try:
-            json_params = req.media
-            validate(json_params)
+            registry = get_registry()
+            registry.validator(json_params)
             # log submission to database
-            submission = create_submission(self.session, json_params) # pylint: disable=no-member
+            submission = create_submission(req.context.session, json_params)
             # schedule dispatch to external systems
-            jobs_scheduled = tasks.schedule(submission_obj=submission,\
-                systems_dict=MAP)
+            jobs_scheduled = schedule(submission_obj=submission, registry=registry)
 
             # return adu dispatcher id
             resp.body = json.dumps(jsend.success({
                 'submission_id': submission.id,
+                'group_id': jobs_scheduled.id,
                 'job_ids': [job.id for job in jobs_scheduled],
-                'params': json.dumps(req.media)
+                'params': json.dumps(json_params)
             }))
             resp.status = falcon.HTTP_200
+        except ValidationError as err:
+            # nothing was stored yet
+            resp.body = json.dumps(jsend.error("{0}".format(err), data={'errors': err.errors}))
+            resp.status = falcon.HTTP_400
         except Exception as err: # pylint: disable=broad-except
             if (submission is not None
                     and hasattr(submission, 'id')
                     and isinstance(submission.id, int)):
-                self.session.delete(submission) # pylint: disable=no-member
-                self.session.commit() # pylint: disable=no-member
+                req.context.session.delete(submission)
+                req.context.session.commit()
             # print("caught error in submission on_post")
             # print("traceback:")
             # traceback.print_exc(file=sys.stdout)
@@ -49,8 +145,111 @@ class SubmissionResource:
             resp.body = json.dumps(jsend.error("{0}".format(err)))
             resp.status = falcon.HTTP_500
 
-def validate(json_data):
-    '''enforce validation rules'''
-    if "block" not in json_data or not json_data["block"] or\
-                "lot" not in json_data or not json_data["lot"]:
-        raise Exception("Block and lot are required fields")
+    def on_patch_item(self, req, resp, submission_id):
+        # pylint: disable=no-self-use, too-many-locals
+        """
+            Handle Submission PATCH requests, a json merge patch of the form
+            data in which null removes a field.  the change is kept as the
+            next version of the submission, and only the external systems
+            whose templates read a changed field receive it again
+        """
+        body = read_body(req, max_body_bytes())
+        try:
+            changes = json.loads(body.decode('utf-8'))
+            if not isinstance(changes, dict):
+                raise ValueError("must be a json object")
+        except ValueError as err:
+            resp.body = json.dumps(jsend.error("Invalid amendment: {0}".format(err)))
+            resp.status = falcon.HTTP_400
+            return
+
+        db_session = req.context.session
+        submission = db_session.query(Submission).get(submission_id)
+        if submission is None:
+            if db_session.query(SubmissionArchive.id)\
+                    .filter(SubmissionArchive.id == submission_id).count():
+                resp.body = json.dumps(jsend.error('Archived submissions cannot be amended'))
+                resp.status = falcon.HTTP_409
+            else:
+                resp.body = json.dumps(jsend.error('404 - Not Found'))
+                resp.status = falcon.HTTP_404
+            return
+
+        data = json.loads(submission.data)
+        diff = {}
+        for field_id, value in changes.items():
+            if data.get(field_id) != value:
+                diff[field_id] = [data.get(field_id), value]
+            if value is None:
+                data.pop(field_id, None)
+            else:
+                data[field_id] = value
+        registry = get_registry()
+        try:
+            registry.validator(data)
+        except ValidationError as err:
+            resp.body = json.dumps(jsend.error("{0}".format(err), data={'errors': err.errors}))
+            resp.status = falcon.HTTP_400
+            return
+
+        unsettled = unsettled_dispatches(db_session, submission_id) if diff else []
+        if unsettled:
+            # queued jobs carry the data they were queued with
+            resp.body = json.dumps(jsend.error('Dispatch to ' + ', '.join(sorted(unsettled)) +\
+                    ' still in progress, amend the submission once it finished'))
+            resp.status = falcon.HTTP_409
+            return
+
+        affected = registry.reading(diff)
+        done = {external_id.external_system for external_id in submission.external_ids}
+        api_systems = registry.of_type('api')
+        # systems not reached yet get the amended data when their turn comes
+        resend = [code for code in affected if code in api_systems and code in done]
+        reexport = submission.csv_date_processed is not None and\
+                any(code in registry.of_type('csv') for code in affected)
+        if diff and not amend_submission(db_session, submission, data, diff, resend, reexport):
+            resp.body = json.dumps(jsend.error('Submission was amended at the same time, '\
+                    'try again'))
+            resp.status = falcon.HTTP_409
+            return
+        jobs = schedule(submission, resend, registry=registry, amended=resend)\
+                if resend else None
+
+        resp.body = json.dumps(jsend.success({
+            'submission_id': submission.id,
+            'version': submission.version,
+            'changed': sorted(diff),
+            'external_systems': affected,
+            'reexport': reexport,
+            'group_id': jobs.id if jobs else None,
+            'job_ids': [job.id for job in jobs] if jobs else []
+        }))
+        resp.status = falcon.HTTP_200
+
+def read_body(req, limit):
+    """
+        request body, rejected with a 413 once it is over limit bytes,
+        before reading it if the client sent a content length
+    """
+    if req.content_length is not None and req.content_length > limit:
+        raise falcon.HTTPPayloadTooLarge(description='Submission is over ' + str(limit) + ' bytes')
+    body = req.bounded_stream.read(limit + 1)
+    if len(body) > limit:
+        raise falcon.HTTPPayloadTooLarge(description='Submission is over ' + str(limit) + ' bytes')
+    return body
+
+def submission_external_ids(db_session, submission_ids):
+    """external ids of submissions as {submission_id: {external_system: external_id}}"""
+    external_ids = {}
+    if submission_ids:
+        # the newest wins where ids were recorded twice
+        for row in db_session.query(ExternalId.submission_id, ExternalId.external_system,\
+                ExternalId.external_id).filter(ExternalId.submission_id.in_(submission_ids))\
+                .order_by(ExternalId.id):
+            external_ids.setdefault(row.submission_id, {})[row.external_system] =\
+                    row.external_id
+    return external_ids
+
+def isoformat(value):
+    """iso 8601 string of a datetime, None stays None"""
+    return value.isoformat() if value is not None else None
@@ -1,13 +1,25 @@
 """Submission Data Model"""
 
 import json
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy as sa
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
+from sqlalchemy.exc import IntegrityError
 
 BASE = declarative_base()
 
+DISPATCH_QUEUED = 'queued'
+DISPATCH_IN_FLIGHT = 'in-flight'
+DISPATCH_DONE = 'done'
+DISPATCH_FAILED = 'failed'
+# posted to a system which calls back with its id later
+DISPATCH_PENDING = 'pending'
+
+EXPORT_RUNNING = 'running'
+EXPORT_DONE = 'done'
+
 class Submission(BASE):
     # pylint: disable=too-few-public-methods
     """Map Submission object to db"""
@@ -17,16 +29,19 @@ class Submission(BASE):
     data = sa.Column('data', sa.Text, nullable=False)
     date_created = sa.Column('date_created', sa.DateTime(timezone=True), server_default=func.now())
     csv_date_processed = sa.Column('csv_date_processed', sa.DateTime(timezone=True))
+    # number of amendments made to data
+    version = sa.Column('version', sa.Integer, nullable=False, default=0, server_default='0')
     external_ids = relationship("ExternalId")
+    dispatches = relationship("Dispatch", cascade="all, delete-orphan")
+    dead_letters = relationship("DeadLetter", cascade="all, delete-orphan")
 
     dispatch_count = {}
 
     def create_external_id(self, db_session, external_system, external_id):
         '''helper function for creating an external id'''
-        external_id_obj = ExternalId(submission_id=self.id,\
-                external_system=external_system,\
-                external_id=external_id)
-        db_session.add(external_id_obj)
+        external_id_obj = record_external_id(db_session, self.id, external_system, external_id)
+        # record the id and close out the dispatch in one transaction
+        set_dispatch_state(db_session, self.id, external_system, DISPATCH_DONE)
         db_session.commit()
         return external_id_obj
 
@@ -41,9 +56,431 @@ class ExternalId(BASE):
     external_system = sa.Column('external_system', sa.VARCHAR(length=255), nullable=False)
     date_created = sa.Column('date_created', sa.DateTime(timezone=True), server_default=func.now())
 
+class SubmissionAmendment(BASE):
+    # pylint: disable=too-few-public-methods
+    """Map SubmissionAmendment object to db, the change which made a version of a submission"""
+
+    __tablename__ = 'submission_amendment'
+    __table_args__ = (sa.UniqueConstraint('submission_id', 'version'),)
+    id = sa.Column('id', sa.Integer, primary_key=True)
+    submission_id = sa.Column('submission_id', sa.Integer, sa.ForeignKey('submission.id'),\
+            nullable=False)
+    version = sa.Column('version', sa.Integer, nullable=False)
+    # json object of field id to [old value, new value], null when absent
+    diff = sa.Column('diff', sa.Text, nullable=False)
+    # json list of the external systems the change was sent to again
+    external_systems = sa.Column('external_systems', sa.Text, nullable=False)
+    date_created = sa.Column('date_created', sa.DateTime(timezone=True), server_default=func.now())
+
+class Dispatch(BASE):
+    # pylint: disable=too-few-public-methods
+    """Map Dispatch ledger entry to db, one per submission and external system"""
+
+    __tablename__ = 'dispatch'
+    __table_args__ = (sa.UniqueConstraint('submission_id', 'external_system'),)
+    id = sa.Column('id', sa.Integer, primary_key=True)
+    submission_id = sa.Column('submission_id', sa.Integer, sa.ForeignKey('submission.id'),\
+            nullable=False)
+    external_system = sa.Column('external_system', sa.VARCHAR(length=255), nullable=False)
+    state = sa.Column('state', sa.VARCHAR(length=20), nullable=False)
+    attempts = sa.Column('attempts', sa.Integer, nullable=False, default=0)
+    date_updated = sa.Column('date_updated', sa.DateTime(timezone=True), nullable=False)
+
+class DeadLetter(BASE):
+    # pylint: disable=too-few-public-methods
+    """Map DeadLetter object to db, a dispatch which ran out of retries"""
+
+    __tablename__ = 'dead_letter'
+    id = sa.Column('id', sa.Integer, primary_key=True)
+    submission_id = sa.Column('submission_id', sa.Integer, sa.ForeignKey('submission.id'),\
+            nullable=False)
+    external_system = sa.Column('external_system', sa.VARCHAR(length=255), nullable=False)
+    error_class = sa.Column('error_class', sa.VARCHAR(length=255), nullable=False)
+    error = sa.Column('error', sa.Text)
+    last_status = sa.Column('last_status', sa.Integer)
+    last_response = sa.Column('last_response', sa.Text)
+    attempts = sa.Column('attempts', sa.Integer, nullable=False)
+    date_created = sa.Column('date_created', sa.DateTime(timezone=True), server_default=func.now())
+    date_replayed = sa.Column('date_replayed', sa.DateTime(timezone=True))
+
+class ExportRun(BASE):
+    # pylint: disable=too-few-public-methods
+    """Map ExportRun object to db, one csv export and its last checkpoint"""
+
+    __tablename__ = 'export_run'
+    id = sa.Column('id', sa.Integer, primary_key=True)
+    external_system = sa.Column('external_system', sa.VARCHAR(length=255), nullable=False)
+    status = sa.Column('status', sa.VARCHAR(length=20), nullable=False)
+    file_path = sa.Column('file_path', sa.Text, nullable=False)
+    # highest submission id which belongs in this export
+    high_water_mark = sa.Column('high_water_mark', sa.Integer, nullable=False)
+    # last submission id and file size when the last chunk was committed
+    checkpoint_id = sa.Column('checkpoint_id', sa.Integer, nullable=False, default=0)
+    checkpoint_offset = sa.Column('checkpoint_offset', sa.BigInteger, nullable=False, default=0)
+    rows_written = sa.Column('rows_written', sa.Integer, nullable=False, default=0)
+    # fencing token of the batch lease the last writer held
+    fencing_token = sa.Column('fencing_token', sa.BigInteger)
+    date_started = sa.Column('date_started', sa.DateTime(timezone=True), server_default=func.now())
+    date_finished = sa.Column('date_finished', sa.DateTime(timezone=True))
+
+class SubmissionArchive(BASE):
+    # pylint: disable=too-few-public-methods
+    """
+        Map SubmissionArchive object to db, a fully dispatched and exported
+        submission moved out of the submission table.  on postgres the
+        table is range partitioned by year of date_created
+    """
+
+    __tablename__ = 'submission_archive'
+    id = sa.Column('id', sa.Integer, primary_key=True, autoincrement=False)
+    # partitioned tables need the partition key in their primary key
+    date_created = sa.Column('date_created', sa.DateTime(timezone=True), primary_key=True)
+    data = sa.Column('data', sa.Text, nullable=False)
+    csv_date_processed = sa.Column('csv_date_processed', sa.DateTime(timezone=True))
+    # json object of external system code to external id
+    external_ids = sa.Column('external_ids', sa.Text, nullable=False)
+    # json list of the submission's amendments, oldest first
+    amendments = sa.Column('amendments', sa.Text, nullable=False, server_default='[]')
+    date_archived = sa.Column('date_archived', sa.DateTime(timezone=True),\
+            server_default=func.now())
+
+class DispatchStat(BASE):
+    # pylint: disable=too-few-public-methods
+    """
+        Map DispatchStat object to db, the number of dispatches per external
+        system and state.  kept up to date by triggers on dispatch
+    """
+
+    __tablename__ = 'dispatch_stat'
+    external_system = sa.Column('external_system', sa.VARCHAR(length=255), primary_key=True)
+    state = sa.Column('state', sa.VARCHAR(length=20), primary_key=True)
+    count = sa.Column('count', sa.Integer, nullable=False, default=0)
+
+# the dispatch_stat migration creates the same triggers
+DISPATCH_STAT_TRIGGERS = {
+    'postgresql': [
+        """
+        CREATE FUNCTION dispatch_stat_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE dispatch_stat SET count = count - 1
+                    WHERE external_system = OLD.external_system AND state = OLD.state;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO dispatch_stat (external_system, state, count)
+                    VALUES (NEW.external_system, NEW.state, 1)
+                    ON CONFLICT (external_system, state)
+                    DO UPDATE SET count = dispatch_stat.count + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER dispatch_stat_insert_delete AFTER INSERT OR DELETE ON dispatch
+            FOR EACH ROW EXECUTE PROCEDURE dispatch_stat_count()
+        """,
+        """
+        CREATE TRIGGER dispatch_stat_update AFTER UPDATE OF state ON dispatch
+            FOR EACH ROW WHEN (OLD.state IS DISTINCT FROM NEW.state)
+            EXECUTE PROCEDURE dispatch_stat_count()
+        """
+    ],
+    'sqlite': [
+        """
+        CREATE TRIGGER dispatch_stat_insert AFTER INSERT ON dispatch
+        BEGIN
+            INSERT OR IGNORE INTO dispatch_stat (external_system, state, count)
+                VALUES (NEW.external_system, NEW.state, 0);
+            UPDATE dispatch_stat SET count = count + 1
+                WHERE external_system = NEW.external_system AND state = NEW.state;
+        END
+        """,
+        """
+        CREATE TRIGGER dispatch_stat_update AFTER UPDATE OF state ON dispatch
+            WHEN OLD.state != NEW.state
+        BEGIN
+            UPDATE dispatch_stat SET count = count - 1
+                WHERE external_system = OLD.external_system AND state = OLD.state;
+            INSERT OR IGNORE INTO dispatch_stat (external_system, state, count)
+                VALUES (NEW.external_system, NEW.state, 0);
+            UPDATE dispatch_stat SET count = count + 1
+                WHERE external_system = NEW.external_system AND state = NEW.state;
+        END
+        """,
+        """
+        CREATE TRIGGER dispatch_stat_delete AFTER DELETE ON dispatch
+        BEGIN
+            UPDATE dispatch_stat SET count = count - 1
+                WHERE external_system = OLD.external_system AND state = OLD.state;
+        END
+        """
+    ]
+}
+
+def creating_dispatch_stat(ddl, target, bind, tables=None, **kw):
+    # pylint: disable=unused-argument
+    """whether create_all is creating the dispatch_stat table"""
+    return any(table.name == DispatchStat.__tablename__ for table in tables or [])
+
+for dialect, statements in DISPATCH_STAT_TRIGGERS.items():
+    for statement in statements:
+        # once both dispatch and dispatch_stat exist
+        sa.event.listen(BASE.metadata, 'after_create',\
+                sa.DDL(statement).execute_if(dialect=dialect, callable_=creating_dispatch_stat))
+
+def set_dispatch_state(db_session, submission_id, external_system, state, from_states=None,\
+        stale_before=None):
+    # pylint: disable=too-many-arguments
+    """
+        moves a dispatch to state with a single conditional update
+        returns True when the row was changed
+    """
+    query = db_session.query(Dispatch)\
+            .filter(Dispatch.submission_id == submission_id)\
+            .filter(Dispatch.external_system == external_system)
+    if from_states is not None:
+        condition = Dispatch.state.in_(from_states)
+        if stale_before is not None:
+            condition = sa.or_(condition, sa.and_(Dispatch.state == DISPATCH_IN_FLIGHT,\
+                    Dispatch.date_updated < stale_before))
+        query = query.filter(condition)
+    values = {Dispatch.state: state, Dispatch.date_updated: datetime.now(timezone.utc)}
+    if state == DISPATCH_IN_FLIGHT:
+        values[Dispatch.attempts] = Dispatch.attempts + 1
+    return query.update(values, synchronize_session=False) == 1
+
+def insert_dispatch(db_session, submission_id, external_system, state):
+    """
+        creates and commits the ledger entry for a dispatch
+        returns False when another process created it first
+    """
+    db_session.add(Dispatch(submission_id=submission_id,\
+            external_system=external_system,\
+            state=state,\
+            attempts=1 if state == DISPATCH_IN_FLIGHT else 0,\
+            date_updated=datetime.now(timezone.utc)))
+    try:
+        db_session.commit()
+        return True
+    except IntegrityError:
+        db_session.rollback()
+        return False
+
+def queue_dispatch(db_session, submission_id, external_system):
+    """
+        records that a dispatch is about to be queued
+        returns False when it is already queued, in flight or done
+    """
+    queued = set_dispatch_state(db_session, submission_id, external_system, DISPATCH_QUEUED,\
+            from_states=[DISPATCH_FAILED])\
+            or insert_dispatch(db_session, submission_id, external_system, DISPATCH_QUEUED)
+    db_session.commit()
+    return queued
+
+def claim_dispatch(db_session, submission_id, external_system, lease_seconds):
+    """
+        atomically takes ownership of a dispatch before calling the external system
+        in flight dispatches older than lease_seconds are assumed to belong to a dead worker
+        returns False when another worker owns it or it is already done
+    """
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=lease_seconds)
+    claimed = set_dispatch_state(db_session, submission_id, external_system, DISPATCH_IN_FLIGHT,\
+            from_states=[DISPATCH_QUEUED, DISPATCH_FAILED], stale_before=stale_before)
+    if not claimed and not db_session.query(Dispatch.id)\
+            .filter(Dispatch.submission_id == submission_id)\
+            .filter(Dispatch.external_system == external_system).count():
+        # job queued before the ledger existed
+        claimed = insert_dispatch(db_session, submission_id, external_system, DISPATCH_IN_FLIGHT)
+    db_session.commit()
+    return claimed
+
+def fail_dispatch(db_session, submission_id, external_system):
+    """release a claimed dispatch so a retry can claim it again"""
+    db_session.rollback()
+    set_dispatch_state(db_session, submission_id, external_system, DISPATCH_FAILED,\
+            from_states=[DISPATCH_IN_FLIGHT])
+    db_session.commit()
+
+def record_external_id(db_session, submission_id, external_system, external_id):
+    """
+        the external id a system gave a submission, replacing the one it
+        gave an earlier version so a submission keeps one id per system.
+        the caller commits
+    """
+    external_id_obj = db_session.query(ExternalId)\
+            .filter(ExternalId.submission_id == submission_id)\
+            .filter(ExternalId.external_system == external_system)\
+            .order_by(ExternalId.id.desc()).first()
+    if external_id_obj is None:
+        external_id_obj = ExternalId(submission_id=submission_id,\
+                external_system=external_system)
+        db_session.add(external_id_obj)
+    elif external_id_obj.external_id != str(external_id):
+        print("submission_id - " + str(submission_id) + ":system - " + external_system +\
+                " external_id " + external_id_obj.external_id + " replaced by " + str(external_id))
+    external_id_obj.external_id = external_id
+    return external_id_obj
+
 def create_submission(db_session, json_data):
     '''helper function for creating a submission'''
     submission = Submission(data=json.dumps(json_data))
     db_session.add(submission)
     db_session.commit()
     return submission
+
+def unsettled_dispatches(db_session, submission_id):
+    """
+        external systems a submission is on its way to, every dispatch
+        which is not done or failed with a dead letter waiting for a replay
+    """
+    return [row.external_system for row in db_session.query(Dispatch.external_system)\
+            .filter(Dispatch.submission_id == submission_id)\
+            .filter(Dispatch.state != DISPATCH_DONE)\
+            .filter(~sa.exists().where(DeadLetter.submission_id == Dispatch.submission_id)\
+                    .where(DeadLetter.external_system == Dispatch.external_system)\
+                    .where(DeadLetter.date_replayed.is_(None)))]
+
+def amend_submission(db_session, submission, data, diff, external_systems, reexport):
+    # pylint: disable=too-many-arguments
+    """
+        replaces the data of a submission and records the amendment as its
+        next version in one transaction, releasing the dispatches of
+        external_systems to be sent again and, with reexport, putting the
+        submission back in the next csv export.  returns False, changing
+        nothing, when another amendment made that version first
+    """
+    version = submission.version + 1
+    values = {Submission.data: json.dumps(data), Submission.version: version}
+    if reexport:
+        values[Submission.csv_date_processed] = None
+    if db_session.query(Submission)\
+            .filter(Submission.id == submission.id)\
+            .filter(Submission.version == submission.version)\
+            .update(values, synchronize_session=False) != 1:
+        db_session.rollback()
+        return False
+    db_session.add(SubmissionAmendment(submission_id=submission.id,\
+            version=version,\
+            diff=json.dumps(diff),\
+            external_systems=json.dumps(external_systems)))
+    for external_system in external_systems:
+        set_dispatch_state(db_session, submission.id, external_system, DISPATCH_FAILED,\
+                from_states=[DISPATCH_DONE])
+    db_session.commit()
+    db_session.refresh(submission)
+    return True
+
+def archivable_submissions(db_session, before, external_systems):
+    """
+        query for submissions created before the given time which are in
+        the csv export and have an external id from every external system,
+        with no dispatch still open and no dead letter waiting for a replay
+    """
+    query = db_session.query(Submission)\
+            .filter(Submission.date_created < before)\
+            .filter(Submission.csv_date_processed.isnot(None))\
+            .filter(~sa.exists().where(Dispatch.submission_id == Submission.id)\
+                    .where(Dispatch.state != DISPATCH_DONE))\
+            .filter(~sa.exists().where(DeadLetter.submission_id == Submission.id)\
+                    .where(DeadLetter.date_replayed.is_(None)))
+    for external_system in external_systems:
+        query = query.filter(sa.exists().where(ExternalId.submission_id == Submission.id)\
+                .where(ExternalId.external_system == external_system))
+    return query
+
+def archive_partition(db_session, year):
+    """create the postgres archive partition for a year of submissions"""
+    if db_session.bind.dialect.name != 'postgresql':
+        return
+    db_session.execute("CREATE TABLE IF NOT EXISTS submission_archive_{0} "\
+            "PARTITION OF submission_archive FOR VALUES "\
+            "FROM ('{0}-01-01 00:00:00+00') TO ('{1}-01-01 00:00:00+00')".format(year, year + 1))
+
+def archive_batch(db_session, submissions):
+    """
+        moves submissions with their external ids and amendments to the
+        archive in one transaction.  only submissions every system
+        received are archived, so their dispatch ledger entries and
+        replayed dead letters tell nothing the external ids do not and are
+        dropped.  dispatch_stat keeps counting the dropped dispatches
+    """
+    ids = [submission.id for submission in submissions]
+    external_ids = {}
+    # the newest wins where ids were recorded twice
+    for external_id in db_session.query(ExternalId).filter(ExternalId.submission_id.in_(ids))\
+            .order_by(ExternalId.id):
+        external_ids.setdefault(external_id.submission_id, {})[external_id.external_system] =\
+                external_id.external_id
+    amendments = {}
+    for amendment in db_session.query(SubmissionAmendment)\
+            .filter(SubmissionAmendment.submission_id.in_(ids))\
+            .order_by(SubmissionAmendment.version):
+        date_created = amendment.date_created
+        if date_created.tzinfo is None:
+            # sqlite drops the utc offset
+            date_created = date_created.replace(tzinfo=timezone.utc)
+        amendments.setdefault(amendment.submission_id, []).append({\
+                'version': amendment.version,\
+                'diff': json.loads(amendment.diff),\
+                'external_systems': json.loads(amendment.external_systems),\
+                'date_created': date_created.isoformat()})
+    # the delete triggers take these off dispatch_stat, they are put back below
+    dropped = db_session.query(Dispatch.external_system, Dispatch.state,\
+            sa.func.count(Dispatch.id))\
+            .filter(Dispatch.submission_id.in_(ids))\
+            .group_by(Dispatch.external_system, Dispatch.state).all()
+    for year in {submission.date_created.year for submission in submissions}:
+        archive_partition(db_session, year)
+    db_session.bulk_insert_mappings(SubmissionArchive, [{\
+            'id': submission.id,\
+            'date_created': submission.date_created,\
+            'data': submission.data,\
+            'csv_date_processed': submission.csv_date_processed,\
+            'external_ids': json.dumps(external_ids.get(submission.id, {})),\
+            'amendments': json.dumps(amendments.get(submission.id, []))\
+            } for submission in submissions])
+    for model in (ExternalId, Dispatch, DeadLetter, SubmissionAmendment):
+        db_session.query(model).filter(model.submission_id.in_(ids))\
+                .delete(synchronize_session=False)
+    for external_system, state, count in dropped:
+        db_session.query(DispatchStat)\
+                .filter(DispatchStat.external_system == external_system)\
+                .filter(DispatchStat.state == state)\
+                .update({DispatchStat.count: DispatchStat.count + count},\
+                synchronize_session=False)
+    db_session.query(Submission).filter(Submission.id.in_(ids))\
+            .delete(synchronize_session=False)
+    db_session.commit()
+
+def exported_submissions(db_session, model, chunk_size):
+    """
+        (id, date exported) of every exported submission of a model,
+        Submission or SubmissionArchive, in id order, read chunk_size at a
+        time.  exports record naive utc times, which are made aware
+    """
+    last_id = 0
+    while True:
+        chunk = db_session.query(model.id, model.csv_date_processed)\
+                .filter(model.csv_date_processed.isnot(None))\
+                .filter(model.id > last_id)\
+                .order_by(model.id)\
+                .limit(chunk_size).all()
+        if not chunk:
+            return
+        for submission_id, date_processed in chunk:
+            if date_processed.tzinfo is None:
+                date_processed = date_processed.replace(tzinfo=timezone.utc)
+            yield submission_id, date_processed
+        last_id = chunk[-1][0]
+
+def fence_export(db_session, export_run, token):
+    """
+        stamps an export run with a lease's fencing token in the current
+        transaction.  returns False, leaving it alone, when a worker
+        holding a later lease has stamped it since
+    """
+    return db_session.query(ExportRun)\
+            .filter(ExportRun.id == export_run.id)\
+            .filter(sa.or_(ExportRun.fencing_token.is_(None), ExportRun.fencing_token <= token))\
+            .update({ExportRun.fencing_token: token}, synchronize_session=False) == 1
@@ -0,0 +1,208 @@
+"""Per-client rate limiting and load shedding middleware"""
+import os
+import hmac
+import time
+import threading
+from collections import OrderedDict
+import falcon
+from .db_session import pool_usage
+from .jobs import get_celery
+
+DEFAULT_RATE = 10.0 # tokens per second per client address
+DEFAULT_BURST = 20
+# every legitimate client shares the one ACCESS_KEY, its bucket is off unless sized
+DEFAULT_KEY_RATE = 0.0
+DEFAULT_KEY_BURST = 200
+ACCESS_KEY_BUCKET = 'access-key'
+DEFAULT_MAX_QUEUE_DEPTH = 1000
+DEFAULT_MAX_POOL_USAGE = 0.9
+DEFAULT_CHECK_INTERVAL = 1.0 # seconds between overload probes
+MAX_CLIENTS = 10000 # buckets kept, the least recently used are dropped past it
+
+class TokenBucket:
+    # pylint: disable=too-few-public-methods
+    """token bucket which refills continuously at rate tokens per second"""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def consume(self, now):
+        """
+            take a token if one is available
+            returns seconds to wait before the next token, 0 when allowed
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """token buckets keyed by client"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        # least recently used first
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix='RATE_LIMIT', rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        """
+            build limiter from <prefix>_PER_SECOND and <prefix>_BURST
+            returns None when the rate is 0
+        """
+        rate = float(os.environ.get(prefix + '_PER_SECOND', rate))
+        if rate <= 0:
+            return None
+        return cls(rate, int(os.environ.get(prefix + '_BURST', burst)))
+
+    def check(self, key):
+        """returns seconds the client should wait, 0 when the request is allowed"""
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+                if len(self.buckets) > MAX_CLIENTS:
+                    # forget the client seen longest ago, so memory and the time
+                    # spent under the lock stay the same however many clients come
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.consume(now)
+
+class LoadShedder:
+    # pylint: disable=too-many-instance-attributes
+    """
+        reports overload when the celery queues or the db connection pool
+        is past its threshold.  probes are cached for check_interval seconds
+    """
+
+    def __init__(self, queue_depth=None, max_queue_depth=DEFAULT_MAX_QUEUE_DEPTH,\
+            pool_usage_probe=pool_usage, max_pool_usage=DEFAULT_MAX_POOL_USAGE,\
+            check_interval=DEFAULT_CHECK_INTERVAL, clock=time.monotonic):
+        # pylint: disable=too-many-arguments
+        self.queue_depth = queue_depth or celery_queue_depth
+        self.max_queue_depth = max_queue_depth
+        self.pool_usage = pool_usage_probe
+        self.max_pool_usage = max_pool_usage
+        self.check_interval = check_interval
+        self.clock = clock
+        self.checked = None
+        self.reason = None
+
+    @classmethod
+    def from_env(cls):
+        """build shedder from SHED_QUEUE_DEPTH and SHED_DB_POOL_USAGE"""
+        return cls(max_queue_depth=int(os.environ.get('SHED_QUEUE_DEPTH',\
+                        DEFAULT_MAX_QUEUE_DEPTH)),\
+                max_pool_usage=float(os.environ.get('SHED_DB_POOL_USAGE',\
+                        DEFAULT_MAX_POOL_USAGE)))
+
+    def overloaded(self):
+        """returns the reason for shedding load, None when healthy"""
+        now = self.clock()
+        if self.checked is None or now - self.checked >= self.check_interval:
+            self.checked = now
+            self.reason = self.probe()
+        return self.reason
+
+    def probe(self):
+        """run the queue and pool probes"""
+        try:
+            if self.max_queue_depth and self.queue_depth() >= self.max_queue_depth:
+                return 'job queue is full'
+            if self.max_pool_usage and self.pool_usage() >= self.max_pool_usage:
+                return 'database is busy'
+        except Exception as err: # pylint: disable=broad-except
+            # a failed probe should not take the api down with it
+            print("load shedding probe failed:")
+            print("{0}".format(err))
+        return None
+
+def celery_queue_depth():
+    """
+        number of messages waiting in the default queue and the dispatch
+        queues of the api systems.  the batch queue only ever holds the
+        scheduled runs, which do not grow with the submissions taken in
+    """
+    app = get_celery()
+    import celeryconfig # pylint: disable=import-outside-toplevel
+    queues = [celeryconfig.DEFAULT_QUEUE] + [celeryconfig.dispatch_queue(code)\
+            for code in celeryconfig.DISPATCH_CODES]
+    depth = 0
+    with app.connection_for_read() as conn:
+        for queue_name in queues:
+            try:
+                depth += conn.default_channel.queue_declare(queue=queue_name, passive=True)\
+                        .message_count
+            except conn.channel_errors:
+                # nothing was ever sent to it
+                pass
+    return depth
+
+def client_address(req, proxies):
+    """
+        address of the client, the remote address unless the request came
+        through the number of trusted proxies given, then the address the
+        outermost of them added to X-Forwarded-For
+    """
+    if proxies:
+        forwarded = [hop.strip() for hop in (req.get_header('X-Forwarded-For') or '').split(',')\
+                if hop.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return req.remote_addr
+
+def valid_access_key(req):
+    """whether the request carries the ACCESS_KEY"""
+    access_key = os.environ.get('ACCESS_KEY')
+    sent = req.get_header('ACCESS_KEY')
+    return bool(access_key and sent) and\
+            hmac.compare_digest(sent.encode('utf-8'), access_key.encode('utf-8'))
+
+class ThrottleMiddleware:
+    """
+        rejects requests with 429 once a client exhausts its token bucket
+        and with 503 when resources that use the db arrive while overloaded.
+        requests with the access key share key_limiter's bucket, any other
+        request is limited by limiter per client address, so made up keys
+        do not get a bucket of their own
+    """
+
+    def __init__(self, limiter=None, shedder=None, key_limiter=None, proxies=0):
+        self.limiter = limiter
+        self.shedder = shedder
+        self.key_limiter = key_limiter
+        self.proxies = proxies
+
+    def process_request(self, req, resp):
+        # pylint: disable=unused-argument
+        """enforce the per-client rate limit"""
+        if valid_access_key(req):
+            limiter, key = self.key_limiter, ACCESS_KEY_BUCKET
+        else:
+            limiter, key = self.limiter, client_address(req, self.proxies)
+        if limiter is None:
+            return
+        wait = limiter.check(key)
+        if wait:
+            raise falcon.HTTPTooManyRequests(description='Rate limit exceeded',\
+                    retry_after=max(1, int(round(wait))))
+
+    def process_resource(self, req, resp, resource, params):
+        # pylint: disable=unused-argument
+        """shed load for resources that need the db or the job queue"""
+        if self.shedder is None or not getattr(resource, 'uses_db', False):
+            return
+        reason = self.shedder.overloaded()
+        if reason:
+            raise falcon.HTTPServiceUnavailable(description=reason,\
+                    retry_after=int(self.shedder.check_interval) or 1)
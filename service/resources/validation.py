@@ -0,0 +1,137 @@
+"""Submission validation compiled from the external system templates"""
+import os
+import re
+from .external_systems import GROUP_COUNTER_REPLACEMENT_STRING, template_columns
+
+DEFAULT_MAX_BODY_BYTES = 256 * 1024
+DEFAULT_MAX_LENGTH = 2000 # characters in a text field
+REQUIRED_FIELDS = ("block", "lot")
+# rules for fields which need more than the default text rule
+FIELD_RULES = {
+    "block": {"type": "code", "max_length": 10},
+    "lot": {"type": "code", "max_length": 10},
+    "current_num_adu": {"type": "integer", "min": 0},
+    "est_cost": {"type": "number", "min": 0},
+    "current_sq_ft_adu_%#%": {"type": "number", "min": 0}
+}
+CODE_PATTERN = re.compile(r'^[0-9A-Za-z]+$')
+INTEGER_PATTERN = re.compile(r'^-?[0-9]+$')
+NUMBER_PATTERN = re.compile(r'^-?[0-9]+(\.[0-9]+)?$')
+
+class ValidationError(Exception):
+    """submission failed validation, errors maps field ids to messages"""
+
+    def __init__(self, errors):
+        super().__init__("Invalid submission: " + ", ".join(\
+                field + " " + message for field, message in sorted(errors.items())))
+        self.errors = errors
+
+def max_body_bytes():
+    """largest submission body accepted, from SUBMISSION_MAX_BYTES"""
+    return int(os.environ.get('SUBMISSION_MAX_BYTES', DEFAULT_MAX_BODY_BYTES))
+
+def template_field_ids(systems_dict):
+    """ids of every form field the templates of a mapping read, groupings expanded"""
+    field_ids = set()
+    for system in systems_dict.values():
+        template = system.get("template", [])
+        if isinstance(template, dict):
+            # api payload templates map payload keys to form field ids
+            field_ids.update(value for value in template.values() if value)
+        else:
+            field_ids.update(field_id for _, field_id in template_columns(template))
+        field_ids.update(template_field_ids(system.get("dependants", {})))
+    return field_ids
+
+def expand_rules(rules, counts):
+    """rules keyed by field id, with grouping rules copied for every unit"""
+    expanded = {}
+    for field_id, rule in rules.items():
+        if GROUP_COUNTER_REPLACEMENT_STRING in field_id:
+            for i in range(counts.get(field_id, 0)):
+                expanded[field_id.replace(GROUP_COUNTER_REPLACEMENT_STRING, str(i+1))] = rule
+        else:
+            expanded[field_id] = rule
+    return expanded
+
+def grouping_counts(systems_dict):
+    """number of copies of each grouping field, keyed by its unexpanded id"""
+    counts = {}
+    for system in systems_dict.values():
+        template = system.get("template", [])
+        if isinstance(template, list):
+            for item in template:
+                if item.get("type") == "grouping":
+                    for nested_item in item["template"]:
+                        counts[nested_item["id"]] = max(item["count"],\
+                                counts.get(nested_item["id"], 0))
+        counts.update(grouping_counts(system.get("dependants", {})))
+    return counts
+
+def compile_check(rule):
+    """
+        function checking a field value against a rule
+        returns an error message, None when the value is valid
+    """
+    kind = rule.get("type", "text")
+    max_length = rule.get("max_length", DEFAULT_MAX_LENGTH)
+    minimum = rule.get("min")
+
+    if kind == "code":
+        def check(value):
+            if not isinstance(value, (str, int)) or isinstance(value, bool) or\
+                    not CODE_PATTERN.match(str(value)) or len(str(value)) > max_length:
+                return "must be letters and digits, at most " + str(max_length) + " long"
+            return None
+    elif kind in ("integer", "number"):
+        pattern = INTEGER_PATTERN if kind == "integer" else NUMBER_PATTERN
+        types = (int,) if kind == "integer" else (int, float)
+        def check(value):
+            if value is None or value == "":
+                return None
+            if isinstance(value, bool) or not (isinstance(value, types) or\
+                    isinstance(value, str) and pattern.match(value)):
+                return "must be a" + ("n integer" if kind == "integer" else " number")
+            if minimum is not None and float(value) < minimum:
+                return "must be at least " + str(minimum)
+            return None
+    else:
+        def check(value):
+            if isinstance(value, str):
+                if len(value) > max_length:
+                    return "must be at most " + str(max_length) + " characters"
+            elif isinstance(value, (list, dict)):
+                return "must be a single value"
+            return None
+    return check
+
+class Validator:
+    # pylint: disable=too-few-public-methods
+    """
+        checks submissions against per field checks compiled once from
+        the field ids of a mapping's templates and FIELD_RULES
+    """
+
+    def __init__(self, systems_dict, rules=None, required=REQUIRED_FIELDS):
+        rules = expand_rules(FIELD_RULES if rules is None else rules,\
+                grouping_counts(systems_dict))
+        default = compile_check({})
+        self.checks = {field_id: compile_check(rules[field_id]) if field_id in rules\
+                else default for field_id in template_field_ids(systems_dict) | set(rules)}
+        self.required = tuple(required)
+
+    def __call__(self, json_data):
+        """raises ValidationError listing every invalid field"""
+        if not isinstance(json_data, dict):
+            raise ValidationError({"submission": "must be a json object"})
+        errors = {field_id: "is required" for field_id in self.required\
+                if json_data.get(field_id) in (None, "")}
+        checks = self.checks
+        for field_id, value in json_data.items():
+            check = checks.get(field_id)
+            if check is not None and field_id not in errors:
+                message = check(value)
+                if message is not None:
+                    errors[field_id] = message
+        if errors:
+            raise ValidationError(errors)
@@ -3,115 +3,309 @@
 # import sys
 # import traceback
 import os
+import glob
 import json
-from datetime import datetime
-import celery
+import heapq
+from datetime import datetime, timedelta, timezone
 import requests
-from kombu import serialization
-import celeryconfig
-from service.resources.external_systems import MAP
+import sqlalchemy as sa
+from service.resources.jobs import get_celery, schedule
+from service.resources.registry import get_registry
 from service.resources.db_session import create_session
-from service.resources.submission_model import Submission
+from service.resources.csv_delivery import FtpDelivery, ExportStream, CHECKSUM_SUFFIX
+from service.resources.reconcile import reconcile, REPORTS
+from service.resources.lease import singleton, LeaseLost
+from service.resources.submission_model import Submission, SubmissionArchive, DeadLetter,\
+        Dispatch, ExportRun, claim_dispatch, fail_dispatch, set_dispatch_state,\
+        archivable_submissions, archive_batch, exported_submissions, fence_export,\
+        EXPORT_RUNNING, EXPORT_DONE, DISPATCH_IN_FLIGHT, DISPATCH_PENDING, DISPATCH_FAILED
 
-DEFAULT_MAX_RETRIES = 3
-DEFAULT_RETRY_INTERVAL = 0
 CSV_DIR = "csv/"
-GROUP_COUNTER_REPLACEMENT_STRING = "%#%"
-
-serialization.register_pickle()
-serialization.enable_insecure_serializers()
+# seconds before an unfinished dispatch is assumed to belong to a dead worker,
+# well above DISPATCH_TIMEOUT so a live worker's post gives up long before
+DISPATCH_LEASE = int(os.environ.get('DISPATCH_LEASE', 600))
+# seconds a post to an external system may take to connect and to answer,
+# well below DISPATCH_LEASE so no second worker claims a dispatch still posting
+DISPATCH_TIMEOUT = float(os.environ.get('DISPATCH_TIMEOUT', 30))
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+CALLBACK_URL_HEADER = "Callback-Url"
+DEFAULT_REPLAY_BATCH_SIZE = 100
+DEFAULT_REPLAY_RATE = 5 # dispatches per second per external system
+CSV_CHUNK_SIZE = 1000
+PARTIAL_SUFFIX = ".partial"
+# days before finished submissions move to the archive
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+DEFAULT_ARCHIVE_BATCH_SIZE = 500
+INBOUND_PATTERN = "{0}_inbound_*.csv*"
+# hours an external system gets to take in an export before it is re-sent
+RECONCILE_GRACE_HOURS = int(os.environ.get('RECONCILE_GRACE_HOURS', 24))
+# where parquet exports go, a volume which outlives the worker.  unset, nothing is exported
+PARQUET_DIR = os.environ.get('PARQUET_DIR')
+PARQUET_RUN_PREFIX = "parquet-"
+# hours a system which calls back gets before its pending dispatch is failed
+CALLBACK_DEADLINE_HOURS = int(os.environ.get('CALLBACK_DEADLINE_HOURS', 24))
+DEFAULT_EXPIRE_BATCH_SIZE = 500
 
 # pylint: disable=invalid-name
-celery_app = celery.Celery('adu-dispatcher')
-celery_app.config_from_object(celeryconfig)
+celery_app = get_celery()
 # pylint: enable=invalid-name
 
 @celery_app.task(name="tasks.dispatch", bind=True)
-def dispatch(self, external_code, external_system, submission_obj):
-    # pylint: disable=unused-argument
+def dispatch(self, external_code, registry_version, submission_obj):
+    # pylint: disable=unused-argument, too-many-locals
     """
         does the work to send data to external system
         records successes
         retry failures
+        systems which call back are left pending once they accepted the post
     """
     print("dispatch:submission_id - " + str(submission_obj.id) + ":system - " + external_code)
 
+    session = create_session()
+    db_session = session()
+    response = None
     try:
-        # send payload to external system
-        if not "env_var" in external_system:
-            raise ValueError('env_var required in mapping for external api calls')
-        url = os.getenv(external_system["env_var"], None)
+        # only one worker may talk to the external system for a submission
+        if not claim_dispatch(db_session, submission_obj.id, external_code, DISPATCH_LEASE):
+            print("dispatch:submission_id - " + str(submission_obj.id) + ":system - " +\
+                    external_code + " already claimed or done, dropping duplicate job")
+            return
+
+        external_system = dispatch_system(external_code, registry_version)
+        url = external_system.url
         if not url:
-            raise ValueError('No url set for ' + external_system["env_var"]) # pragma: no cover
-        payload = generate_payload(submission_obj, external_system["template"])
-        response = requests.post(url, json=payload)
+            raise ValueError('No url set for ' + external_system.config["env_var"]) # pragma: no cover
+        payload = generate_payload(submission_obj, external_system.template)
+        # lets the external system drop a repeat of a post whose result we failed to record
+        key = "adu-" + str(submission_obj.id) + "-" + external_code
+        # jobs queued before submissions had versions carry none
+        version = submission_obj.__dict__.get('version')
+        if version:
+            # an amendment is a new post, not a repeat of the last one
+            key += "-v" + str(version)
+        headers = {IDEMPOTENCY_HEADER: key}
+        callback = 'callback_secret_var' in external_system.config
+        if callback and not external_system.callback_secret:
+            # every callback would be refused, leaving the dispatch pending for nothing
+            raise ValueError('No callback secret set for ' +\
+                    external_system.config["callback_secret_var"])
+        if callback and os.environ.get('CALLBACK_BASE_URL'):
+            headers[CALLBACK_URL_HEADER] = os.environ['CALLBACK_BASE_URL'].rstrip('/') +\
+                    "/callbacks/" + external_code + "/" + str(submission_obj.id)
+        response = requests.post(url, json=payload, headers=headers, timeout=DISPATCH_TIMEOUT)
         print("external system post response:" + str(response.status_code))
-        if response.status_code != 200:
+        if response.status_code != 200 and not (callback and response.status_code == 202):
             raise SystemError("Received " + str(response.status_code) +\
                     " error from " + url + ":" + response.text)
 
+        if callback:
+            # the worker is free, the id and dependants follow the callback
+            set_dispatch_state(db_session, submission_obj.id, external_code, DISPATCH_PENDING,\
+                    from_states=[DISPATCH_IN_FLIGHT])
+            db_session.commit()
+            print("dispatch:submission_id - " + str(submission_obj.id) + ":system - " +\
+                    external_code + " pending callback")
+            return
+
         # parse out external id and save it to db
         print("response from external system:")
         print(response.text)
         response_json = json.loads(response.text)
         response_id = response_json["data"]["id"]
-        session = create_session()
-        db_session = session()
         submission_obj.create_external_id(db_session=db_session,\
                             external_system=external_code,\
                             external_id=response_id)
-        db_session.close()
         print("external_id saved successfully")
 
         # queue up dependent systems
-        if "dependants" in external_system and len(external_system["dependants"]) > 0:
-            schedule(submission_obj, external_system["dependants"])
+        if external_system.dependants:
+            schedule(submission_obj, external_system.dependants, db_session,\
+                    registry=get_registry())
     except Exception as err: # pylint: disable=broad-except
         print("Oops!  Something went wrong, retrying.  This was the error:")
         print("{0}".format(err))
         # traceback.print_exc(file=sys.stdout)
+        fail_dispatch(db_session, submission_obj.id, external_code)
+        if self.request.retries >= self.max_retries:
+            record_dead_letter(db_session, submission_obj.id, external_code, err,\
+                    response, self.request.retries + 1)
         self.retry(exc=err)
+    finally:
+        db_session.close()
 
-def generate_payload(submission_obj, payload_template):
-    # pylint: disable=unused-argument
-    """generate payload from template"""
-    # TODO: implement this # pylint: disable=fixme
-    return {"foo": "bar"}
+def dispatch_system(external_code, registry_version):
+    """
+        the external system a dispatch job is for.  a job queued by a
+        process with a newer registry makes this one reload its registry
+        first.  jobs queued before the registry existed carry the mapping
+        instead of a version
+    """
+    registry = get_registry()
+    if isinstance(registry_version, int) and registry_version > registry.version:
+        registry = get_registry(refresh=True)
+    if registry_version != registry.version:
+        print("dispatch:system - " + external_code + " queued with registry version " +\
+                str(registry_version if isinstance(registry_version, int) else None) +\
+                ", sending with version " + str(registry.version))
+    if external_code not in registry.systems or registry.systems[external_code].type != 'api':
+        raise ValueError(external_code + ' is not an api system in registry version ' +\
+                str(registry.version))
+    return registry.systems[external_code]
+
+def record_dead_letter(db_session, submission_id, external_code, err, response, attempts):
+    # pylint: disable=too-many-arguments
+    """keep a dispatch which ran out of retries so it can be replayed"""
+    print("dispatch:submission_id - " + str(submission_id) + ":system - " + external_code +\
+            " out of retries, recording dead letter")
+    db_session.add(DeadLetter(submission_id=submission_id,\
+            external_system=external_code,\
+            error_class=type(err).__name__,\
+            error="{0}".format(err),\
+            last_status=response.status_code if response is not None else None,\
+            last_response=response.text if response is not None else None,\
+            attempts=attempts))
+    db_session.commit()
 
-def schedule(submission_obj, systems_dict):
+@celery_app.task(name="tasks.replay-dead-letters", bind=True)
+@singleton
+def replay_dead_letters(self, external_system=None, batch_size=DEFAULT_REPLAY_BATCH_SIZE,\
+        rate=DEFAULT_REPLAY_RATE, lease=None):
+    # pylint: disable=unused-argument, too-many-locals, too-many-arguments
     """
-        queues jobs to send data to external systems
-        returns array of jobs which were scheduled
+        requeues dispatches which ran out of retries, optionally only
+        those for one external system.  jobs are spread out so each
+        external system receives at most rate dispatches per second
+        returns number of jobs scheduled
     """
+    print("replay_dead_letters started:" + datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    registry = get_registry()
+    systems = registry.of_type('api')
+    session = create_session()
+    db_session = session()
+    # ledger writes need their own session, see schedule
+    ledger_session = session()
+    scheduled = {}
+    last_id = 0
+    try:
+        while True:
+            query = db_session.query(DeadLetter)\
+                    .filter(DeadLetter.date_replayed.is_(None))\
+                    .filter(DeadLetter.id > last_id)
+            if external_system is not None:
+                query = query.filter(DeadLetter.external_system == external_system)
+            batch = query.order_by(DeadLetter.id).limit(batch_size).all()
+            if not batch:
+                break
+            lease.heartbeat()
 
-    systems_todo = systems_dict.keys()
-    systems_done = [external_id.external_system for external_id in submission_obj.external_ids]
-    jobs = []
+            for dead_letter in batch:
+                last_id = dead_letter.id
+                code = dead_letter.external_system
+                if code not in systems:
+                    print("replay_dead_letters:unknown system - " + code)
+                else:
+                    submission = db_session.query(Submission).get(dead_letter.submission_id)
+                    # schedule skips systems which were done or queued since
+                    jobs = schedule(submission, [code], ledger_session,\
+                            countdown=scheduled.get(code, 0) / float(rate), registry=registry)
+                    scheduled[code] = scheduled.get(code, 0) + len(jobs)
+                dead_letter.date_replayed = datetime.now(timezone.utc)
+            db_session.commit()
+    finally:
+        ledger_session.close()
+        db_session.close()
+    print("replay_dead_letters finished:" + str(scheduled))
+    return sum(scheduled.values())
 
-    for todo in systems_todo:
-        if todo not in systems_done and 'type' in systems_dict[todo]\
-                and systems_dict[todo]['type'] == 'api':
-            print("schedule:submission_id - " + str(submission_obj.id) + ":system - " + todo)
+@celery_app.task(name="tasks.expire-callbacks", bind=True)
+@singleton
+def expire_callbacks(self, hours=CALLBACK_DEADLINE_HOURS, batch_size=DEFAULT_EXPIRE_BATCH_SIZE,\
+        lease=None):
+    # pylint: disable=unused-argument
+    """
+        fails dispatches which waited longer than hours for a callback,
+        each with a dead letter to replay, so they stop holding back
+        amendments.  returns number of dispatches expired
+    """
+    print("expire_callbacks started:" + datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    before = datetime.now(timezone.utc) - timedelta(hours=hours)
+    session = create_session()
+    db_session = session()
+    expired = 0
+    last_id = 0
+    try:
+        while True:
+            batch = db_session.query(Dispatch.id, Dispatch.submission_id,\
+                    Dispatch.external_system, Dispatch.attempts)\
+                    .filter(Dispatch.state == DISPATCH_PENDING)\
+                    .filter(Dispatch.date_updated < before)\
+                    .filter(Dispatch.id > last_id)\
+                    .order_by(Dispatch.id).limit(batch_size).all()
+            if not batch:
+                break
+            lease.heartbeat()
+            for row in batch:
+                last_id = row.id
+                # unless its callback came in since
+                if db_session.query(Dispatch)\
+                        .filter(Dispatch.id == row.id)\
+                        .filter(Dispatch.state == DISPATCH_PENDING)\
+                        .filter(Dispatch.date_updated < before)\
+                        .update({Dispatch.state: DISPATCH_FAILED,\
+                            Dispatch.date_updated: datetime.now(timezone.utc)},\
+                            synchronize_session=False) == 1:
+                    db_session.add(DeadLetter(submission_id=row.submission_id,\
+                            external_system=row.external_system,\
+                            error_class='CallbackTimeout',\
+                            error="no callback within " + str(hours) + " hours",\
+                            attempts=row.attempts))
+                    expired += 1
+            db_session.commit()
+    finally:
+        db_session.close()
+    print("expire_callbacks finished:" + str(expired))
+    return expired
 
-            # determine if send csv or making api call
-            print("scheduling external api call")
-            # data needs to be sent to external system api
-            job = dispatch.apply_async((todo, systems_dict[todo], submission_obj),\
-                    serializer='pickle',\
-                    retry=True,\
-                    retry_policy={
-                        'max_retries': systems_dict.get('max_retries', DEFAULT_MAX_RETRIES),
-                        'interval_start': systems_dict.get('timeout', DEFAULT_RETRY_INTERVAL)
-                    })
-            jobs.append(job)
-        elif "dependants" in systems_dict[todo] and len(systems_dict[todo]["dependants"]) > 0:
-            # external system already done, check dependants
-            jobs = jobs + schedule(submission_obj, systems_dict[todo]["dependants"])
-    return jobs
+@celery_app.task(name="tasks.archive-submissions", bind=True)
+@singleton
+def archive_submissions(self, days=ARCHIVE_AFTER_DAYS, batch_size=DEFAULT_ARCHIVE_BATCH_SIZE,\
+        lease=None):
+    # pylint: disable=unused-argument
+    """
+        moves submissions older than days which every external system has
+        received and which went out in a csv to the archive, batch_size at
+        a time so the submission table, which exports and dispatches
+        query, only holds recent and unfinished submissions
+        returns number of submissions archived
+    """
+    print("archive_submissions started:" + datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    before = datetime.now(timezone.utc) - timedelta(days=days)
+    session = create_session()
+    db_session = session()
+    archived = 0
+    try:
+        while True:
+            batch = archivable_submissions(db_session, before, get_registry().of_type('api'))\
+                    .order_by(Submission.id).limit(batch_size).all()
+            if not batch:
+                break
+            lease.heartbeat()
+            archive_batch(db_session, batch)
+            archived += len(batch)
+    finally:
+        db_session.close()
+    print("archive_submissions finished:" + str(archived))
+    return archived
 
+def generate_payload(submission_obj, payload_template):
+    # pylint: disable=unused-argument
+    """generate payload from template"""
+    # TODO: implement this # pylint: disable=fixme
+    return {"foo": "bar"}
 
 @celery_app.task(name="tasks.outbound-csv", bind=True)
-def outbound_csv(self):
+@singleton
+def outbound_csv(self, lease=None):
     # pylint: disable=unused-argument
     """
         creates csvs and puts them on an ftp server
@@ -120,29 +314,28 @@ def outbound_csv(self):
 
     session = create_session()
     db_session = session()
-    new_submissions = db_session.query(Submission).filter(Submission.csv_date_processed.is_(None))
+    # one connection per ftp server, shared by every file sent there
+    deliveries = {}
 
-    # create csvs
-    for external_code in MAP:
-        if "type" in MAP[external_code] and MAP[external_code]["type"] == "csv":
-            file_path = create_csv(new_submissions, MAP[external_code]["template"])
+    try:
+        # create csvs and ftp them as they are written
+        for external_code, external_system in get_registry().of_type('csv').items():
+            delivery = FtpDelivery.from_system(external_system.config)
+            if delivery is not None:
+                delivery = deliveries.setdefault((delivery.host, delivery.port), delivery)
+            file_path = create_csv(db_session, external_code, external_system, delivery, lease)
             print("file created: " + file_path)
 
-            # ftp it
-
             # archive csv file in the cloud
-
-            # mark csv processed
-            now = datetime.utcnow()
-            for submission in new_submissions:
-                submission.csv_date_processed = now
-            db_session.commit()
-
-    db_session.close()
+    finally:
+        for delivery in deliveries.values():
+            delivery.close()
+        db_session.close()
     print("outbound_csv finished:" + datetime.now().strftime("%Y/%m/%d, %H:%M:%S"))
 
 @celery_app.task(name="tasks.inbound-csv", bind=True)
-def inbound_csv(self):
+@singleton
+def inbound_csv(self, lease=None):
     # pylint: disable=unused-argument
     """
         process csv from dbi
@@ -150,47 +343,259 @@ def inbound_csv(self):
     print("inbound_csv:submission")
     print("TODO: this isn't implemented yet")
 
-def create_csv(submissions, template):
+@celery_app.task(name="tasks.reconcile-csv", bind=True)
+@singleton
+def reconcile_csv(self, external_code="dbi", file_path=None, lease=None):
     # pylint: disable=unused-argument
     """
-        creates csv and returns filepath
-    """
-    file_path = os.path.join(CSV_DIR, datetime.now().strftime("%Y%m%d_%H%M%S") + ".csv")
-
-    with open(file_path, "w+") as csv_file:
-        # generate field names and ids
-        field_names = ['adu_id']  # first field is adu db unique identifier
-        ids = []
-        for item in template:
-            print(json.dumps(item))
-            # loop through a group object
-            if "type" in item and item["type"] == "grouping":
-                for i in range(item["count"]): # zero-based
-                    for nested_item in item["template"]:
-                        field_names.append(\
-                                nested_item["name"].replace(GROUP_COUNTER_REPLACEMENT_STRING,\
-                                str(i+1)))
-                        ids.append(\
-                                nested_item["id"].replace(GROUP_COUNTER_REPLACEMENT_STRING,\
-                                str(i+1)))
-            else:
-                field_names.append(item["name"])
-                ids.append(item["id"])
-        csv_file.write('|'.join(field_names) + '\n')
-
-        for submission in submissions:
-            # generate data
-            data = [submission.id]
-            data_json = json.loads(submission.data)
-            for form_id in ids:
-                if form_id in data_json:
-                    data.append(data_json[form_id])
-                else:
-                    data.append(None)
-            quoted_data = [quote_strings(val) for val in data]
-            csv_file.write('|'.join(str(val) for val in quoted_data) + '\n')
+        compares the newest inbound csv of a csv system, or file_path,
+        with the submissions exported to it and writes reports of the ids
+        missing from it, found more than once, never exported and due a
+        re-export.  returns the number of ids in each report
+    """
+    if file_path is None:
+        inbound = glob.glob(os.path.join(CSV_DIR, INBOUND_PATTERN.format(external_code)))
+        if not inbound:
+            print("reconcile_csv:" + external_code + " no inbound file")
+            return None
+        file_path = max(inbound, key=os.path.getmtime)
+    print("reconcile_csv started:" + file_path)
+
+    # exports after the file was written cannot be in it
+    received = datetime.fromtimestamp(os.path.getmtime(file_path), timezone.utc)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_paths = {report: os.path.join(CSV_DIR, stamp + "_" + external_code +\
+            "_reconcile_" + report + ".csv") for report in REPORTS}
+
+    session = create_session()
+    db_session = session()
+    try:
+        # archived submissions were exported too
+        exported = heapq.merge(\
+                exported_submissions(db_session, Submission, CSV_CHUNK_SIZE),\
+                exported_submissions(db_session, SubmissionArchive, CSV_CHUNK_SIZE))
+        counts = reconcile(file_path, renewing(exported, lease), report_paths, received,\
+                received - timedelta(hours=RECONCILE_GRACE_HOURS))
+    finally:
+        db_session.close()
+    print("reconcile_csv finished:" + json.dumps(counts))
+    return counts
+
+@celery_app.task(name="tasks.export-parquet", bind=True)
+@singleton
+def export_parquet(self, external_code="dbi", lease=None):
+    # pylint: disable=unused-argument, too-many-locals
+    """
+        appends the submissions created since the last export to parquet
+        files for reporting, with the columns of a csv system's template
+        and partitioned by day.  an interrupted export is written again
+        from the start.  returns the paths of the files written, none when
+        PARQUET_DIR is unset
+    """
+    if not PARQUET_DIR:
+        # files written to the dyno's own disk would be lost on its next restart
+        print("export_parquet skipped: PARQUET_DIR is not set")
+        return []
+    # pylint: disable=import-outside-toplevel
+    # pyarrow is only installed where reports are exported
+    from service.resources.columnar import PartitionWriter, export_schema, record_batch,\
+            remove_files
+    from service.resources.validation import grouping_counts
+    print("export_parquet started:" + datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    registry = get_registry()
+    run_name = PARQUET_RUN_PREFIX + external_code
+    schema = export_schema(registry.systems[external_code].columns,\
+            grouping_counts(registry.mapping))
+
+    session = create_session()
+    db_session = session()
+    try:
+        export_run = db_session.query(ExportRun)\
+                .filter(ExportRun.external_system == run_name)\
+                .filter(ExportRun.status == EXPORT_RUNNING)\
+                .order_by(ExportRun.id.desc()).first()
+        if export_run is None:
+            export_run = ExportRun(external_system=run_name,\
+                    status=EXPORT_RUNNING,\
+                    file_path=PARQUET_DIR,\
+                    high_water_mark=db_session.query(sa.func.max(Submission.id)).scalar() or 0,\
+                    checkpoint_id=0,\
+                    checkpoint_offset=0,\
+                    rows_written=0)
+            db_session.add(export_run)
+            db_session.flush()
+        prefix = "run-" + str(export_run.id)
+        # parquet files cannot be appended to once closed
+        for name in remove_files(export_run.file_path, prefix):
+            print("removed " + name + " of interrupted export")
+        after = db_session.query(sa.func.max(ExportRun.high_water_mark))\
+                .filter(ExportRun.external_system == run_name)\
+                .filter(ExportRun.status == EXPORT_DONE).scalar() or 0
+        export_run.rows_written = 0
+        fence(db_session, export_run, lease)
+        db_session.commit()
+
+        with PartitionWriter(export_run.file_path, prefix, schema) as writer:
+            while True:
+                chunk = db_session.query(Submission.id, Submission.date_created,\
+                        Submission.version, Submission.data)\
+                        .filter(Submission.id > after)\
+                        .filter(Submission.id <= export_run.high_water_mark)\
+                        .order_by(Submission.id)\
+                        .limit(CSV_CHUNK_SIZE).all()
+                if not chunk:
+                    break
+                writer.write(record_batch(chunk, schema))
+                export_run.rows_written = export_run.rows_written + len(chunk)
+                after = chunk[-1].id
+                lease.heartbeat()
+
+        export_run.status = EXPORT_DONE
+        export_run.date_finished = datetime.now(timezone.utc)
+        fence(db_session, export_run, lease)
+        db_session.commit()
+    finally:
+        db_session.close()
+    print("export_parquet finished:" + str(len(writer.paths)) + " files")
+    return writer.paths
+
+def renewing(rows, lease):
+    """passes rows through, keeping the lease renewed while they are read"""
+    for row in rows:
+        lease.heartbeat()
+        yield row
+
+def create_csv(db_session, external_code, external_system, delivery=None, lease=None):
+    # pylint: disable=too-many-locals,too-many-statements
+    """
+        exports unprocessed submissions to a csv and returns its filepath
+
+        rows are written in chunks to a .partial file, gzipped if the
+        mapping sets compress, and uploaded through delivery in the same
+        pass.  each chunk is fsynced, then its submissions are marked
+        processed together with a checkpoint of the file size, so an
+        interrupted export resumes after its last checkpoint.  the
+        finished file is renamed into place next to its sha256 checksum
+
+        with a lease every commit is fenced by its token and renews it,
+        a worker whose lease was taken over stops with LeaseLost
+    """
+    compress = external_system.compress
+    export_run = db_session.query(ExportRun)\
+            .filter(ExportRun.external_system == external_code)\
+            .filter(ExportRun.status == EXPORT_RUNNING)\
+            .order_by(ExportRun.id.desc()).first()
+    if export_run is None:
+        high_water_mark = db_session.query(sa.func.max(Submission.id))\
+                .filter(Submission.csv_date_processed.is_(None)).scalar()
+        export_run = ExportRun(external_system=external_code,\
+                status=EXPORT_RUNNING,\
+                file_path='',\
+                high_water_mark=high_water_mark or 0,\
+                checkpoint_id=0,\
+                checkpoint_offset=0,\
+                rows_written=0)
+        db_session.add(export_run)
+        db_session.flush()
+        # the run id keeps exports started within the same second apart
+        export_run.file_path = os.path.join(CSV_DIR,\
+                datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + str(export_run.id) +\
+                (".csv.gz" if compress else ".csv"))
+    else:
+        print("resuming export " + export_run.file_path + " after submission_id - " +\
+                str(export_run.checkpoint_id))
+    # stop any worker still writing this export under an older lease
+    fence(db_session, export_run, lease)
+    db_session.commit()
+
+    partial_path = export_run.file_path + PARTIAL_SUFFIX
+    # renamed into place but not marked done, only the upload may be unfinished
+    finished = not os.path.exists(partial_path) and export_run.checkpoint_offset > 0
+    if finished and not os.path.exists(export_run.file_path):
+        raise IOError(partial_path + " is missing, cannot resume export")
+    path = export_run.file_path if finished else partial_path
 
-    return file_path
+    with open(path, "r+b" if os.path.exists(path) else "w+b") as csv_file:
+        upload = None
+        if delivery is not None:
+            upload = delivery.upload(os.path.basename(export_run.file_path), csv_file)
+        stream = ExportStream(csv_file, compress, upload)
+        # drop anything written after the last checkpoint
+        stream.resume(os.path.getsize(path) if finished else export_run.checkpoint_offset)
+
+        if not finished:
+            columns = external_system.columns
+            ids = [form_id for _, form_id in columns]
+            if export_run.checkpoint_offset == 0:
+                # first field is adu db unique identifier
+                field_names = ['adu_id'] + [name for name, _ in columns]
+                stream.write(('|'.join(field_names) + '\n').encode('utf-8'))
+
+            while True:
+                chunk = db_session.query(Submission)\
+                        .filter(Submission.csv_date_processed.is_(None))\
+                        .filter(Submission.id > export_run.checkpoint_id)\
+                        .filter(Submission.id <= export_run.high_water_mark)\
+                        .order_by(Submission.id)\
+                        .limit(CSV_CHUNK_SIZE).all()
+                if not chunk:
+                    break
+                write_csv_rows(stream, chunk, ids)
+                offset = stream.checkpoint()
+
+                # mark csv processed along with the checkpoint
+                now = datetime.utcnow()
+                for submission in chunk:
+                    submission.csv_date_processed = now
+                export_run.checkpoint_id = chunk[-1].id
+                export_run.checkpoint_offset = offset
+                export_run.rows_written = export_run.rows_written + len(chunk)
+                fence(db_session, export_run, lease)
+                db_session.commit()
+        checksum = stream.close()
+
+    if not finished:
+        os.replace(partial_path, export_run.file_path)
+    checksum_line = (checksum + "  " + os.path.basename(export_run.file_path) + "\n")\
+            .encode('utf-8')
+    with open(export_run.file_path + CHECKSUM_SUFFIX, "wb") as checksum_file:
+        checksum_file.write(checksum_line)
+    if delivery is not None:
+        delivery.put(os.path.basename(export_run.file_path) + CHECKSUM_SUFFIX, checksum_line)
+
+    export_run.status = EXPORT_DONE
+    export_run.date_finished = datetime.now(timezone.utc)
+    fence(db_session, export_run, lease)
+    db_session.commit()
+    return export_run.file_path
+
+def fence(db_session, export_run, lease):
+    """
+        stamps an export run with the lease's fencing token, renewing the
+        lease when due.  rolls back and raises LeaseLost when a worker
+        holding a later lease wrote the run since
+    """
+    if lease is None or lease.token is None:
+        return
+    lease.heartbeat()
+    if not fence_export(db_session, export_run, lease.token):
+        db_session.rollback()
+        raise LeaseLost(export_run.file_path + " taken over from lease token " +\
+                str(lease.token))
+
+def write_csv_rows(stream, submissions, ids):
+    """writes a csv line per submission"""
+    for submission in submissions:
+        # generate data
+        data = [submission.id]
+        data_json = json.loads(submission.data)
+        for form_id in ids:
+            if form_id in data_json:
+                data.append(data_json[form_id])
+            else:
+                data.append(None)
+        quoted_data = [quote_strings(val) for val in data]
+        stream.write(('|'.join(str(val) for val in quoted_data) + '\n').encode('utf-8'))
 
 def quote_strings(val):
     """
@@ -1,17 +1,52 @@
-# pylint: disable=redefined-outer-name
+# pylint: disable=redefined-outer-name, too-many-lines
 """Tests for microservice"""
 import os
 import os.path
+import sys
 import json
-from unittest.mock import patch
+import gzip
+import pickle
+import ftplib
+import queue as queue_module
+import hashlib
+import threading
+import subprocess
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock, DEFAULT
 # import pprint
 import jsend
 import pytest
+import sqlalchemy
+import falcon
+import redis
+import fakeredis
+import sentry_sdk
+from sqlalchemy.pool import QueuePool
 from falcon import testing
 import tasks
+import celeryconfig
+import worker
 import service.microservice
-from service.resources.submission_model import Submission, ExternalId, create_submission
-from service.resources.db_session import create_session
+from service.resources.submission_model import Submission, ExternalId, Dispatch, DeadLetter,\
+        ExportRun, SubmissionArchive, EXPORT_RUNNING, EXPORT_DONE, archive_partition,\
+        set_dispatch_state, DISPATCH_QUEUED, BASE,\
+        create_submission, claim_dispatch, insert_dispatch, DISPATCH_FAILED, DISPATCH_DONE,\
+        DISPATCH_IN_FLIGHT, DISPATCH_PENDING, SubmissionAmendment, amend_submission,\
+        unsettled_dispatches
+from service.resources.external_systems import MAP
+from service.resources.registry import Registry, RegistryError, CONFIG_ENV, get_registry,\
+        swap
+from service.resources.csv_delivery import FtpDelivery, ExportStream
+from service.resources.db_session import create_session, pool_usage, dispose_engine
+from service.resources.validation import Validator, ValidationError
+from service.resources.submission import read_body
+from service.resources.stats import StatsResource, dispatch_counts
+from service.resources.reconcile import ExternalSort
+from service.resources.callback import sign, SIGNATURE_HEADER
+from service.resources.error_reporting import ErrorReporter, get_reporter, sentry_transport
+from service.resources.lease import Lease, LeaseLost, get_client as get_lease_client
+from service.resources.throttle import RateLimiter, LoadShedder, ThrottleMiddleware,\
+        celery_queue_depth
 from tasks import celery_app as queue, dispatch
 
 CLIENT_HEADERS = {
@@ -27,6 +62,9 @@ EXTERNAL_RESPONSE = """{
 
 HEADERS = {"Content-Type": "application/json"}
 
+# microseconds the web process may spend importing service.microservice
+IMPORT_TIME_BUDGET_US = int(os.environ.get('IMPORT_TIME_BUDGET_US', 500000))
+
 # shortening the timeout
 MOCK_EXTERNAL_SYSTEMS = {
     "dbi":{
@@ -46,6 +84,7 @@ MOCK_EXTERNAL_SYSTEMS = {
         ],
         "dependants": {
             "fire": {
+                "type": "api",
                 "env_var": "FIRE_SYSTEM_URL",
                 "template": {
                     "name": "fire template"
@@ -65,6 +104,7 @@ MOCK_EXTERNAL_SYSTEMS = {
         "max_retry": 3,
         "dependants": {
             "fake_dependant": {
+                "type": "api",
                 "env_var": "FIRE_SYSTEM_URL",
                 "template": {
                     "name": "fire template"
@@ -102,6 +142,15 @@ def mock_env_access_key(monkeypatch):
     """ mock environment access key """
     monkeypatch.setenv("ACCESS_KEY", CLIENT_HEADERS["ACCESS_KEY"])
 
+@pytest.fixture
+def mock_registry(mock_external_system_env, monkeypatch):
+    # pylint: disable=unused-argument
+    """ fixture swapping in a registry compiled from the mock external systems """
+    monkeypatch.delenv(CONFIG_ENV, raising=False)
+    registry = Registry(MOCK_EXTERNAL_SYSTEMS, version=1)
+    monkeypatch.setattr('service.resources.registry.REGISTRY', registry)
+    return registry
+
 @pytest.fixture
 def mock_env_no_access_key(monkeypatch):
     """ mock environment with no access key """
@@ -162,6 +211,8 @@ def test_create_submission(client, mock_env_access_key, mock_external_system_env
 
     response_json = json.loads(response.text)
     assert isinstance(response_json["data"]["submission_id"], int)
+    # the default mapping has no api system at the top, nothing is published
+    assert response_json["data"]["group_id"] is None
 
     # Test submission request with no ACCESS_KEY in header
     client_no_access_key = testing.TestClient(service.microservice.start_service())
@@ -187,7 +238,8 @@ def test_create_submission_no_block_lot(client, mock_env_access_key, mock_extern
         response = client.simulate_post('/submissions',\
                 json=body,\
                 headers=HEADERS)
-    assert response.status_code == 500
+    assert response.status_code == 400
+    assert response.json['data']['errors']['lot'] == "is required"
 
     # only block
     body = {
@@ -201,7 +253,8 @@ def test_create_submission_no_block_lot(client, mock_env_access_key, mock_extern
         response = client.simulate_post('/submissions',\
                 json=body,\
                 headers=HEADERS)
-    assert response.status_code == 500
+    assert response.status_code == 400
+    assert response.json['data']['errors']['lot'] == "is required"
 
     # only lot
     body = {
@@ -215,9 +268,16 @@ def test_create_submission_no_block_lot(client, mock_env_access_key, mock_extern
         response = client.simulate_post('/submissions',\
                 json=body,\
                 headers=HEADERS)
-    assert response.status_code == 500
+    assert response.status_code == 400
+    assert response.json['data']['errors'] == {"block": "is required"}
+
+    # bodies which are not json are refused the same way
+    for body in (b'{"block": ', b'\xff\xfe'):
+        response = client.simulate_post('/submissions', body=body, headers=HEADERS)
+        assert response.status_code == 400
+        assert response.json['message'].startswith("Invalid submission: ")
 
-def test_schedule_submission_continuation(mock_external_system_env):
+def test_schedule_submission_continuation(mock_registry):
     # pylint: disable=unused-argument
     """
         tests the case where a submission already exists in the db
@@ -235,11 +295,10 @@ def test_schedule_submission_continuation(mock_external_system_env):
         mock_post.return_value.status_code = 200
         mock_post.return_value.text = EXTERNAL_RESPONSE
 
-        with patch('service.resources.external_systems.MAP', MOCK_EXTERNAL_SYSTEMS):
-            jobs_scheduled = tasks.schedule(s, MOCK_EXTERNAL_SYSTEMS)
+        jobs_scheduled = tasks.schedule(s)
 
-    # two jobs should be scheduled, planning
-    assert len(jobs_scheduled) == 1
+    # two jobs should be scheduled, planning and fire
+    assert len(jobs_scheduled) == 2
     db.close()
 
     # clear out the queue
@@ -249,7 +308,7 @@ def test_submission_post_error(client, mock_env_access_key, mock_external_system
     # pylint: disable=unused-argument
     """test when error in submission post"""
 
-    with patch('tasks.schedule') as mock_schedule:
+    with patch('service.resources.submission.schedule') as mock_schedule:
         mock_schedule.side_effect = Exception("Generic Error")
 
         response = client.simulate_post('/submissions',\
@@ -260,7 +319,7 @@ def test_submission_post_error(client, mock_env_access_key, mock_external_system
     # clear out the queue
     queue.control.purge()
 
-def test_tasks(mock_env_access_key, mock_external_system_env):
+def test_tasks(mock_env_access_key, mock_registry):
     # pylint: disable=unused-argument
     """test happy path for queue tasks"""
 
@@ -268,15 +327,14 @@ def test_tasks(mock_env_access_key, mock_external_system_env):
     db = session() # pylint: disable=invalid-name
     s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
 
-    with patch('service.resources.external_systems.MAP', MOCK_EXTERNAL_SYSTEMS):
-        with patch('tasks.requests.post') as mock_post:
-            mock_post.return_value.status_code = 200
-            mock_post.return_value.text = EXTERNAL_RESPONSE
+    with patch('tasks.requests.post') as mock_post:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.text = EXTERNAL_RESPONSE
 
-            external_code = "planning"
-            dispatch.s(external_code=external_code,\
-                    external_system=MOCK_EXTERNAL_SYSTEMS[external_code],\
-                    submission_obj=s).apply()
+        external_code = "planning"
+        dispatch.s(external_code=external_code,\
+                registry_version=mock_registry.version,\
+                submission_obj=s).apply()
 
     # verify submission exists in db
     sub = db.query(Submission).filter(Submission.id == s.id)
@@ -291,7 +349,7 @@ def test_tasks(mock_env_access_key, mock_external_system_env):
     # clear out the queue
     queue.control.purge()
 
-def test_external_404(mock_env_access_key, mock_external_system_env):
+def test_external_404(mock_env_access_key, mock_registry):
     # pylint: disable=unused-argument
     """test that failed jobs get rescheduled"""
 
@@ -299,16 +357,15 @@ def test_external_404(mock_env_access_key, mock_external_system_env):
     db = session() # pylint: disable=invalid-name
     s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
 
-    with patch('service.resources.external_systems.MAP', MOCK_EXTERNAL_SYSTEMS):
-        with patch('tasks.requests.post') as mock_post:
-            mock_post.return_value.status_code = 404
+    with patch('tasks.requests.post') as mock_post:
+        mock_post.return_value.status_code = 404
 
-            external_code = "planning"
-            # schedule(s, MOCK_EXTERNAL_SYSTEMS)
-            # monkeypatch.setattr(queue.task.Context, 'called_directly', False)
-            dispatch.s(external_code=external_code,\
-                    external_system=MOCK_EXTERNAL_SYSTEMS[external_code],\
-                    submission_obj=s).apply()
+        external_code = "planning"
+        # schedule(s)
+        # monkeypatch.setattr(queue.task.Context, 'called_directly', False)
+        dispatch.s(external_code=external_code,\
+                registry_version=mock_registry.version,\
+                submission_obj=s).apply()
 
     celery_inspect = queue.control.inspect()
     jobs_reserved = celery_inspect.reserved()
@@ -332,17 +389,22 @@ def test_external_404(mock_env_access_key, mock_external_system_env):
     db.close()
     queue.control.purge()
 
-def test_missing_env_var(mock_env_access_key, mock_external_system_env):
+def test_missing_env_var(mock_env_access_key, mock_registry):
     # pylint: disable=unused-argument
     """test that exception is thrown when env_var is missing in the mapping"""
 
     mapping = {
-        "template": {
-            "name": "planning template"
-        },
-        "timeout": 3,
-        "max_retry": 3
+        "planning": {
+            "type": "api",
+            "template": {
+                "name": "planning template"
+            },
+            "timeout": 3,
+            "max_retry": 3
+        }
     }
+    with pytest.raises(RegistryError):
+        Registry(mapping)
 
     session = create_session()
     db = session() # pylint: disable=invalid-name
@@ -351,9 +413,11 @@ def test_missing_env_var(mock_env_access_key, mock_external_system_env):
         mock_post.return_value.status_code = 200
         mock_post.return_value.text = EXTERNAL_RESPONSE
 
-        dispatch.s("planning",\
-                external_system=mapping,\
+        # systems missing from the registry are never posted to
+        dispatch.s("retired",\
+                registry_version=mock_registry.version,\
                 submission_obj=s).apply()
+    mock_post.assert_not_called()
 
     # check db that no external requests were recorded
     ext_ids = db.query(ExternalId)\
@@ -377,7 +441,8 @@ def test_create_csv(mock_env_access_key, mock_external_system_env):
     tasks.outbound_csv.s().apply()
     new_num_files = file_count_dir(tasks.CSV_DIR)
 
-    assert current_num_files == new_num_files - 1
+    # the csv and its checksum
+    assert current_num_files == new_num_files - 2
 
     db.refresh(submission1)
     db.refresh(submission2)
@@ -396,3 +461,1364 @@ def test_process_csv_response(mock_env_access_key, mock_external_system_env):
     # pylint: disable=unused-argument
     """test processing inbound csv"""
     tasks.inbound_csv.s().apply()
+
+def test_rate_limit(mock_env_access_key, monkeypatch):
+    # pylint: disable=unused-argument
+    """test that a client is throttled once its bucket is empty"""
+    monkeypatch.setenv("RATE_LIMIT_PER_SECOND", "1")
+    monkeypatch.setenv("RATE_LIMIT_BURST", "2")
+    client = testing.TestClient(app=service.microservice.start_service(), headers=CLIENT_HEADERS)
+
+    # the access key is not limited by default, it is shared by every legitimate client
+    for _ in range(5):
+        assert client.simulate_get('/welcome').status_code == 200
+
+    # anything else is limited by address, whatever key it makes up
+    for status in (403, 403, 429):
+        response = client.simulate_get('/welcome', headers={"ACCESS_KEY": str(status) + "?"},\
+                remote_addr="10.0.0.1")
+        assert response.status_code == status
+    assert response.headers['retry-after'] == '1'
+    response = client.simulate_get('/welcome', headers={"ACCESS_KEY": ""}, remote_addr="10.0.0.2")
+    assert response.status_code == 403
+
+    # behind a proxy the address it saw is used, not the ones the client claims
+    monkeypatch.setenv("RATE_LIMIT_PROXIES", "1")
+    client = testing.TestClient(app=service.microservice.start_service(), headers={})
+    for status, claimed in ((403, "1.1.1.1"), (403, "2.2.2.2"), (429, "3.3.3.3")):
+        assert client.simulate_get('/welcome', remote_addr="10.0.0.9", headers={\
+                "X-Forwarded-For": claimed + ", 192.0.2.1"}).status_code == status
+    assert client.simulate_get('/welcome', remote_addr="10.0.0.9",\
+            headers={"X-Forwarded-For": "192.0.2.2"}).status_code == 403
+
+    # the access key's bucket is sized separately
+    monkeypatch.setenv("RATE_LIMIT_KEY_PER_SECOND", "1")
+    monkeypatch.setenv("RATE_LIMIT_KEY_BURST", "1")
+    client = testing.TestClient(app=service.microservice.start_service(), headers=CLIENT_HEADERS)
+    assert client.simulate_get('/welcome').status_code == 200
+    assert client.simulate_get('/welcome').status_code == 429
+
+    # disabled limiter
+    monkeypatch.setenv("RATE_LIMIT_PER_SECOND", "0")
+    assert RateLimiter.from_env() is None
+
+def test_token_bucket_refill():
+    """test that buckets refill over time and the least recent clients are evicted"""
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=1, clock=lambda: now[0])
+    assert limiter.check("a") == 0
+    assert limiter.check("a") == 0.5
+    now[0] = 0.5
+    assert limiter.check("a") == 0
+
+    with patch('service.resources.throttle.MAX_CLIENTS', 2):
+        limiter.check("b")
+        assert limiter.check("a") == 0.5
+        limiter.check("c")
+        assert list(limiter.buckets) == ["a", "c"]
+        # busy clients are evicted too, the number of buckets stays capped
+        for client_number in range(100):
+            limiter.check(str(client_number))
+        assert list(limiter.buckets) == ["98", "99"]
+
+def test_load_shedding(client, mock_env_access_key, mock_external_system_env):
+    # pylint: disable=unused-argument
+    """test that db resources are shed while the queue or db pool is overloaded"""
+    depth = [0]
+    usage = [0.0]
+    shedder = LoadShedder(queue_depth=lambda: depth[0], max_queue_depth=10,\
+            pool_usage_probe=lambda: usage[0], max_pool_usage=0.9, check_interval=0)
+    throttle = ThrottleMiddleware(shedder=shedder)
+    with patch('service.microservice.ThrottleMiddleware', return_value=throttle):
+        client = testing.TestClient(app=service.microservice.start_service(),\
+                headers=CLIENT_HEADERS)
+
+    depth[0] = 10
+    response = client.simulate_post('/submissions', json=STANDARD_SUBMISSION_JSON, headers=HEADERS)
+    assert response.status_code == 503
+    # resources without db access are never shed
+    assert client.simulate_get('/welcome').status_code == 200
+
+    depth[0] = 0
+    usage[0] = 0.95
+    response = client.simulate_post('/submissions', json=STANDARD_SUBMISSION_JSON, headers=HEADERS)
+    assert response.status_code == 503
+
+    # failing probes let requests through
+    def broken_probe():
+        raise ConnectionError("broker down")
+    shedder.queue_depth = broken_probe
+    assert shedder.overloaded() is None
+
+    # clear out the queue
+    queue.control.purge()
+
+def test_celery_queue_depth(mock_registry, monkeypatch):
+    # pylint: disable=unused-argument
+    """test queue depth probe and pool usage against the configured backends"""
+    monkeypatch.setenv("SHED_QUEUE_DEPTH", "2")
+    shedder = LoadShedder.from_env()
+    assert shedder.max_queue_depth == 2
+    queue.control.purge()
+    assert shedder.probe() is None
+
+    # dispatches wait on their system's queue, or the default one
+    monkeypatch.setattr(celeryconfig, 'DISPATCH_CODES', ('planning',))
+    queue.send_task('tasks.dispatch', args=("planning", 1, 1))
+    queue.send_task('tasks.dispatch', args=("fire", 1, 1))
+    assert celery_queue_depth() == 2
+    assert shedder.probe() == 'job queue is full'
+    queue.control.purge()
+
+def test_pool_usage():
+    """test db pool usage for queue pools and pools without a limit"""
+    queue_pool_engine = sqlalchemy.create_engine('sqlite://', poolclass=QueuePool,\
+            pool_size=2, max_overflow=2)
+    with patch('service.resources.db_session.ENGINE', queue_pool_engine):
+        assert pool_usage() == 0
+        conn = queue_pool_engine.connect()
+        assert pool_usage() == 0.25
+        conn.close()
+    with patch('service.resources.db_session.ENGINE', sqlalchemy.create_engine('sqlite://')):
+        assert pool_usage() == 0
+
+def test_dispose_engine():
+    """test that the pool is replaced after a fork while the engine is kept"""
+    session = create_session()
+    pool = session.kw['bind'].pool # pylint: disable=no-member
+    dispose_engine()
+    assert session.kw['bind'].pool is not pool # pylint: disable=no-member
+    db = session() # pylint: disable=invalid-name
+    assert db.query(Submission).count() >= 0
+    db.close()
+
+def test_lazy_session(mock_env_access_key, mock_external_system_env):
+    # pylint: disable=unused-argument
+    """test that sessions are only opened by requests which use the db"""
+    session_factory = MagicMock()
+    with patch('service.microservice.create_session', return_value=session_factory):
+        client = testing.TestClient(app=service.microservice.start_service(),\
+                headers=CLIENT_HEADERS)
+
+    assert client.simulate_get('/welcome').status_code == 200
+    assert client.simulate_get('/some_page_that_does_not_exist').status_code == 404
+    assert not session_factory.called
+
+    client.simulate_post('/submissions', json=STANDARD_SUBMISSION_JSON, headers=HEADERS)
+    assert session_factory.call_count == 1
+    session_factory.return_value.commit.assert_called()
+    session_factory.return_value.close.assert_called_once()
+
+    # clear out the queue
+    queue.control.purge()
+
+def test_session_rollback():
+    """test that the session is rolled back when the request fails"""
+    session_factory = MagicMock()
+    manager = service.microservice.SQLAlchemySessionManager(session_factory)
+    req = MagicMock(context=service.microservice.SessionContext())
+    manager.process_request(req, None)
+    session = req.context.session
+    assert req.context.session is session
+    assert session_factory.call_count == 1
+    manager.process_response(req, None, None, False)
+    session_factory.return_value.rollback.assert_called_once()
+    session_factory.return_value.commit.assert_not_called()
+    session_factory.return_value.close.assert_called_once()
+
+def test_import_time():
+    """test that the web process stays clear of worker-only imports on startup"""
+    env = dict(os.environ)
+    env.pop('REDIS_URL', None)
+    env.pop('SENTRY_DSN', None)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',\
+            'import service.microservice'], env=env, stdout=subprocess.PIPE,\
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    # lines look like "import time:  self [us] | cumulative | imported package"
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            cumulative[fields[2].strip()] = int(fields[1])
+
+    for module in ['tasks', 'celeryconfig', 'celery', 'kombu', 'requests', 'sentry_sdk']:
+        assert module not in cumulative
+    assert cumulative['service.microservice'] < IMPORT_TIME_BUDGET_US
+
+def test_sentry(client, mock_env_access_key, monkeypatch):
+    # pylint: disable=unused-argument
+    """test that sentry is only loaded when a dsn is configured"""
+    monkeypatch.setenv("SENTRY_DSN", "https://key@sentry.example.com/1")
+    with patch('sentry_sdk.init') as mock_init:
+        client = testing.TestClient(app=service.microservice.start_service(),\
+                headers=CLIENT_HEADERS)
+    mock_init.assert_called_once_with("https://key@sentry.example.com/1")
+
+    # 404 floods are one event in the background, the rest only counted
+    monkeypatch.setattr('service.resources.error_reporting.REPORTER', None)
+    monkeypatch.setenv('ERROR_FLUSH_SECONDS', '0')
+    with patch('sentry_sdk.capture_message') as mock_capture:
+        for path in ('/wp-admin', '/.env', '/some_page_that_does_not_exist'):
+            response = client.simulate_get(path)
+            assert response.status_code == 404
+        get_reporter().flush()
+    mock_capture.assert_called_once_with('404 - Not Found: GET /wp-admin', level='info')
+    response = client.simulate_get('/submissions/stats')
+    assert response.json['data']['errors']['deduplicated'] == 2
+    assert response.json['data']['errors']['sent'] == 1
+    get_reporter().close()
+
+def test_error_reporter():
+    """test sampling, dedup windows and batching of error reports"""
+    now = [0.0]
+    draws = iter([0.1, 0.9, 0.1, 0.1, 0.1, 0.1])
+    batches = []
+    reporter = ErrorReporter(batches.append, sample_rate=0.5, dedup_seconds=10,\
+            batch_size=2, flush_seconds=0, clock=lambda: now[0], rng=lambda: next(draws))
+    assert reporter.report("boom")
+    assert not reporter.report("boom")
+    assert not reporter.report("boom")
+    # the window is over, but this one is sampled out
+    now[0] = 11
+    assert not reporter.report("boom")
+    assert reporter.report("boom")
+    assert reporter.report("bang", fingerprint="bang", level="warning")
+    reporter.flush()
+    events = [event for batch in batches for event in batch]
+    assert [(event['message'], event['repeats']) for event in events] ==\
+            [("boom", 0), ("boom", 2), ("bang", 0)]
+    assert all(len(batch) <= 2 for batch in batches)
+    assert reporter.counters == {"reported": 6, "sampled_out": 1, "deduplicated": 2,\
+            "dropped": 0, "sent": 3, "failed": 0}
+
+    # transport failures are counted, and the oldest fingerprints make way
+    reporter.transport = MagicMock(side_effect=ConnectionError("sentry down"))
+    with patch('service.resources.error_reporting.MAX_FINGERPRINTS', 2):
+        assert reporter.report("crash")
+    reporter.flush()
+    assert list(reporter.windows) == ["bang", "crash"]
+    assert reporter.counters["failed"] == 1
+    with patch.object(reporter.queue, 'put_nowait', side_effect=queue_module.Full):
+        assert not reporter.report("full")
+    assert reporter.counters["dropped"] == 1
+    reporter.close()
+    assert not reporter.thread.is_alive()
+
+    # sentry gets each event with its fingerprint and repeats
+    with patch('sentry_sdk.capture_message') as mock_capture:
+        sentry_transport([{"message": "boom", "fingerprint": "boom", "level": "error",\
+                "repeats": 2}])
+    mock_capture.assert_called_once_with("boom", level="error")
+    sent = []
+    with sentry_sdk.init("https://key@sentry.example.com/1", transport=sent.append):
+        sentry_transport([{"message": "bang", "fingerprint": "bang", "level": "warning",\
+                "repeats": 3}])
+    assert [(event['message'], event['level'], event['fingerprint'], event['extra']['repeats'])\
+            for event in sent] == [("bang", "warning", ["bang"], 3)]
+
+def test_schedule_deduplication(mock_registry):
+    # pylint: disable=unused-argument
+    """test that a submission is only queued once per external system"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
+
+    with patch.object(queue, 'send_task', wraps=queue.send_task) as mock_send:
+        jobs = tasks.schedule(s)
+    # both systems go out in one group, over one producer
+    assert len(jobs) == 2
+    assert {job.id for job in jobs} == {call[1]['task_id'] for call in mock_send.call_args_list}
+    assert {call[1]['group_id'] for call in mock_send.call_args_list} == {jobs.id}
+    assert len({id(call[1]['producer']) for call in mock_send.call_args_list}) == 1
+    assert not tasks.schedule(s)
+
+    # a failed enqueue releases the system for the next schedule
+    s2 = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)
+    with patch.object(queue, 'send_task', side_effect=ConnectionError("broker down")):
+        with pytest.raises(ConnectionError):
+            tasks.schedule(s2, ["planning"])
+    ledger = db.query(Dispatch).filter(Dispatch.submission_id == s2.id).one()
+    assert ledger.state == DISPATCH_FAILED
+    assert len(tasks.schedule(s2, ["planning"])) == 1
+
+    db.close()
+    # clear out the queue
+    queue.control.purge()
+
+def test_claim_dispatch():
+    """test that only one worker can claim a dispatch"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
+
+    # jobs queued before the ledger existed are claimed by inserting
+    assert claim_dispatch(db, s.id, "planning", 600)
+    assert not claim_dispatch(db, s.id, "planning", 600)
+    assert not insert_dispatch(db, s.id, "planning", DISPATCH_IN_FLIGHT)
+
+    # a dispatch abandoned by a dead worker can be taken over
+    assert claim_dispatch(db, s.id, "planning", -1)
+    ledger = db.query(Dispatch).filter(Dispatch.submission_id == s.id).one()
+    assert ledger.attempts == 2
+
+    s.create_external_id(db_session=db, external_system="planning", external_id=1)
+    db.refresh(ledger)
+    assert ledger.state == DISPATCH_DONE
+    assert not claim_dispatch(db, s.id, "planning", -1)
+    db.close()
+
+def test_dispatch_duplicate_dropped(mock_env_access_key, mock_registry):
+    # pylint: disable=unused-argument
+    """test that a dispatch claimed by another worker never reaches the external system"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
+    assert claim_dispatch(db, s.id, "planning", 600)
+
+    with patch('tasks.requests.post') as mock_post:
+        dispatch.s(external_code="planning",\
+                registry_version=mock_registry.version,\
+                submission_obj=s).apply()
+    mock_post.assert_not_called()
+    db.close()
+
+def test_task_routing(monkeypatch):
+    """test that dispatches are routed per external system and csv jobs to the batch queue"""
+    monkeypatch.setattr(celeryconfig, 'DISPATCH_CODES', ('planning', 'fire'))
+    assert celeryconfig.route_task('tasks.dispatch', ('planning', {}, None), {}, {}) ==\
+            {'queue': 'dispatch.planning'}
+    assert celeryconfig.route_task('tasks.dispatch', (), {'external_code': 'fire'}, {}) ==\
+            {'queue': 'dispatch.fire'}
+    # a system added since the workers started has no queue they consume
+    assert celeryconfig.route_task('tasks.dispatch', ('new', {}, None), {}, {}) ==\
+            {'queue': 'celery'}
+    assert celeryconfig.route_task('tasks.outbound-csv', (), {}, {}) == {'queue': 'batch'}
+    assert celeryconfig.route_task('tasks.other', (), {}, {}) is None
+    assert list(Registry(MOCK_EXTERNAL_SYSTEMS).of_type('api')) ==\
+            ['planning', 'fire', 'fake_dependant']
+
+def test_worker_main(monkeypatch):
+    """test that the workers are stopped as soon as any one of them exits"""
+    monkeypatch.setattr(worker, 'POLL_SECONDS', 0.01)
+    monkeypatch.setattr(worker, 'worker_commands', lambda registry, environ: [\
+            [sys.executable, '-c', 'import time; time.sleep(30)'],\
+            [sys.executable, '-c', 'import sys; sys.exit(3)']])
+    started = datetime.now()
+    with patch('signal.signal'), pytest.raises(SystemExit) as exit_info:
+        worker.main()
+    assert exit_info.value.code == 3
+    assert datetime.now() - started < timedelta(seconds=10)
+
+def test_worker_commands():
+    """test that the launcher starts a worker per queue with its own concurrency"""
+    systems = {"planning": dict(MOCK_EXTERNAL_SYSTEMS["planning"], concurrency=5)}
+    systems["planning"]["dependants"] = {"fire": MOCK_EXTERNAL_SYSTEMS["dbi"]["dependants"]["fire"]}
+    commands = worker.worker_commands(Registry(systems), {"CELERY_CONCURRENCY_FIRE": "7"})
+    queues = {command[3]: command[4] for command in commands}
+    assert queues == {
+        '--queues=celery': '--concurrency=2',
+        '--queues=batch': '--concurrency=1',
+        '--queues=dispatch.planning': '--concurrency=5',
+        '--queues=dispatch.fire': '--concurrency=7'
+    }
+
+def test_dead_letter_replay(mock_env_access_key, mock_registry):
+    # pylint: disable=unused-argument
+    """test that exhausted dispatches are recorded and can be replayed"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    # leave out dead letters from other tests
+    db.query(DeadLetter).update({DeadLetter.date_replayed: datetime.now(timezone.utc)})
+    db.commit()
+    s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
+
+    with patch('tasks.requests.post') as mock_post:
+        mock_post.return_value.status_code = 503
+        mock_post.return_value.text = "down for maintenance"
+        dispatch.s(external_code="planning",\
+                registry_version=mock_registry.version,\
+                submission_obj=s).apply()
+
+    dead_letter = db.query(DeadLetter).filter(DeadLetter.submission_id == s.id).one()
+    assert dead_letter.external_system == "planning"
+    assert dead_letter.error_class == "SystemError"
+    assert dead_letter.last_status == 503
+    assert dead_letter.last_response == "down for maintenance"
+    assert dead_letter.attempts == dispatch.max_retries + 1
+
+    # a dead letter for a system which is no longer mapped is only marked replayed
+    db.add(DeadLetter(submission_id=s.id, external_system="retired", error_class="ValueError",\
+            attempts=1))
+    db.commit()
+
+    with patch.object(queue, 'send_task') as mock_send:
+        assert tasks.replay_dead_letters.s(external_system="fire").apply().get() == 0
+        assert tasks.replay_dead_letters.s(batch_size=1, rate=2).apply().get() == 1
+        assert tasks.replay_dead_letters.s().apply().get() == 0
+    assert mock_send.call_count == 1
+    assert mock_send.call_args[0][1][0] == "planning"
+
+    db.refresh(dead_letter)
+    assert dead_letter.date_replayed is not None
+    db.close()
+
+def test_create_csv_resume(mock_env_access_key, mock_external_system_env):
+    # pylint: disable=unused-argument
+    """test that an interrupted export resumes from its last checkpoint"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    # leave out submissions from other tests
+    db.query(Submission).filter(Submission.csv_date_processed.is_(None))\
+            .update({Submission.csv_date_processed: datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    submissions = [create_submission(db_session=db, json_data=dict(STANDARD_SUBMISSION_JSON,\
+            first_name="applicant " + str(i))) for i in range(3)]
+
+    # die while writing the second chunk, after some bytes hit the file
+    write_csv_rows = tasks.write_csv_rows
+    def crash_on_second_chunk(csv_file, chunk, ids):
+        if chunk[0].id != submissions[0].id:
+            csv_file.write(b"half a row")
+            raise RuntimeError("worker died")
+        write_csv_rows(csv_file, chunk, ids)
+
+    with patch('tasks.CSV_CHUNK_SIZE', 1):
+        with patch('tasks.write_csv_rows', side_effect=crash_on_second_chunk):
+            with pytest.raises(RuntimeError):
+                tasks.outbound_csv.s().apply().get()
+
+        export_run = db.query(ExportRun).order_by(ExportRun.id.desc()).first()
+        assert export_run.status == EXPORT_RUNNING
+        assert export_run.checkpoint_id == submissions[0].id
+        assert export_run.rows_written == 1
+        assert not os.path.exists(export_run.file_path)
+        assert os.path.exists(export_run.file_path + tasks.PARTIAL_SUFFIX)
+
+        tasks.outbound_csv.s().apply().get()
+
+    db.refresh(export_run)
+    assert export_run.status == EXPORT_DONE
+    assert export_run.rows_written == 3
+    assert not os.path.exists(export_run.file_path + tasks.PARTIAL_SUFFIX)
+    with open(export_run.file_path) as csv_file:
+        lines = csv_file.read().splitlines()
+    assert lines[0].startswith('adu_id|Own the property|')
+    assert [line.split('|')[0] for line in lines[1:]] ==\
+            [str(submission.id) for submission in submissions]
+    assert '"applicant 1"' in lines[2]
+
+    # renamed into place but not yet marked done
+    export_run.status = EXPORT_RUNNING
+    db.commit()
+    tasks.outbound_csv.s().apply().get()
+    db.refresh(export_run)
+    assert export_run.status == EXPORT_DONE
+
+    # partial file lost
+    export_run.status = EXPORT_RUNNING
+    db.commit()
+    os.remove(export_run.file_path)
+    with pytest.raises(IOError):
+        tasks.outbound_csv.s().apply().get()
+    export_run.status = EXPORT_DONE
+    db.commit()
+    db.close()
+
+@pytest.fixture
+def ftp_server(tmp_path, monkeypatch):
+    """ fixture running an ftp server for dbi csvs on a temp dir """
+    authorizers = pytest.importorskip('pyftpdlib.authorizers')
+    handlers = pytest.importorskip('pyftpdlib.handlers')
+    servers = pytest.importorskip('pyftpdlib.servers')
+    authorizer = authorizers.DummyAuthorizer()
+    authorizer.add_user('adu', 'secret', str(tmp_path), perm='elradfmwMT')
+    handler = type('Handler', (handlers.FTPHandler,), {'authorizer': authorizer})
+    server = servers.ThreadedFTPServer(('127.0.0.1', 0), handler)
+    stop = threading.Event()
+    def serve():
+        while not stop.is_set():
+            server.serve_forever(timeout=0.05, blocking=False)
+        server.close_all()
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    monkeypatch.setenv("DBI_FTP_SERVER", "{0}:{1}".format(*server.address))
+    monkeypatch.setenv("DBI_FTP_USER", "adu")
+    monkeypatch.setenv("DBI_FTP_PASSWD", "secret")
+    yield tmp_path
+    stop.set()
+    thread.join()
+
+def test_ftp_delivery(mock_env_access_key, ftp_server):
+    # pylint: disable=unused-argument
+    """test that csvs and their checksums are streamed to ftp, gzipped on request"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+
+    for compress in (False, True):
+        for i in range(3):
+            create_submission(db_session=db, json_data=dict(STANDARD_SUBMISSION_JSON,\
+                    first_name="applicant " + str(i)))
+        with patch('service.resources.registry.REGISTRY',\
+                Registry({"dbi": dict(MAP['dbi'], compress=compress)})),\
+                patch('tasks.CSV_CHUNK_SIZE', 2):
+            tasks.outbound_csv.s().apply().get()
+
+        export_run = db.query(ExportRun).order_by(ExportRun.id.desc()).first()
+        name = os.path.basename(export_run.file_path)
+        assert name.endswith('.csv.gz' if compress else '.csv')
+        with open(export_run.file_path, 'rb') as local_file:
+            local = local_file.read()
+        remote = (ftp_server / name).read_bytes()
+        assert remote == local
+        assert not (ftp_server / (name + '.partial')).exists()
+        checksum = (ftp_server / (name + '.sha256')).read_text()
+        assert checksum == hashlib.sha256(local).hexdigest() + '  ' + name + '\n'
+        with open(export_run.file_path + '.sha256') as checksum_file:
+            assert checksum_file.read() == checksum
+
+        # one gzip member per chunk, read back as a single stream
+        lines = (gzip.decompress(remote) if compress else remote).decode('utf-8').splitlines()
+        assert lines[0].startswith('adu_id|Own the property|')
+        assert '"applicant 2"' in lines[-1]
+    db.close()
+
+def test_ftp_connection_reuse(mock_env_access_key, ftp_server):
+    # pylint: disable=unused-argument
+    """test that csv systems on the same ftp server share a connection"""
+    with patch('service.resources.registry.REGISTRY',\
+            Registry({"dbi": MAP['dbi'], "dbi_copy": MAP['dbi']})):
+        with patch.object(ftplib.FTP, 'login', autospec=True, side_effect=ftplib.FTP.login)\
+                as mock_login:
+            tasks.outbound_csv.s().apply().get()
+    assert mock_login.call_count == 1
+    assert len(list(ftp_server.glob('*.sha256'))) == 2
+
+    # no ftp server configured
+    assert FtpDelivery.from_system({"ftp_server_var": "NO_SUCH_FTP_SERVER"}) is None
+
+def test_ftp_resume(ftp_server, tmp_path):
+    """test that uploads pick up after dropped connections and interrupted exports"""
+    delivery = FtpDelivery.from_system(MAP['dbi'])
+    block = os.urandom(50000)
+    local_path = str(tmp_path / 'local.csv')
+    with open(local_path, 'w+b') as local_file:
+        stream = ExportStream(local_file, upload=delivery.upload('remote.csv', local_file))
+        stream.resume(0)
+        stream.write(block)
+        stream.write(block)
+        # connection drops mid transfer
+        stream.upload.conn.close()
+        stream.write(block)
+        stream.checkpoint()
+        stream.write(block)
+        checksum = stream.close()
+    remote = (ftp_server / 'remote.csv').read_bytes()
+    assert remote == block * 4
+    assert checksum == hashlib.sha256(remote).hexdigest()
+
+    # an export interrupted after its checkpoint, the remote partial has
+    # bytes the local file dropped
+    delivery.put('again.csv.partial', block * 3)
+    with open(local_path, 'r+b') as local_file:
+        stream = ExportStream(local_file, upload=delivery.upload('again.csv', local_file))
+        stream.resume(len(block))
+        stream.write(block)
+        assert stream.close() == hashlib.sha256(block * 2).hexdigest()
+    assert (ftp_server / 'again.csv').read_bytes() == block * 2
+
+    # the server stays away
+    with open(local_path, 'r+b') as local_file:
+        stream = ExportStream(local_file, upload=delivery.upload('gone.csv', local_file))
+        stream.resume(0)
+        stream.upload.conn.close()
+        with patch.object(delivery, 'reconnect', side_effect=ftplib.error_temp('421 gone')):
+            with pytest.raises(ftplib.error_temp):
+                stream.write(block * 2)
+    with patch.object(ftplib.FTP, 'quit', side_effect=EOFError):
+        delivery.close()
+    assert delivery.ftp is None
+
+def test_archive_submissions(mock_env_access_key, mock_registry):
+    # pylint: disable=unused-argument, too-many-locals
+    """test that old finished submissions move to the archive"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    old = datetime.now(timezone.utc) - timedelta(days=400)
+    systems = list(mock_registry.of_type('api'))
+    def old_submission(processed=True, external_ids=None):
+        submission = Submission(data=json.dumps(STANDARD_SUBMISSION_JSON), date_created=old,\
+                csv_date_processed=old if processed else None)
+        db.add(submission)
+        db.commit()
+        for code in systems if external_ids is None else external_ids:
+            submission.create_external_id(db, code, code + "-" + str(submission.id))
+        return submission
+
+    finished = old_submission()
+    db.add(Dispatch(submission_id=finished.id, external_system="fire", state=DISPATCH_DONE,\
+            date_updated=old))
+    db.add(DeadLetter(submission_id=finished.id, external_system="fire",\
+            error_class="SystemError", attempts=4, date_replayed=old))
+    recent = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)
+    recent.csv_date_processed = old
+    unexported = old_submission(processed=False)
+    undispatched = old_submission(external_ids=["fire"])
+    failed = old_submission()
+    db.add(Dispatch(submission_id=failed.id, external_system="planning", state=DISPATCH_FAILED,\
+            date_updated=old))
+    dead = old_submission()
+    db.add(DeadLetter(submission_id=dead.id, external_system="planning",\
+            error_class="SystemError", attempts=4))
+    db.commit()
+    db.add(SubmissionAmendment(submission_id=finished.id, version=1,\
+            diff='{"block": ["1", "2"]}', external_systems='["fire"]', date_created=old))
+    db.commit()
+    kept = [recent.id, unexported.id, undispatched.id, failed.id, dead.id]
+    finished_id = finished.id
+    counts = dispatch_counts(db)
+
+    assert tasks.archive_submissions.s(batch_size=1).apply().get() == 1
+    assert tasks.archive_submissions.s().apply().get() == 0
+    db.expire_all()
+
+    archived = db.query(SubmissionArchive).filter(SubmissionArchive.id == finished_id).one()
+    assert json.loads(archived.data) == STANDARD_SUBMISSION_JSON
+    assert json.loads(archived.external_ids) == {code: code + "-" + str(finished_id)\
+            for code in systems}
+    assert json.loads(archived.amendments) == [{"version": 1, "diff": {"block": ["1", "2"]},\
+            "external_systems": ["fire"], "date_created": old.isoformat()}]
+    # archived dispatches still count
+    assert dispatch_counts(db) == counts
+    assert db.query(Submission).get(finished_id) is None
+    for model in (ExternalId, Dispatch, DeadLetter, SubmissionAmendment):
+        assert not db.query(model).filter(model.submission_id == finished_id).count()
+    assert db.query(Submission).filter(Submission.id.in_(kept)).count() == len(kept)
+
+    # postgres archives into a partition per year
+    pg_session = MagicMock()
+    pg_session.bind.dialect.name = 'postgresql'
+    archive_partition(pg_session, 2020)
+    assert "submission_archive_2020 PARTITION OF submission_archive FOR VALUES "\
+            "FROM ('2020-01-01 00:00:00+00') TO ('2021-01-01 00:00:00+00')"\
+            in pg_session.execute.call_args[0][0]
+    db.close()
+
+def test_get_submission(client, mock_env_access_key, mock_registry):
+    # pylint: disable=unused-argument
+    """test reading back a submission with its dispatch progress"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
+    insert_dispatch(db, s.id, "fire", DISPATCH_DONE)
+    insert_dispatch(db, s.id, "planning", DISPATCH_FAILED)
+    # ids recorded twice before they were replaced, the newest is read
+    db.add(ExternalId(submission_id=s.id, external_system="fire", external_id="f-0"))
+    db.commit()
+    s.create_external_id(db, "fire", "f-1")
+    db.add(ExternalId(submission_id=s.id, external_system="fire", external_id="f-2"))
+    db.commit()
+    s.create_external_id(db, "fire", "f-1")
+
+    response = client.simulate_get('/submissions/' + str(s.id))
+    assert response.status_code == 200
+    submission = response.json['data']
+    assert submission['submission_id'] == s.id
+    assert submission['external_ids'] == {"fire": "f-1"}
+    assert submission['dispatches'] == {"fire": DISPATCH_DONE, "planning": DISPATCH_FAILED}
+    assert submission['pending_systems'] == ["dbi", "fake_dependant", "planning"]
+    assert submission['data'] == STANDARD_SUBMISSION_JSON
+    assert not submission['archived']
+
+    # archived submissions are read from the archive
+    archived_id = db.query(sqlalchemy.func.max(Submission.id)).scalar() + 1000
+    db.add(SubmissionArchive(id=archived_id, date_created=datetime.now(timezone.utc),\
+            data=json.dumps(STANDARD_SUBMISSION_JSON), external_ids='{"fire": "f-2"}'))
+    db.commit()
+    response = client.simulate_get('/submissions/' + str(archived_id))
+    assert response.status_code == 200
+    assert response.json['data']['archived']
+    assert response.json['data']['external_ids'] == {"fire": "f-2"}
+    assert response.json['data']['pending_systems'] == []
+
+    response = client.simulate_get('/submissions/' + str(archived_id + 1))
+    assert response.status_code == 404
+    db.close()
+
+def test_list_submissions(client, mock_env_access_key):
+    # pylint: disable=unused-argument
+    """test paging through submissions"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    after = db.query(sqlalchemy.func.max(Submission.id)).scalar() or 0
+    submissions = [create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)\
+            for _ in range(3)]
+    submissions[0].create_external_id(db, "fire", "f-1")
+    ids = [submission.id for submission in submissions]
+
+    response = client.simulate_get('/submissions', params={'after': after, 'limit': 2})
+    assert response.status_code == 200
+    page = response.json['data']
+    assert [row['submission_id'] for row in page['submissions']] == ids[:2]
+    assert page['submissions'][0]['external_ids'] == {"fire": "f-1"}
+    assert 'data' not in page['submissions'][0]
+    assert page['next_after'] == ids[1]
+
+    response = client.simulate_get('/submissions', params={'after': page['next_after'],\
+            'since': '2000-01-01T00:00:00'})
+    page = response.json['data']
+    assert [row['submission_id'] for row in page['submissions']] == ids[2:]
+    assert page['next_after'] is None
+
+    response = client.simulate_get('/submissions', params={'since': '2999-01-01'})
+    assert response.json['data']['submissions'] == []
+
+    for params in ({'since': 'yesterday'}, {'limit': 0}, {'after': 'x'}):
+        response = client.simulate_get('/submissions', params=params)
+        assert response.status_code == 400
+    db.close()
+
+def test_dispatch_stats(client, mock_env_access_key):
+    # pylint: disable=unused-argument
+    """test that dispatch counts follow the ledger and are cached"""
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    before = dispatch_counts(db)
+    def delta(code, state):
+        return dispatch_counts(db).get(code, {}).get(state, 0) -\
+                before.get(code, {}).get(state, 0)
+
+    s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
+    insert_dispatch(db, s.id, "stats", DISPATCH_QUEUED)
+    insert_dispatch(db, s.id, "other", DISPATCH_QUEUED)
+    assert delta("stats", DISPATCH_QUEUED) == 1
+    set_dispatch_state(db, s.id, "stats", DISPATCH_DONE)
+    db.commit()
+    assert delta("stats", DISPATCH_QUEUED) == 0
+    assert delta("stats", DISPATCH_DONE) == 1
+    db.query(Dispatch).filter(Dispatch.external_system == "other").delete()
+    db.commit()
+    assert "other" not in dispatch_counts(db)
+
+    response = client.simulate_get('/submissions/stats')
+    assert response.status_code == 200
+    assert response.json['data']['dispatches']["stats"][DISPATCH_DONE] ==\
+            before.get("stats", {}).get(DISPATCH_DONE, 0) + 1
+
+    # counts are read once per interval
+    clock = MagicMock(return_value=100.0)
+    resource = StatsResource(cache_seconds=5, clock=clock)
+    req = MagicMock()
+    req.get_header.return_value = CLIENT_HEADERS["ACCESS_KEY"]
+    resource.on_get(req, MagicMock())
+    insert_dispatch(db, s.id, "cached", DISPATCH_QUEUED)
+    resp = MagicMock()
+    resource.on_get(req, resp)
+    assert "cached" not in json.loads(resp.body)['data']['dispatches']
+    clock.return_value = 105.0
+    resource.on_get(req, resp)
+    assert req.context.session.query.call_count == 2
+    db.close()
+
+    # create_all adds the triggers along with the table, and only then
+    engine = sqlalchemy.create_engine('sqlite://')
+    BASE.metadata.create_all(engine)
+    BASE.metadata.create_all(engine)
+    assert {row[0] for row in engine.execute("SELECT name FROM sqlite_master "\
+            "WHERE type = 'trigger'")} ==\
+            {'dispatch_stat_insert', 'dispatch_stat_update', 'dispatch_stat_delete'}
+
+def test_validation():
+    """test that submissions are checked against the compiled template fields"""
+    validate = Validator(MOCK_EXTERNAL_SYSTEMS, rules={
+        "block": {"type": "code", "max_length": 4},
+        "lot": {"type": "code"},
+        "est_cost": {"type": "number", "min": 0},
+        "current_sq_ft_adu_%#%": {"type": "integer", "min": 0}
+    })
+    # template fields, api payload fields and expanded groupings
+    assert {"first_name", "est_cost", "current_unit_type_adu_5", "current_sq_ft_adu_5"}\
+            <= set(validate.checks)
+    assert "current_sq_ft_adu_6" not in validate.checks
+
+    validate(dict(STANDARD_SUBMISSION_JSON, est_cost="1500.50", current_sq_ft_adu_1=400,\
+            current_sq_ft_adu_2="", unlisted_field={"kept": "as is"}))
+    with pytest.raises(ValidationError) as err:
+        validate({"block": "12345", "first_name": "x" * 2001, "last_name": ["smith"],\
+                "est_cost": "-1", "current_sq_ft_adu_1": "4OO", "current_sq_ft_adu_2": True})
+    assert err.value.errors == {
+        "block": "must be letters and digits, at most 4 long",
+        "lot": "is required",
+        "first_name": "must be at most 2000 characters",
+        "last_name": "must be a single value",
+        "est_cost": "must be at least 0",
+        "current_sq_ft_adu_1": "must be an integer",
+        "current_sq_ft_adu_2": "must be an integer"
+    }
+    assert str(err.value).startswith("Invalid submission: block must be letters")
+    with pytest.raises(ValidationError) as err:
+        validate(["block", "lot"])
+    assert err.value.errors == {"submission": "must be a json object"}
+
+def test_submission_validation_errors(client, mock_env_access_key, monkeypatch):
+    # pylint: disable=unused-argument
+    """test that every invalid field is reported and large bodies are refused"""
+    response = client.simulate_post('/submissions', json={"block": "1/2", "lot": "",\
+            "current_num_adu": "two"})
+    assert response.status_code == 400
+    assert response.json['data']['errors'] == {
+        "block": "must be letters and digits, at most 10 long",
+        "lot": "is required",
+        "current_num_adu": "must be an integer"
+    }
+
+    monkeypatch.setenv("SUBMISSION_MAX_BYTES", "100")
+    response = client.simulate_post('/submissions',\
+            json=dict(STANDARD_SUBMISSION_JSON, additional_work_text="x" * 100))
+    assert response.status_code == 413
+
+    # bodies sent without a content length
+    req = MagicMock(content_length=None)
+    req.bounded_stream.read.return_value = b"x" * 101
+    with pytest.raises(falcon.HTTPPayloadTooLarge):
+        read_body(req, 100)
+    req.bounded_stream.read.return_value = b"x" * 100
+    assert read_body(req, 100) == b"x" * 100
+
+def test_registry(mock_external_system_env, monkeypatch, tmp_path):
+    # pylint: disable=unused-argument
+    """test compiling, hot reloading and falling back of the external systems registry"""
+    registry = Registry(MOCK_EXTERNAL_SYSTEMS)
+    assert list(registry.systems) == ["dbi", "planning", "fire", "fake_dependant"]
+    assert registry.systems["fire"].parent == "dbi"
+    assert registry.systems["dbi"].dependants == ["fire"]
+    assert registry.systems["fake_dependant"].parent == "planning"
+    assert registry.systems["planning"].url == "http://planning.com"
+    assert registry.systems["planning"].retry_interval == 3
+    assert list(registry.of_type('csv')) == ["dbi"]
+
+    dependant = {"type": "api", "env_var": "FIRE_SYSTEM_URL", "template": {}}
+    for mapping in ({"planning": dict(MOCK_EXTERNAL_SYSTEMS["planning"], type="ftp")},\
+            {"planning": dict(MOCK_EXTERNAL_SYSTEMS["planning"], template=[])},\
+            {"dbi": dict(MOCK_EXTERNAL_SYSTEMS["dbi"], template={})},\
+            {"fire": dependant, "dbi": dict(MOCK_EXTERNAL_SYSTEMS["dbi"],\
+                    dependants={"fire": dependant})}):
+        with pytest.raises(RegistryError):
+            Registry(mapping)
+
+    # no config file, MAP is used
+    monkeypatch.delenv(CONFIG_ENV, raising=False)
+    monkeypatch.setenv('REGISTRY_RELOAD_SECONDS', '0')
+    monkeypatch.setattr('service.resources.registry.REGISTRY', None)
+    assert get_registry().mapping is MAP
+    # threads waiting on the lock use the registry the first one swapped in
+    assert swap(False) is get_registry()
+    assert get_registry().version == 0
+
+    config_path = tmp_path / "external_systems.json"
+    config_path.write_text(json.dumps({"version": 1, "systems": MOCK_EXTERNAL_SYSTEMS}))
+    monkeypatch.setenv(CONFIG_ENV, str(config_path))
+    registry = get_registry()
+    assert registry.version == 1
+    assert registry.source == str(config_path)
+    # unchanged files are not recompiled
+    assert get_registry() is registry
+
+    config_path.write_text(json.dumps({"version": 2, "systems": {"dbi": MAP["dbi"]}}))
+    os.utime(str(config_path), (registry.mtime + 1, registry.mtime + 1))
+    monkeypatch.setenv('REGISTRY_RELOAD_SECONDS', '3600')
+    # checked at most every REGISTRY_RELOAD_SECONDS
+    assert get_registry() is registry
+    assert get_registry(refresh=True).version == 2
+    assert list(get_registry().systems) == ["dbi"]
+
+    # broken files keep the registry in use
+    config_path.write_text(json.dumps({"systems": {}}))
+    os.utime(str(config_path), (registry.mtime + 2, registry.mtime + 2))
+    assert get_registry(refresh=True).version == 2
+    monkeypatch.setattr('service.resources.registry.REGISTRY', None)
+    assert get_registry().mapping is MAP
+    # threads waiting on the lock use the registry the first one swapped in
+    assert swap(False) is get_registry()
+
+def test_registry_dispatch(mock_env_access_key, mock_registry, monkeypatch):
+    # pylint: disable=unused-argument
+    """test that jobs are sent with the registry version they were queued with"""
+    assert tasks.dispatch_system("fire", 1).url == "http://fire.com"
+    with pytest.raises(ValueError):
+        tasks.dispatch_system("dbi", 1)
+
+    # jobs queued before the registry carry their mapping, the registry is used
+    assert tasks.dispatch_system("planning", MOCK_EXTERNAL_SYSTEMS["planning"])\
+            is mock_registry.systems["planning"]
+
+    # jobs from a newer registry make the worker reload
+    newer = Registry(MOCK_EXTERNAL_SYSTEMS, version=2)
+    with patch('service.resources.registry.swap', return_value=newer) as mock_swap:
+        assert tasks.dispatch_system("planning", 2) is newer.systems["planning"]
+    mock_swap.assert_called_once_with(True)
+
+def test_reconcile_csv(mock_env_access_key, monkeypatch, tmp_path):
+    # pylint: disable=unused-argument, too-many-locals
+    """test reconciling an inbound csv against the exported submissions"""
+    monkeypatch.setattr(tasks, 'CSV_DIR', str(tmp_path))
+    # sort the inbound ids in runs of two
+    monkeypatch.setenv('RECONCILE_SORT_BUFFER', '2')
+    assert tasks.reconcile_csv.s().apply().get() is None
+
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    def submission(exported):
+        s = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON) # pylint: disable=invalid-name
+        s.csv_date_processed = exported
+        db.commit()
+        return s.id
+    acknowledged = submission(datetime(2001, 1, 1))
+    lost = submission(datetime(2001, 1, 1))
+    recent = submission(datetime(2001, 1, 9, 12))
+    twice = submission(datetime(2001, 1, 1))
+    unexported = submission(None)
+    archived = twice + 5000
+    db.add(SubmissionArchive(id=archived, date_created=datetime(2001, 1, 1),\
+            csv_date_processed=datetime(2001, 1, 1), data='{}', external_ids='{}'))
+    db.commit()
+
+    rows = [archived, twice, "abc", acknowledged, unexported, twice, twice + 7000]
+    inbound = '"name"|adu_id\n' + ''.join('"x"|' + str(row) + '\n' for row in rows) +\
+            '\n"short"\n'
+    file_path = tmp_path / "dbi_inbound_20010110.csv"
+    file_path.write_text(inbound)
+    received = datetime(2001, 1, 10, tzinfo=timezone.utc).timestamp()
+    os.utime(str(file_path), (received, received))
+
+    counts = tasks.reconcile_csv.s().apply().get()
+    assert counts == {"missing": 2, "duplicate": 1, "mismatched": 4, "reexport": 1}
+    reports = {report: (tmp_path / name).read_text().splitlines()[1:]\
+            for name in os.listdir(str(tmp_path)) for report in counts\
+            if name.endswith("_dbi_reconcile_" + report + ".csv")}
+    assert reports["missing"] == [str(lost) + "|2001-01-01T00:00:00+00:00",\
+            str(recent) + "|2001-01-09T12:00:00+00:00"]
+    assert reports["reexport"] == [str(lost) + "|2001-01-01T00:00:00+00:00"]
+    assert reports["duplicate"] == [str(twice) + "|2"]
+    assert sorted(reports["mismatched"]) == sorted(["abc", "", str(unexported),\
+            str(twice + 7000)])
+
+    # gzipped files are read as they are
+    gz_path = tmp_path / "dbi_inbound_20010110.csv.gz"
+    gz_path.write_bytes(gzip.compress(inbound.encode('utf-8')))
+    os.utime(str(gz_path), (received, received))
+    assert tasks.reconcile_csv.s(file_path=str(gz_path)).apply().get() == counts
+
+    file_path.write_text('"name"|id\n')
+    with pytest.raises(ValueError):
+        tasks.reconcile_csv.s(file_path=str(file_path)).apply().get()
+    file_path.write_text('')
+    os.utime(str(file_path), (received, received))
+    assert tasks.reconcile_csv.s(file_path=str(file_path)).apply().get() ==\
+            {"missing": 5, "duplicate": 0, "mismatched": 0, "reexport": 4}
+
+    # runs are merged a few at a time
+    with ExternalSort(3, fanin=2) as sorter:
+        sorter.add(reversed(range(20)))
+        assert list(sorter.sorted()) == list(range(20))
+        directory = sorter.directory.name
+    assert not os.path.exists(directory)
+    db.close()
+
+def test_batch_lease(monkeypatch):
+    """test that batch leases are held by one worker at a time with increasing tokens"""
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr('service.resources.lease.CLIENT', client)
+    first = Lease("export")
+    assert first.acquire()
+    assert first.token == 1
+    second = Lease("export")
+    assert not second.acquire()
+
+    # renewals push back the expiry once a third of the lease went by
+    client.pexpire(first.key, 1000)
+    first.heartbeat()
+    assert client.pttl(first.key) <= 1000
+    first.renewed -= first.seconds
+    first.heartbeat()
+    assert client.pttl(first.key) > 1000
+
+    # an expired lease goes to the next worker with a later token
+    client.delete(first.key)
+    assert second.acquire()
+    assert second.token == 2
+    with pytest.raises(LeaseLost):
+        first.renew()
+    first.release()
+    assert client.get(second.key) == second.owner
+
+    # leases changed while a worker reads them are left to the other worker
+    def meddle(value):
+        def run(*args):
+            # pylint: disable=unused-argument
+            client.set(second.key, b'meddler')
+            return value
+        return run
+    with patch.object(redis.client.Pipeline, 'get', side_effect=meddle(second.owner)):
+        with pytest.raises(LeaseLost):
+            second.renew()
+    client.set(second.key, second.owner)
+    with patch.object(redis.client.Pipeline, 'get', side_effect=meddle(second.owner)):
+        second.release()
+    assert client.get(second.key) == b'meddler'
+    client.delete(second.key)
+    with patch.object(redis.client.Pipeline, 'exists', side_effect=meddle(0)):
+        assert not Lease("export").acquire()
+
+    # without redis there is a single worker, which always holds the lease
+    monkeypatch.setattr('service.resources.lease.CLIENT', None)
+    unshared = Lease("export")
+    assert unshared.acquire()
+    unshared.renew()
+    unshared.release()
+    # redis brokers get a client
+    monkeypatch.setenv('REDIS_URL', 'redis://localhost:6379/0')
+    assert isinstance(get_lease_client(), redis.Redis)
+
+def test_batch_task_lease(mock_env_access_key, mock_external_system_env, monkeypatch,\
+        tmp_path):
+    # pylint: disable=unused-argument
+    """test that batch tasks run under a lease which fences their exports"""
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr('service.resources.lease.CLIENT', client)
+    monkeypatch.setattr(tasks, 'CSV_DIR', str(tmp_path))
+    monkeypatch.delenv('DBI_FTP_SERVER', raising=False)
+
+    holder = Lease("tasks.outbound-csv")
+    assert holder.acquire()
+    assert tasks.outbound_csv.s().apply().get() is None
+    assert not os.listdir(str(tmp_path))
+    holder.release()
+
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)
+    tasks.outbound_csv.s().apply().get()
+    export_run = db.query(ExportRun).order_by(ExportRun.id.desc()).first()
+    assert export_run.status == EXPORT_DONE
+    assert export_run.fencing_token == int(client.get("fence:tasks.outbound-csv"))
+    # the lease is given up once the task finishes
+    assert not client.exists("lease:tasks.outbound-csv")
+
+    # a worker whose export was taken over by a later lease stops
+    stale = Lease("tasks.outbound-csv")
+    assert stale.acquire()
+    export_run.status = EXPORT_RUNNING
+    export_run.fencing_token = stale.token + 1
+    db.commit()
+    with pytest.raises(LeaseLost):
+        tasks.create_csv(db, 'dbi', get_registry().systems['dbi'], lease=stale)
+    export_run.status = EXPORT_DONE
+    db.commit()
+    db.close()
+
+def test_callback_dispatch(client, mock_env_access_key, mock_external_system_env, monkeypatch):
+    # pylint: disable=unused-argument, too-many-locals, too-many-statements
+    """test that callback systems free the worker and are acknowledged through the callback route"""
+    monkeypatch.setenv("PLANNING_CALLBACK_SECRET", "shh")
+    monkeypatch.setenv("CALLBACK_BASE_URL", "https://adu.example.com/")
+    systems = dict(MOCK_EXTERNAL_SYSTEMS, planning=dict(MOCK_EXTERNAL_SYSTEMS["planning"],\
+            callback_secret_var="PLANNING_CALLBACK_SECRET"))
+    registry = Registry(systems, version=1)
+    monkeypatch.setattr('service.resources.registry.REGISTRY', registry)
+    with pytest.raises(RegistryError):
+        Registry({"dbi": dict(MOCK_EXTERNAL_SYSTEMS["dbi"], callback_secret_var="SECRET")})
+
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    s, unsent, rejected = [create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)\
+            for _ in range(3)] # pylint: disable=invalid-name
+    for submission in (s, rejected):
+        assert len(tasks.schedule(submission, ["planning"])) == 1
+        with patch('tasks.requests.post') as mock_post:
+            mock_post.return_value.status_code = 202
+            dispatch.s("planning", registry_version=1, submission_obj=submission).apply()
+        assert mock_post.call_args[1]['headers'][tasks.CALLBACK_URL_HEADER] ==\
+                "https://adu.example.com/callbacks/planning/" + str(submission.id)
+        assert mock_post.call_args[1]['timeout'] == tasks.DISPATCH_TIMEOUT < tasks.DISPATCH_LEASE
+    db.expire_all()
+    ledger = db.query(Dispatch).filter(Dispatch.submission_id == s.id).one()
+    assert ledger.state == DISPATCH_PENDING
+    assert not db.query(ExternalId).filter(ExternalId.submission_id == s.id).count()
+
+    def callback(code, submission_id, body, secret="shh"):
+        body = json.dumps(body).encode('utf-8')
+        return client.simulate_post('/callbacks/' + code + '/' + str(submission_id), body=body,\
+                headers={SIGNATURE_HEADER: sign(secret, body)})
+    success = {"status": "success", "data": {"id": "p-1"}}
+    assert callback("planning", s.id, success, secret="guess").status_code == 403
+    assert callback("fire", s.id, success).status_code == 403
+    assert callback("retired", s.id, success).status_code == 403
+    assert callback("planning", s.id, {"status": "success"}).status_code == 400
+    assert callback("planning", s.id + 1000, success).status_code == 404
+    assert callback("planning", unsent.id, success).status_code == 409
+
+    with patch.object(queue, 'send_task') as mock_send:
+        response = callback("planning", s.id, success)
+        assert response.status_code == 200
+        assert response.json['data']['job_ids'] == [mock_send.call_args[1]['task_id']]
+        assert response.json['data']['group_id'] == mock_send.call_args[1]['group_id']
+        assert mock_send.call_args[0][1][0] == "fake_dependant"
+        # repeated callbacks change nothing
+        response = callback("planning", s.id, success)
+        assert response.json['data'] == {"submission_id": s.id, "external_id": "p-1",\
+                "group_id": None, "job_ids": []}
+        assert mock_send.call_count == 1
+    db.expire_all()
+    assert ledger.state == DISPATCH_DONE
+    assert db.query(ExternalId.external_id).filter(ExternalId.submission_id == s.id)\
+            .scalar() == "p-1"
+
+    # an amendment is called back again, repeats answer with the id it got
+    assert amend_submission(db, s, dict(STANDARD_SUBMISSION_JSON, block="5"),\
+            {"block": ["1", "5"]}, ["planning"], False)
+    assert len(tasks.schedule(s, ["planning"], amended=["planning"])) == 1
+    with patch('tasks.requests.post') as mock_post:
+        mock_post.return_value.status_code = 202
+        dispatch.s("planning", registry_version=1, submission_obj=s).apply()
+    amended = {"status": "success", "data": {"id": "p-2"}}
+    with patch.object(queue, 'send_task'):
+        assert callback("planning", s.id, amended).status_code == 200
+        response = callback("planning", s.id, amended)
+    assert response.status_code == 200
+    assert response.json['data']['external_id'] == "p-2"
+    assert db.query(ExternalId.external_id).filter(ExternalId.submission_id == s.id)\
+            .all() == [("p-2",)]
+
+    # rejected dispatches are failed with a dead letter to replay
+    response = callback("planning", rejected.id, {"status": "fail", "data": {"block": "bad"}})
+    assert response.status_code == 200
+    dead_letter = db.query(DeadLetter).filter(DeadLetter.submission_id == rejected.id).one()
+    assert dead_letter.error_class == "CallbackError"
+    assert json.loads(dead_letter.error) == {"block": "bad"}
+    assert db.query(Dispatch.state).filter(Dispatch.submission_id == rejected.id)\
+            .scalar() == DISPATCH_FAILED
+
+    # callbacks which never come are failed after the deadline
+    waiting, recent = [create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)\
+            for _ in range(2)]
+    for submission in (waiting, recent):
+        assert len(tasks.schedule(submission, ["planning"])) == 1
+        with patch('tasks.requests.post') as mock_post:
+            mock_post.return_value.status_code = 202
+            dispatch.s("planning", registry_version=1, submission_obj=submission).apply()
+    db.query(Dispatch).filter(Dispatch.submission_id == waiting.id).update(\
+            {Dispatch.date_updated: datetime.now(timezone.utc) - timedelta(hours=25)},\
+            synchronize_session=False)
+    db.commit()
+    assert unsettled_dispatches(db, waiting.id) == ["planning"]
+    assert tasks.expire_callbacks.s(batch_size=1).apply().get() == 1
+    dead_letter = db.query(DeadLetter).filter(DeadLetter.submission_id == waiting.id).one()
+    assert (dead_letter.error_class, dead_letter.attempts) == ("CallbackTimeout", 1)
+    assert unsettled_dispatches(db, waiting.id) == []
+    assert db.query(Dispatch.state).filter(Dispatch.submission_id == recent.id)\
+            .scalar() == DISPATCH_PENDING
+    assert callback("planning", waiting.id, success).status_code == 409
+
+    # without its secret a callback system is never posted to
+    monkeypatch.delenv("PLANNING_CALLBACK_SECRET")
+    monkeypatch.setattr('service.resources.registry.REGISTRY', Registry(systems, version=1))
+    assert len(tasks.schedule(unsent, ["planning"])) == 1
+    with patch('tasks.requests.post') as mock_post:
+        dispatch.s("planning", registry_version=1, submission_obj=unsent).apply()
+    mock_post.assert_not_called()
+    assert db.query(DeadLetter.error).filter(DeadLetter.submission_id == unsent.id)\
+            .scalar() == "No callback secret set for PLANNING_CALLBACK_SECRET"
+    db.close()
+    queue.control.purge()
+
+def test_amend_submission(client, mock_env_access_key, mock_external_system_env, monkeypatch):
+    # pylint: disable=unused-argument, too-many-locals, too-many-statements
+    """test that amendments are versioned and only reach the systems reading a changed field"""
+    systems = dict(MOCK_EXTERNAL_SYSTEMS, planning=dict(MOCK_EXTERNAL_SYSTEMS["planning"],\
+            template={"block": "block", "lot": "lot"}))
+    registry = Registry(systems, version=1)
+    monkeypatch.setattr('service.resources.registry.REGISTRY', registry)
+    assert registry.field_systems["current_sq_ft_adu_5"] == ["dbi"]
+    assert registry.field_systems["fire template"] == ["fire", "fake_dependant"]
+    assert registry.reading(["block", "first_name", "unread"]) == ["dbi", "planning"]
+
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    s, busy = [create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)\
+            for _ in range(2)] # pylint: disable=invalid-name
+    for code in ("planning", "fake_dependant", "fire"):
+        insert_dispatch(db, s.id, code, DISPATCH_DONE)
+        s.create_external_id(db, code, code[0] + "-1")
+    s.csv_date_processed = datetime.now(timezone.utc)
+    insert_dispatch(db, busy.id, "planning", DISPATCH_QUEUED)
+    db.commit()
+
+    def amend(submission_id, body):
+        return client.simulate_patch('/submissions/' + str(submission_id), body=body)
+    assert amend(s.id, '[1]').status_code == 400
+    assert amend(s.id, '{"block": ').status_code == 400
+    response = amend(s.id, '{"block": null}')
+    assert response.status_code == 400
+    assert response.json['data']['errors'] == {"block": "is required"}
+    assert amend(s.id + 1000, '{"block": "5"}').status_code == 404
+    assert amend(busy.id, '{"block": "5"}').status_code == 409
+
+    published = []
+    def publish(*args, **kwargs): # pylint: disable=unused-argument
+        # jobs are pickled when published, before the request's session expires them
+        published.append(pickle.dumps(args[1]))
+        return DEFAULT
+    with patch.object(queue, 'send_task', side_effect=publish) as mock_send:
+        response = amend(s.id, '{"block": "5", "lot": 2}')
+        assert response.status_code == 200
+        assert response.json['data']['version'] == 1
+        assert response.json['data']['changed'] == ["block"]
+        assert response.json['data']['external_systems'] == ["planning"]
+        assert not response.json['data']['reexport']
+        assert response.json['data']['job_ids'] == [mock_send.call_args[1]['task_id']]
+        job = pickle.loads(published[0])
+        assert job[0] == "planning"
+        # nothing changed, nothing sent
+        response = amend(s.id, '{"lot": 2, "unit": null}')
+        assert response.json['data']['version'] == 1
+        assert response.json['data']['changed'] == []
+        assert mock_send.call_count == 1
+    db.expire_all()
+    assert db.query(Dispatch.state).filter(Dispatch.submission_id == s.id)\
+            .filter(Dispatch.external_system == "planning").scalar() == DISPATCH_QUEUED
+    assert amend(s.id, '{"block": "6"}').status_code == 409
+    amendment = db.query(SubmissionAmendment).filter(SubmissionAmendment.submission_id == s.id)\
+            .one()
+    assert (amendment.version, json.loads(amendment.diff)) == (1, {"block": [1, "5"]})
+    assert json.loads(amendment.external_systems) == ["planning"]
+
+    # the amended data is a new post to the external system
+    with patch('tasks.requests.post') as mock_post, patch.object(queue, 'send_task') as mock_send:
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.text = EXTERNAL_RESPONSE
+        dispatch.s(*job).apply()
+        assert mock_post.call_args[1]['headers'][tasks.IDEMPOTENCY_HEADER] ==\
+                "adu-" + str(s.id) + "-planning-v1"
+        # its dependant reads nothing which changed
+        assert not mock_send.called
+    db.expire_all()
+    # the id of the amended post replaces the first one
+    assert db.query(ExternalId.external_id).filter(ExternalId.submission_id == s.id)\
+            .filter(ExternalId.external_system == "planning").count() == 1
+
+    # csv systems get the amended row in their next export
+    response = amend(s.id, '{"first_name": "rob", "current_sq_ft_adu_2": 400}')
+    assert response.json['data']['version'] == 2
+    assert response.json['data']['external_systems'] == ["dbi"]
+    assert response.json['data']['reexport']
+    assert response.json['data']['group_id'] is None
+    db.expire_all()
+    assert s.csv_date_processed is None
+    assert json.loads(s.data) == dict(STANDARD_SUBMISSION_JSON, block="5", first_name="rob",\
+            current_sq_ft_adu_2=400)
+
+    # a version is only made once
+    stale = session().query(Submission).get(s.id)
+    data = json.loads(s.data)
+    assert amend_submission(db, s, data, {}, [], False)
+    assert not amend_submission(db, stale, data, {}, [], False)
+    assert s.version == 3
+    with patch('service.resources.submission.amend_submission', return_value=False):
+        assert amend(s.id, '{"block": "7"}').status_code == 409
+
+    archived_id = db.query(sqlalchemy.func.max(Submission.id)).scalar() + 1000
+    db.add(SubmissionArchive(id=archived_id, date_created=datetime.now(timezone.utc),\
+            data=json.dumps(STANDARD_SUBMISSION_JSON), external_ids='{}'))
+    db.commit()
+    assert amend(archived_id, '{"block": "5"}').status_code == 409
+    db.close()
+    queue.control.purge()
+
+def test_export_parquet(mock_env_access_key, mock_external_system_env, monkeypatch, tmp_path):
+    # pylint: disable=unused-argument, too-many-locals, too-many-statements
+    """test that submissions are exported to typed, day partitioned parquet files"""
+    pa = pytest.importorskip("pyarrow")
+    from pyarrow import dataset, parquet # pylint: disable=import-outside-toplevel
+    from service.resources.columnar import to_array, PartitionWriter, record_batch,\
+            export_schema # pylint: disable=import-outside-toplevel
+    monkeypatch.setattr(tasks, 'PARQUET_DIR', None)
+    assert tasks.export_parquet.s().apply().get() == []
+    monkeypatch.setattr(tasks, 'PARQUET_DIR', str(tmp_path))
+    monkeypatch.setattr(tasks, 'CSV_CHUNK_SIZE', 2)
+
+    assert to_array([1, "2", "2.5", True, "x", None], pa.int64()).to_pylist() ==\
+            [1, 2, None, None, None, None]
+    assert to_array([str(2 ** 63 - 1), str(2 ** 63), -2 ** 63, "-" + "9" * 30], pa.int64())\
+            .to_pylist() == [2 ** 63 - 1, None, -2 ** 63, None]
+    assert to_array([1, "2.5", 3.5, False], pa.float64()).to_pylist() == [1.0, 2.5, 3.5, None]
+    assert to_array(["a", 5, True, ["b"], None], pa.string()).to_pylist() ==\
+            ["a", "5", "true", None, None]
+    codes = to_array(["V-B", "V-B", "III-A"], pa.dictionary(pa.int32(), pa.string()))
+    assert codes.dictionary.to_pylist() == ["V-B", "III-A"]
+
+    session = create_session()
+    db = session() # pylint: disable=invalid-name
+    # a run interrupted after its first file
+    submissions = [create_submission(db_session=db, json_data=dict(STANDARD_SUBMISSION_JSON,\
+            type_of_construction=construction, est_cost=cost, current_unit_type_adu_2="garage"))\
+            for construction, cost in (("V-B", "12000.50"), ("III-A", 9000), ("V-B", "n/a"))]
+    days = [datetime(2026, 1, 1, 8), datetime(2026, 1, 1, 23), datetime(2026, 1, 2, 9)]
+    for submission, day in zip(submissions, days):
+        submission.date_created = day.replace(tzinfo=timezone.utc)
+    interrupted = ExportRun(external_system=tasks.PARQUET_RUN_PREFIX + "dbi",\
+            status=EXPORT_RUNNING, file_path=str(tmp_path), high_water_mark=submissions[-1].id,\
+            checkpoint_id=0, checkpoint_offset=0, rows_written=0)
+    db.add(interrupted)
+    db.commit()
+    stale = tmp_path / "date=2026-01-01"
+    stale.mkdir()
+    (stale / ("run-" + str(interrupted.id) + "-0.parquet")).write_bytes(b"stale")
+    (stale / (".run-" + str(interrupted.id) + "-1.parquet")).write_bytes(b"stale")
+
+    paths = tasks.export_parquet.s().apply().get()
+    assert [os.path.relpath(path, str(tmp_path)) for path in paths[-2:]] == [\
+            os.path.join("date=2026-01-01", "run-" + str(interrupted.id) + "-" +\
+            str(len(paths) - 2) + ".parquet"),\
+            os.path.join("date=2026-01-02", "run-" + str(interrupted.id) + "-" +\
+            str(len(paths) - 1) + ".parquet")]
+    assert sorted(os.listdir(str(stale))) == [os.path.basename(paths[-2])]
+    db.expire_all()
+    assert interrupted.status == EXPORT_DONE
+    assert interrupted.rows_written == db.query(Submission)\
+            .filter(Submission.id <= interrupted.high_water_mark).count()
+
+    table = dataset.dataset(str(tmp_path), format="parquet", partitioning="hive").to_table(\
+            filter=dataset.field("adu_id") >= submissions[0].id)
+    assert table.schema.field("type_of_construction").type ==\
+            pa.dictionary(pa.int32(), pa.string())
+    assert table.schema.field("est_cost").type == pa.float64()
+    rows = sorted(table.to_pylist(), key=lambda row: row["adu_id"])
+    assert [row["adu_id"] for row in rows] == [submission.id for submission in submissions]
+    assert [row["type_of_construction"] for row in rows] == ["V-B", "III-A", "V-B"]
+    assert [row["est_cost"] for row in rows] == [12000.5, 9000.0, None]
+    assert rows[0]["current_unit_type_adu_2"] == "garage"
+    assert rows[0]["block"] == "1" and rows[0]["version"] == 0
+    metadata = parquet.ParquetFile(paths[-1]).metadata.row_group(0)
+    encodings = {metadata.column(i).path_in_schema: metadata.column(i).encodings\
+            for i in range(metadata.num_columns)}
+    assert "RLE_DICTIONARY" in encodings["type_of_construction"]
+    assert "RLE_DICTIONARY" not in encodings["first_name"]
+
+    # later runs only export what came since
+    assert tasks.export_parquet.s().apply().get() == []
+    latest = create_submission(db_session=db, json_data=STANDARD_SUBMISSION_JSON)
+    paths = tasks.export_parquet.s().apply().get()
+    assert len(paths) == 1
+    assert parquet.read_table(paths[0]).column("adu_id").to_pylist() == [latest.id]
+
+    # a failed export leaves its open file hidden
+    schema = export_schema([("Block", "block")], {})
+    batch = record_batch([(1, datetime(2026, 1, 3), 0, '{"block": "1"}')], schema)
+    with pytest.raises(ValueError):
+        with PartitionWriter(str(tmp_path), "failed", schema) as writer:
+            writer.write(batch)
+            raise ValueError("export failed")
+    assert os.listdir(str(tmp_path / "date=2026-01-03")) == [".failed-0.parquet"]
+    db.close()
@@ -0,0 +1,67 @@
+"""
+    starts one celery worker per queue
+
+    each external api system gets a worker on its own queue, sized by
+    CELERY_CONCURRENCY_<CODE> or the system's "concurrency" mapping setting,
+    csv batch jobs and everything else get a worker each
+"""
+import os
+import sys
+import time
+import signal
+import subprocess
+import celeryconfig
+from service.resources.registry import get_registry
+
+DEFAULT_CONCURRENCY = 2
+BATCH_CONCURRENCY = 1
+POLL_SECONDS = 1.0 # between checks for a worker which exited
+
+def concurrency(name, default, environ):
+    """worker concurrency for a queue, overridable per queue from the environment"""
+    return int(environ.get('CELERY_CONCURRENCY_' + name.upper(), default))
+
+def worker_command(name, queue, processes):
+    """celery worker command line consuming a single queue"""
+    return ['celery', '--app=tasks', 'worker',\
+            '--queues=' + queue,\
+            '--concurrency=' + str(processes),\
+            '--hostname=' + name + '@%h',\
+            '--loglevel=info']
+
+def worker_commands(registry, environ):
+    """one worker command per queue"""
+    commands = [
+        worker_command('default', celeryconfig.DEFAULT_QUEUE,\
+                concurrency('default', DEFAULT_CONCURRENCY, environ)),
+        worker_command('batch', celeryconfig.BATCH_QUEUE,\
+                concurrency('batch', BATCH_CONCURRENCY, environ))
+    ]
+    for code, system in registry.of_type('api').items():
+        commands.append(worker_command(code, celeryconfig.dispatch_queue(code),\
+                concurrency(code, system.config.get('concurrency', DEFAULT_CONCURRENCY),\
+                environ)))
+    return commands
+
+def main():
+    """run the workers until one exits or we are asked to stop"""
+    workers = [subprocess.Popen(command) for command in worker_commands(get_registry(), os.environ)]
+
+    def stop(signum, _frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # the first to exit, whichever it is, takes the others down with it
+    while all(worker.poll() is None for worker in workers):
+        time.sleep(POLL_SECONDS)
+    stop(signal.SIGTERM, None)
+    exit_code = 0
+    for worker in workers:
+        exit_code = worker.wait() or exit_code
+    sys.exit(exit_code)
+
+if __name__ == '__main__':
+    main()